@@ -0,0 +1,259 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Benchmarks
+#
+# Micro benchmarks time single calls of the model, controller and utility
+# hot paths. Macro benchmarks time the sim_1 startup scenario (10 ms at
+# 1 MHz) on every engine and parameter set and report the simulated seconds
+# per wall second and the evaluations per second: model evaluations (RHS) for
+# the engines integrating the model, propagator steps for expm and multirate.
+#
+# Every benchmark is repeated, its spread being how much slower the median
+# repeat is than the best one. A slowdown against the baseline is only
+# flagged when it exceeds regression_ratio widened by the spreads of both
+# runs.
+#
+# python bench.py               run and compare with the stored baseline
+# python bench.py --save        run and store the results as the baseline
+# python bench.py --engines event --psets 2
+#
+
+import numpy as np
+import argparse
+import json
+import os
+import platform
+import time as wall
+import timeit
+
+import misc_utils as mu
+import dyn_model  as dm
+import control    as ctl
+import event_sim  as es
+import expm_sim   as xs
+import multirate_sim as ms
+import sim_1
+
+# Baseline file, next to this one
+baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+# Slowdown against the baseline reported as a regression, before widening by
+# the spreads
+regression_ratio = 1.2
+
+# Repeats of every benchmark
+micro_repeat = 5
+macro_repeat = 3
+
+# Startup scenario of the macro benchmarks
+macro_t_end = 0.01
+macro_dt = 1e-6
+macro_X0 = [0, mu.rad_of_deg(0.1), 0, 0, 0]
+macro_W = [0, 1]
+
+engines = {
+    'event' : lambda X0, W, P: es.simulate(X0, macro_t_end, W, macro_dt, P),
+    'expm'  : lambda X0, W, P: xs.simulate(X0, macro_t_end, W, macro_dt, P),
+    'multirate' : lambda X0, W, P: ms.simulate(X0, macro_t_end, W, macro_dt, P),
+    'step'  : lambda X0, W, P: sim_1.run_fixed_step(X0, macro_t_end, W, macro_dt, P, progress=False),
+    }
+
+# Evaluations counted for each engine, and the function counted for them:
+# the model RHS or the propagator step (one switch state lookup per step)
+engine_evals = {
+    'event'     : 'RHS',
+    'expm'      : 'steps',
+    'multirate' : 'steps',
+    'step'      : 'RHS',
+    }
+eval_functions = {
+    'RHS'   : (dm.Model, 'dyn'),
+    'steps' : (xs, 'switch_state_index'),
+    }
+
+#
+# Best time and spread of a list of repeat times
+#
+def best_and_spread(times):
+    times = sorted(times)
+    return times[0], times[len(times) // 2] / times[0] - 1.
+
+#
+# Time of a call of fn, in seconds, over repeat runs of number calls
+#
+# Returns the best time and the spread of the repeats
+def best_time(fn, number, repeat=micro_repeat):
+    best, spread = best_and_spread(timeit.repeat(fn, number=number, repeat=repeat))
+    return best / number, spread
+
+#
+# Micro benchmarks
+#
+# Returns a dictionary of the time per call of every benchmark, in seconds
+def run_micro(number=20000):
+    P = dm.MotorParams.from_pset(2)
+    X = np.array([0.3, 50., 0.1, -0.2, 0.1])
+    U = np.array([0., 1., 1., 0., 0., 0.])
+    W = [0., 1.]
+    Y = dm.output(X, U, P)
+    model = dm.Model(P)
+
+    benchmarks = [
+        ('backemf',    lambda: dm.backemf(X, 0., P)),
+        ('voltages',   lambda: dm.voltages(X, U, P)),
+        ('dyn',        lambda: dm.dyn(X, 0., U, W, P)),
+        ('dyn_debug',  lambda: dm.dyn_debug(X, 0., U, W, P)),
+        ('output',     lambda: dm.output(X, U, P)),
+        ('Model.dyn',  lambda: model.dyn(X, 0., U, W)),
+        ('control.run', lambda: ctl.run(0, Y, 0.0001, P)),
+        ('norm_angle', lambda: mu.norm_angle(7.5)),
+        ]
+    results = {}
+    for name, fn in benchmarks:
+        t, spread = best_time(fn, number)
+        results[name] = {'time' : t, 'spread' : spread}
+    return results
+
+#
+# Count the calls of the function name of owner (a module or a class) while
+# running fn
+#
+def count_calls(owner, name, fn):
+    count = [0]
+    original = vars(owner)[name]
+    counted = getattr(owner, name)
+    def counting(*args):
+        count[0] += 1
+        return counted(*args)
+    setattr(owner, name, counting)
+    try:
+        fn()
+    finally:
+        setattr(owner, name, original)
+    return count[0]
+
+#
+# Macro benchmarks
+#
+# Returns a dictionary, indexed by 'engine/pset', of the best wall time and
+# the spread of the repeats, the simulated seconds per wall second and the
+# evaluations per second, the evaluations being named by 'evals'
+def run_macro(engine_names, pset_names, repeat=macro_repeat):
+    results = {}
+    for engine in engine_names:
+        owner, name = eval_functions[engine_evals[engine]]
+        for pset in pset_names:
+            P = dm.MotorParams.from_pset(pset)
+            simulate = engines[engine]
+            count = count_calls(owner, name, lambda: simulate(macro_X0, macro_W, P))
+            times = []
+            for k in range(repeat):
+                t0 = wall.time()
+                simulate(macro_X0, macro_W, P)
+                times.append(wall.time() - t0)
+            elapsed, spread = best_and_spread(times)
+            results["{}/{}".format(engine, pset)] = {
+                'wall'      : elapsed,
+                'spread'    : spread,
+                'sim_rate'  : macro_t_end / elapsed,
+                'eval_rate' : count / elapsed,
+                'evals'     : engine_evals[engine],
+                }
+    return results
+
+def load_baseline():
+    if not os.path.exists(baseline_file):
+        return None
+    return json.load(open(baseline_file))
+
+def save_baseline(results):
+    f = open(baseline_file, 'w')
+    json.dump(results, f, indent=1, sort_keys=True)
+    f.close()
+
+#
+# Ratio of a time to its baseline, '' when there is no baseline
+#
+# The regression threshold is widened by the spreads of the result and of the
+# baseline.
+def compare(result, base):
+    if base is None:
+        return ''
+    ratio = result['time'] / base['time']
+    threshold = regression_ratio * (1. + result['spread'] + base['spread'])
+    flag = '  REGRESSION' if ratio > threshold else ''
+    return "{:8.2f}x{}".format(ratio, flag)
+
+#
+# Time entry of a macro result, for compare
+#
+def macro_time(result):
+    if result is None:
+        return None
+    return {'time' : result['wall'], 'spread' : result['spread']}
+
+def report(results, baseline):
+    micro = baseline.get('micro', {}) if baseline else {}
+    macro = baseline.get('macro', {}) if baseline else {}
+    print "{:<14} {:>12} {:>8} {:>9}".format('micro', 'us/call', 'spread', 'vs base')
+    for name in sorted(results['micro']):
+        r = results['micro'][name]
+        print "{:<14} {:12.3f} {:7.1%} {}".format(name, r['time'] * 1e6, r['spread'],
+                                                  compare(r, micro.get(name)))
+    print
+    print "{:<14} {:>10} {:>8} {:>14} {:>12} {:<6} {:>9}".format(
+        'macro', 'wall (s)', 'spread', 'sim s/wall s', 'evals/s', '', 'vs base')
+    for name in sorted(results['macro']):
+        r = results['macro'][name]
+        print "{:<14} {:10.3f} {:7.1%} {:14.5f} {:12.0f} {:<6} {}".format(
+            name, r['wall'], r['spread'], r['sim_rate'], r['eval_rate'], r['evals'],
+            compare(macro_time(r), macro_time(macro.get(name))))
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulator benchmarks')
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--engines', nargs='+', default=sorted(engines.keys()), choices=sorted(engines.keys()))
+    parser.add_argument('--psets', nargs='+', type=int, default=sorted(dm.psets.keys()))
+    parser.add_argument('--no-macro', action='store_true', help='only run the micro benchmarks')
+    args = parser.parse_args()
+
+    results = {'machine' : platform.node(), 'micro' : run_micro(), 'macro' : {}}
+    if not args.no_macro:
+        results['macro'] = run_macro(args.engines, args.psets)
+
+    baseline = load_baseline()
+    if baseline and not all(isinstance(r, dict) for r in baseline['micro'].values()):
+        print "baseline in an older format, ignored (store a new one with --save)"
+        baseline = None
+    if baseline and baseline.get('machine') != results['machine']:
+        print "baseline recorded on {}, comparisons are indicative".format(baseline.get('machine'))
+    report(results, baseline)
+
+    if args.save:
+        if baseline:
+            baseline['micro'].update(results['micro'])
+            baseline['macro'].update(results['macro'])
+            baseline['machine'] = results['machine']
+            results = baseline
+        save_baseline(results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Checkpointed runs
+#
+# A checkpointed run streams its trajectory to a directory (see traj_store)
+# with the event engine and saves a snapshot to directory/checkpoints every
+# checkpoint_every of simulated time. A snapshot holds everything needed to
+# carry on from there: the engine loop state (time, state, last command,
+# output grid position), the controller settings, the run settings and the
+# position of the trajectory writer.
+#
+#   run(directory, ...)            start a checkpointed run
+#   resume(directory)              carry on from the last (or a given) snapshot
+#   fork(directory, new_directory, PWM_duty=0.7)
+#                                  start a new run from a snapshot of another
+#                                  one with different controller settings,
+#                                  sharing the trajectory up to the snapshot
+#
+
+import copy
+import os
+import pickle
+import shutil
+
+import control    as ctl
+import event_sim  as es
+import traj_store as ts
+
+# Directory of the snapshots in a run directory
+checkpoint_dir = 'checkpoints'
+
+#
+# File of the snapshot taken at the output grid position n_out
+#
+def checkpoint_file(directory, n_out):
+    return os.path.join(directory, checkpoint_dir, 'ckpt_{:012d}.pkl'.format(n_out))
+
+#
+# Snapshot files of a run, oldest first
+#
+def checkpoints(directory):
+    path = os.path.join(directory, checkpoint_dir)
+    if not os.path.isdir(path):
+        return []
+    return [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.pkl')]
+
+def latest(directory):
+    files = checkpoints(directory)
+    if not files:
+        raise ValueError("no checkpoint in {}".format(directory))
+    return files[-1]
+
+def save(filename, snapshot):
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    # write then rename, a crash never leaves a partial snapshot
+    f = open(filename + '.tmp', 'wb')
+    pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.rename(filename + '.tmp', filename)
+
+def load(filename):
+    f = open(filename, 'rb')
+    snapshot = pickle.load(f)
+    f.close()
+    return snapshot
+
+#
+# Remove the snapshots taken after the one in filename
+#
+def drop_after(directory, filename):
+    for name in checkpoints(directory):
+        if os.path.basename(name) > os.path.basename(filename):
+            os.remove(name)
+
+#
+# Run the event engine from start (None for X0) with snapshots
+#
+# The controller runs with the settings of the run, the ones of the process
+# are restored afterwards.
+def run_from(directory, settings, start, writer):
+    saved = ctl.settings()
+    ctl.apply_settings(**settings['controller'])
+
+    def on_checkpoint(state):
+        snapshot = {'settings'   : settings,
+                    'controller' : ctl.settings(),
+                    'state'      : state,
+                    'writer'     : writer.position()}
+        save(checkpoint_file(directory, state['n_out']), snapshot)
+
+    try:
+        es.simulate(settings['X0'], settings['t_end'], settings['W'], settings['dt'], settings['P'],
+                    Sp=settings['Sp'], writer=writer, start=start, on_checkpoint=on_checkpoint,
+                    checkpoint_every=settings['checkpoint_every'], **settings['solver'])
+    finally:
+        ctl.apply_settings(**saved)
+
+#
+# Start a checkpointed run, streaming to directory
+#
+# solver takes the method, rtol and atol of event_sim.simulate
+def run(directory, X0, t_end, W, dt, P, checkpoint_every, Sp=0, decimation=1, mode='stride', **solver):
+    settings = {'X0'               : list(X0),
+                't_end'            : t_end,
+                'W'                : list(W),
+                'dt'               : dt,
+                'P'                : P,
+                'Sp'               : Sp,
+                'checkpoint_every' : checkpoint_every,
+                'solver'           : solver,
+                'controller'       : ctl.settings()}
+    shutil.rmtree(os.path.join(directory, checkpoint_dir), ignore_errors=True)
+    writer = ts.TrajWriter(directory, decimation=decimation, mode=mode)
+    run_from(directory, settings, None, writer)
+
+#
+# Carry on the run of directory from a snapshot, the last one by default
+#
+# The trajectory is cut back to the snapshot. t_end can extend the run.
+def resume(directory, filename=None, t_end=None):
+    if filename is None:
+        filename = latest(directory)
+    snapshot = load(filename)
+    settings = dict(snapshot['settings'], controller=snapshot['controller'])
+    if t_end is not None:
+        settings['t_end'] = t_end
+    drop_after(directory, filename)
+    writer = ts.TrajWriter(directory, position=snapshot['writer'])
+    run_from(directory, settings, snapshot['state'], writer)
+
+#
+# Start a new run in new_directory from a snapshot of the run of directory
+#
+# The trajectory up to the snapshot is copied, the new run carries on with
+# the controller settings changed by controller (see control.apply_settings).
+def fork(directory, new_directory, filename=None, t_end=None, **controller):
+    if filename is None:
+        filename = latest(directory)
+    snapshot = load(filename)
+    settings = dict(snapshot['settings'], controller=dict(snapshot['controller'], **controller))
+    if t_end is not None:
+        settings['t_end'] = t_end
+
+    ts.copy_prefix(directory, new_directory, snapshot['writer']['rows'])
+    shutil.rmtree(os.path.join(new_directory, checkpoint_dir), ignore_errors=True)
+    fork_snapshot = dict(snapshot, settings=settings, controller=settings['controller'])
+    save(checkpoint_file(new_directory, snapshot['state']['n_out']), fork_snapshot)
+
+    writer = ts.TrajWriter(new_directory, position=copy.deepcopy(snapshot['writer']))
+    run_from(new_directory, settings, snapshot['state'], writer)
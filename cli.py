@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Headless batch simulation
+#
+# Runs one simulation, streams the trajectory to a directory and, when asked
+# to, writes the figures of sim_1 as image files with a non interactive
+# backend. Only numpy and the modules of the selected engine are imported
+# up front, matplotlib is only loaded for the figures.
+#
+# ./cli.py --engine event --pset 2 --t-end 0.01 --out traj --figures figs
+#
+
+import numpy as np
+import argparse
+import os
+
+import misc_utils as mu
+import dyn_model  as dm
+import control    as ctl
+import traj_store as ts
+import integrators
+
+engines = ['event', 'expm', 'multirate', 'step']
+
+# Figures written, file name and size in inches
+figures = [('output.png', (10.24, 7.68)),
+           ('state.png', (10.24, 5.12)),
+           ('debug.png', (10.24, 5.12))]
+
+#
+# Run the simulation with the selected engine, streaming it to writer
+#
+# average and switching_window select the PWM averaged model of the event
+# engine, ratio is the mechanical step of the multirate engine in steps,
+# backend the integrator of the step engine, see integrators, rtol and
+# atol the tolerances of the event engine and progress whether the step
+# engine prints its progress
+def simulate(engine, X0, t_end, W, dt, P, writer, profile, average=False, switching_window=None,
+             ratio=10, backend='odeint', rtol=1e-6, atol=1e-9, progress=True):
+    if engine == 'event':
+        import event_sim as es
+        es.simulate(X0, t_end, W, dt, P, rtol=rtol, atol=atol, writer=writer, profile=profile,
+                    average=average, switching_window=switching_window)
+    elif engine == 'expm':
+        import expm_sim as xs
+        xs.simulate(X0, t_end, W, dt, P, writer=writer, profile=profile)
+    elif engine == 'multirate':
+        import multirate_sim as ms
+        ms.simulate(X0, t_end, W, dt, P, ratio=ratio, writer=writer, profile=profile)
+    else:
+        import sim_1
+        sim_1.run_fixed_step(X0, t_end, W, dt, P, writer=writer, profile=profile, backend=backend,
+                             progress=progress)
+
+#
+# Write the figures of a trajectory to a directory
+#
+def save_figures(traj, directory, image_format='png'):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import my_plot as mp
+    import sim_1
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    draw = [lambda: mp.plot_output(traj, ls='-'),
+            lambda: sim_1.display_state_and_command(traj.time, traj.X, traj.U),
+            lambda: mp.plot_debug(traj)]
+    for (name, size), fn in zip(figures, draw):
+        fig = plt.figure(figsize=size)
+        fn()
+        fig.savefig(os.path.join(directory, os.path.splitext(name)[0] + '.' + image_format))
+        plt.close(fig)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Headless BLDC simulation')
+    parser.add_argument('--engine', choices=engines, default='event')
+    parser.add_argument('--pset', type=int, default=2, help='parameter set')
+    parser.add_argument('--params', help='parameter file, overrides --pset')
+    parser.add_argument('--t-end', type=float, default=0.01, help='run length in s')
+    parser.add_argument('--dt', type=float, default=1e-6, help='simulation and sampling step in s')
+    parser.add_argument('--duty', type=float, default=ctl.PWM_duty, help='PWM duty cycle')
+    parser.add_argument('--torque', type=float, default=0., help='load torque')
+    parser.add_argument('--friction', type=float, default=1., help='dry friction')
+    parser.add_argument('--omega0', type=float, default=mu.rad_of_deg(0.1), help='initial speed in rad/s')
+    parser.add_argument('--average', action='store_true', help='PWM averaged model (event engine)')
+    parser.add_argument('--switching-window', type=float, nargs=2, metavar=('START', 'END'),
+                        help='keep the switching model from START to END s with --average')
+    parser.add_argument('--ratio', type=int, default=10,
+                        help='mechanical step in simulation steps (multirate engine)')
+    parser.add_argument('--backend', choices=integrators.names(), default='odeint',
+                        help='integrator (step engine)')
+    parser.add_argument('--tuned', action='store_true',
+                        help='step size or tolerance cached by tuner.py, overrides --dt (event: rtol)')
+    parser.add_argument('--decimation', type=int, default=3, help='decimation factor of the trajectory')
+    parser.add_argument('--mode', default='stride', help='decimation mode, see decimator')
+    parser.add_argument('--out', default='traj', help='trajectory directory')
+    parser.add_argument('--figures', help='directory the figures are written to')
+    parser.add_argument('--format', default='png', help='image format of the figures')
+    parser.add_argument('--profile', action='store_true', help='time the simulation stages')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.average and args.engine != 'event':
+        raise SystemExit("--average needs the event engine")
+
+    if args.params:
+        P = dm.MotorParams.load(args.params)
+        pset = os.path.basename(args.params)
+    else:
+        P = dm.MotorParams.from_pset(args.pset)
+        pset = args.pset
+    ctl.apply_settings(PWM_duty=args.duty)
+    X0 = [0, args.omega0, 0, 0, 0]
+
+    dt, rtol, atol = args.dt, 1e-6, 1e-9
+    if args.tuned:
+        import tuner
+        entry = tuner.cached(args.engine, pset, P, args.backend)
+        if entry is None:
+            raise SystemExit("no tuning of {} for these settings, run tuner.py".format(
+                tuner.cache_key(args.engine, pset, args.backend)))
+        dt = entry.get('dt', dt)
+        rtol = entry.get('rtol', rtol)
+        atol = tuner.atol_ratio * rtol
+    W = [args.torque, args.friction]
+
+    profile = None
+    if args.profile:
+        import profiling as pf
+        profile = pf.Profile()
+
+    writer = ts.TrajWriter(args.out, decimation=args.decimation, mode=args.mode)
+    simulate(args.engine, X0, args.t_end, W, dt, P, writer, profile,
+             args.average, args.switching_window, args.ratio, args.backend,
+             rtol, atol)
+
+    traj = ts.Trajectory(args.out)
+    print "{} samples written to {}, final speed {:.1f} rpm".format(
+        len(traj), args.out, mu.rpm_of_radps(traj.Y[-1, dm.ov_omega]))
+
+    if profile is not None:
+        print profile.summary()
+        profile.dump(os.path.join(args.out, 'profile.json'))
+
+    if args.figures:
+        save_figures(traj, args.figures, args.format)
+
+if __name__ == "__main__":
+    main()
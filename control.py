@@ -33,289 +33,190 @@ PWM_duty_time = PWM_cycle_time * PWM_duty
 debug = False
 
 #
+# Switching patterns
 #
-# Sp setpoint, Y output
+# A pattern is a pair of tables giving, for each of the 6 commutation steps,
+# the switches that are on during the PWM duty time and during the rest of
+# the PWM cycle. Switches are in the scheme order hu, lu, hv, lv, hw, lw.
+# Adding a pattern only means adding its tables to the patterns dictionary.
 #
-def run_hpwm_l_on_bipol(Sp, Y, t):
-    elec_angle = mu.norm_angle(Y[dm.ov_theta] * dm.NbPoles/2)
-
-    U = np.zeros(dm.iv_size)
-
-    step = "none"
 
-    # switching pattern based on the "encoder"
-    # H PWM L ON pattern
-    if 0. <= elec_angle <= (math.pi * (1./6.)): # second half of step 1
-        # U off
-        # V low
-        # W hpwm
-        hu = 0
-        lu = 0
-        hv = 0
-        lv = 1
-        if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-            hw = 1
-        else:
-            hw = 0
-        lw = 0
-        step = "1b"
-    elif (math.pi * (1.0/6.0)) < elec_angle <= (math.pi * (3.0/6.0)): # step 2
-        # U hpwm
-        # V low
-        # W off
-        if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-            hu = 1
-        else:
-            hu = 0
-        lu = 0
-        hv = 0
-        lv = 1
-        hw = 0
-        lw = 0
-        step = "2 "
-    elif (math.pi * (3.0/6.0)) < elec_angle <= (math.pi * (5.0/6.0)): # step 3
-        # U hpwm
-        # V off
-        # W low
-        if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-            hu = 1
-        else:
-            hu = 0
-        lu = 0
-        hv = 0
-        lv = 0
-        hw = 0
-        lw = 1
-        step = "3 "
-    elif (math.pi * (5.0/6.0)) < elec_angle <= (math.pi * (7.0/6.0)): # step 4
-        # U off
-        # V hpwm
-        # W low
-        hu = 0
-        lu = 0
-        if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-            hv = 1
-        else:
-            hv = 0
-        lv = 0
-        hw = 0
-        lw = 1
-        step = "4 "
-    elif (math.pi * (7.0/6.0)) < elec_angle <= (math.pi * (9.0/6.0)): # step 5
-        # U low
-        # V hpwm
-        # W off
-        hu = 0
-        lu = 1
-        if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-            hv = 1
-        else:
-            hv = 0
-        lv = 0
-        hw = 0
-        lw = 0
-        step = "5 "
-    elif (math.pi * (9.0/6.0)) < elec_angle <= (math.pi * (11.0/6.0)): # step 6
-        # U low
-        # V off
-        # W hpwm
-        hu = 0
-        lu = 1
-        hv = 0
-        lv = 0
-        if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-            hw = 1
-        else:
-            hw = 0
-        lw = 0
-        step = "6 "
-    elif (math.pi * (11.0/6.0)) < elec_angle <= (math.pi * (12.0/6.0)): # first half of step 1
-        # U off
-        # V low
-        # W hpwm
-        hu = 0
-        lu = 0
-        hv = 0
-        lv = 1
-        if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-            hw = 1
-        else:
-            hw = 0
-        lw = 0
-        step = "1a"
-    else:
-        print 'ERROR: The electrical angle is out of range!!!'
+# H PWM L ON pattern
+hpwm_l_on_bipol_duty = [[0, 0, 0, 1, 1, 0],  # step 1: U off,  V low,  W hpwm
+                        [1, 0, 0, 1, 0, 0],  # step 2: U hpwm, V low,  W off
+                        [1, 0, 0, 0, 0, 1],  # step 3: U hpwm, V off,  W low
+                        [0, 0, 1, 0, 0, 1],  # step 4: U off,  V hpwm, W low
+                        [0, 1, 1, 0, 0, 0],  # step 5: U low,  V hpwm, W off
+                        [0, 1, 0, 0, 1, 0]]  # step 6: U low,  V off,  W hpwm
+hpwm_l_on_bipol_off = [[0, 0, 0, 1, 0, 0],
+                       [0, 0, 0, 1, 0, 0],
+                       [0, 0, 0, 0, 0, 1],
+                       [0, 0, 0, 0, 0, 1],
+                       [0, 1, 0, 0, 0, 0],
+                       [0, 1, 0, 0, 0, 0]]
+
+# H PWM L ON pattern bipolar, the low side of the PWM phase and the high
+# side of the low phase are switched on when the PWM is off
+hpwm_l_on_duty = hpwm_l_on_bipol_duty
+hpwm_l_on_off = [[0, 0, 1, 0, 0, 1],
+                 [0, 1, 1, 0, 0, 0],
+                 [0, 1, 0, 0, 1, 0],
+                 [0, 0, 0, 1, 1, 0],
+                 [1, 0, 0, 1, 0, 0],
+                 [1, 0, 0, 0, 0, 1]]
+
+# Assigning the scheme phase values to the simulator phases
+# "Connecting the controller wires to the motor" ^^
+# This way we can for example decide which direction we want to turn the motor
+scheme_wiring = [dm.iv_hu, dm.iv_lu, dm.iv_hw, dm.iv_lw, dm.iv_hv, dm.iv_lv]
 
-    # Assigning the scheme phase values to the simulator phases
-    # "Connecting the controller wires to the motor" ^^
-    # This way we can for example decide which direction we want to turn the motor
-    U[dm.iv_hu] = hu
-    U[dm.iv_lu] = lu
-    U[dm.iv_hv] = hw
-    U[dm.iv_lv] = lw
-    U[dm.iv_hw] = hv
-    U[dm.iv_lw] = lv
+#
+# Precompute the switch vectors of a pattern
+#
+# Returns a read only array (2, 6, iv_size) indexed by [pwm on, sector]
+def pattern_table(duty, off):
+    table = np.zeros((2, 6, dm.iv_size))
+    table[0][:, scheme_wiring] = off
+    table[1][:, scheme_wiring] = duty
+    table.flags.writeable = False
+    return table
+
+patterns = {
+    'hpwm_l_on_bipol' : pattern_table(hpwm_l_on_bipol_duty, hpwm_l_on_bipol_off),
+    'hpwm_l_on'       : pattern_table(hpwm_l_on_duty, hpwm_l_on_off),
+    }
+
+# Pattern used by run
+pattern = 'hpwm_l_on_bipol'
 
-    if debug:
-        print 'time {} step {} eangle {} switches {}'.format(t, step, mu.deg_of_rad(elec_angle), U)
+#
+# Controller settings
+#
+# The settings that can be changed between runs, as a dictionary
+#
+def settings():
+    return {'PWM_freq' : PWM_freq, 'PWM_duty' : PWM_duty, 'pattern' : pattern}
 
-    return U
+#
+# Change some of the controller settings, keeping the derived timings
+# consistent
+#
+def apply_settings(**values):
+    global PWM_freq, PWM_cycle_time, PWM_duty, PWM_duty_time, pattern
+    unknown = [name for name in values if name not in settings()]
+    if unknown:
+        raise TypeError("unknown controller settings {}".format(unknown))
+    if values.get('pattern', pattern) not in patterns:
+        raise ValueError("Unknown pattern {}".format(values['pattern']))
+    PWM_freq = values.get('PWM_freq', PWM_freq)
+    PWM_duty = values.get('PWM_duty', PWM_duty)
+    pattern = values.get('pattern', pattern)
+    PWM_cycle_time = 1. / PWM_freq
+    PWM_duty_time = PWM_cycle_time * PWM_duty
 
 #
+# Commutation sectors
 #
-# Sp setpoint, Y output
+# Sector k (step k+1) spans the electrical angles ](2k-1) pi/6, (2k+1) pi/6],
+# step 1 wrapping around 0.
 #
-def run_hpwm_l_on(Sp, Y, t):
-    elec_angle = mu.norm_angle(Y[dm.ov_theta] * dm.NbPoles/2)
+sector_angle = math.pi / 3.
+sector_upper = np.array([math.pi * (1.0/6.0), math.pi * (3.0/6.0), math.pi * (5.0/6.0),
+                         math.pi * (7.0/6.0), math.pi * (9.0/6.0), math.pi * (11.0/6.0),
+                         math.pi * (13.0/6.0)])
 
-    U = np.zeros(dm.iv_size)
+#
+# Commutation sector of an electrical angle in [0, 2pi]
+#
+def sector_of(elec_angle):
+    sector = int((elec_angle + math.pi/6.) // sector_angle)
+    # settle the angles right on (or rounded across) a boundary
+    if elec_angle > sector_upper[sector]:
+        sector += 1
+    elif sector > 0 and elec_angle <= sector_upper[sector-1]:
+        sector -= 1
+    return sector % 6
 
-    step = "none"
+#
+# Commutation sectors of an array of electrical angles in [0, 2pi]
+#
+def sector_vec(elec_angle):
+    sector = np.floor_divide(elec_angle + math.pi/6., sector_angle).astype(int)
+    sector += elec_angle > sector_upper[sector]
+    sector -= (sector > 0) & (elec_angle <= sector_upper[sector-1])
+    return np.mod(sector, 6)
 
-    # switching pattern based on the "encoder"
-    # H PWM L ON pattern bipolar
-    if 0. <= elec_angle <= (math.pi * (1./6.)): # second half of step 1
-        # U off
-        # V low
-        # W hpwm
-        hu = 0
-        lu = 0
-        if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-            hw = 1
-	    lw = 0
-            hv = 0
-            lv = 1
-        else:
-            hw = 0
-            lw = 1
-            hv = 1
-            lv = 0
-        step = "1b"
-    elif (math.pi * (1.0/6.0)) < elec_angle <= (math.pi * (3.0/6.0)): # step 2
-        # U hpwm
-        # V low
-        # W off
-        if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-            hu = 1
-	    lu = 0
-            hv = 0
-            lv = 1
-        else:
-            hu = 0
-	    lu = 1
-            hv = 1
-            lv = 0
-        hw = 0
-        lw = 0
-        step = "2 "
-    elif (math.pi * (3.0/6.0)) < elec_angle <= (math.pi * (5.0/6.0)): # step 3
-        # U hpwm
-        # V off
-        # W low
-        if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-            hu = 1
-            lu = 0
-            hw = 0
-            lw = 1
-        else:
-            hu = 0
-            lu = 1
-            hw = 1
-            lw = 0
-        hv = 0
-        lv = 0
-        step = "3 "
-    elif (math.pi * (5.0/6.0)) < elec_angle <= (math.pi * (7.0/6.0)): # step 4
-        # U off
-        # V hpwm
-        # W low
-        hu = 0
-        lu = 0
-        if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-            hv = 1
-            lv = 0
-            hw = 0
-            lw = 1
-        else:
-            hv = 0
-            lv = 1
-            hw = 1
-            lw = 0
-        step = "4 "
-    elif (math.pi * (7.0/6.0)) < elec_angle <= (math.pi * (9.0/6.0)): # step 5
-        # U low
-        # V hpwm
-        # W off
-        if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-            hv = 1
-            lv = 0
-            hu = 0
-            lu = 1
-        else:
-            hv = 0
-            lv = 1
-            hu = 1
-            lu = 0
-        hw = 0
-        lw = 0
-        step = "5 "
-    elif (math.pi * (9.0/6.0)) < elec_angle <= (math.pi * (11.0/6.0)): # step 6
-        # U low
-        # V off
-        # W hpwm
-        hv = 0
-        lv = 0
-        if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-            hw = 1
-            lw = 0
-            hu = 0
-            lu = 1
-        else:
-            hw = 0
-            lw = 1
-            hu = 1
-            lu = 0
-        step = "6 "
-    elif (math.pi * (11.0/6.0)) < elec_angle <= (math.pi * (12.0/6.0)): # first half of step 1
-        # U off
-        # V low
-        # W hpwm
-        hu = 0
-        lu = 0
-        if math.fmod(t, PWM_cycle_time) <= PWM_duty_time:
-            hw = 1
-            lw = 0
-            hv = 0
-            lv = 1
-        else:
-            hw = 0
-            lw = 1
-            hv = 1
-            lv = 0
-        step = "1a"
-    else:
-        print 'ERROR: The electrical angle is out of range!!!'
+#
+# Run a switching pattern
+#
+# Sp setpoint, Y output, t time, P motor parameters
+#
+# Returns the switch vector, a row of the pattern table that must not be
+# modified
+def run_pattern(table, Sp, Y, t, P):
+    elec_angle = mu.norm_angle(Y[dm.ov_theta] * P.pole_pairs)
+    sector = sector_of(elec_angle)
+    pwm_on = math.fmod(t, PWM_cycle_time) <= PWM_duty_time
 
-    # Assigning the scheme phase values to the simulator phases
-    # "Connecting the controller wires to the motor" ^^
-    # This way we can for example decide which direction we want to turn the motor
-    U[dm.iv_hu] = hu
-    U[dm.iv_lu] = lu
-    U[dm.iv_hv] = hw
-    U[dm.iv_lv] = lw
-    U[dm.iv_hw] = hv
-    U[dm.iv_lw] = lv
+    U = table[int(pwm_on), sector]
 
     if debug:
-        print 'time {} step {} eangle {} switches {}'.format(t, step, mu.deg_of_rad(elec_angle), U)
+        print 'time {} step {} eangle {} switches {}'.format(t, sector+1, mu.deg_of_rad(elec_angle), U)
 
     return U
 
+#
+#
+# Sp setpoint, Y output
+#
+def run_hpwm_l_on_bipol(Sp, Y, t, P):
+    return run_pattern(patterns['hpwm_l_on_bipol'], Sp, Y, t, P)
 
 #
 #
 # Sp setpoint, Y output
 #
-def run(Sp, Y, t):
-    #return run_hpwm_l_on(Sp, Y, t)
-    return run_hpwm_l_on_bipol(Sp, Y, t)
+def run_hpwm_l_on(Sp, Y, t, P):
+    return run_pattern(patterns['hpwm_l_on'], Sp, Y, t, P)
+
+#
+#
+# Sp setpoint, Y output, P motor parameters
+#
+def run(Sp, Y, t, P):
+    return run_pattern(patterns[pattern], Sp, Y, t, P)
+
+#
+# PWM averaged controller
+#
+# Sp setpoint, Y output, P motor parameters
+#
+# Returns the switch vectors during and after the PWM duty time of the
+# current sector, and the duty cycle (see dyn_model.Model.set_average_command)
+def run_average(Sp, Y, t, P):
+    table = patterns[pattern]
+    sector = sector_of(mu.norm_angle(Y[dm.ov_theta] * P.pole_pairs))
+    return table[1, sector], table[0, sector], PWM_duty
+
+#
+# Vectorized controller
+#
+# Computes the switch vectors of a whole array of outputs Y (..., ov_size)
+# at once, e.g. all the members of an ensemble or all the samples of a run,
+# t being a time or an array of times.
+#
+# Sp setpoint, Y outputs, t time, P motor parameters
+# duty PWM duty cycle, can be one per output
+#
+def run_vec(Sp, Y, t, P, duty=None, pattern_name=None):
+    if duty is None:
+        duty = PWM_duty
+    if pattern_name is None:
+        pattern_name = pattern
+    Y = np.asarray(Y, dtype=float)
+
+    elec_angle = mu.norm_angle_vec(Y[..., dm.ov_theta] * np.asarray(P.pole_pairs))
+    sector = sector_vec(elec_angle)
+    pwm_on = np.fmod(t, PWM_cycle_time) <= PWM_cycle_time * np.asarray(duty)
+
+    return patterns[pattern_name][pwm_on.astype(int), sector]
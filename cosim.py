@@ -0,0 +1,250 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Lockstep co-simulation with an external controller
+#
+# The simulator (see simulator) and the controller run in two processes and
+# exchange, every control period, the output vector and the switch vector
+# through two ring buffers in a shared memory file. The file is an array of
+# doubles, so that a controller written in C (the Open-BLDC firmware built
+# for the host) can map it as well:
+#
+#   header      header_size doubles: magic, ring size, ov_size, iv_size, stop
+#   outputs     ring size slots of [seq, t, Y(ov_size)]
+#   commands    ring size slots of [seq, U(iv_size)]
+#
+# Exchange k uses the slots k % ring size. The writer of a slot fills it, then
+# writes seq = k; the reader polls seq until it reads k. There is no lock and
+# no system call in an exchange, only the stores and loads of the slots, which
+# keeps the overhead of an exchange to a few microseconds when both processes
+# have a CPU. On a single CPU the waiter sleeps instead of spinning, to hand
+# the CPU over, and an exchange costs a scheduler round trip. This relies on
+# the stores being seen in order by the other process, as they are on x86.
+#
+# With lag = 0 the simulator waits for the command of period k before
+# stepping, as the Python controller of sim_1. With lag = L > 0 the command of
+# period k is applied at period k + L, like firmware that needs time to
+# compute; the simulator and the controller then run concurrently.
+#
+# python cosim.py runs the stand-in controller (control.run) in a child
+# process against the in-process loop and reports the exchange overhead.
+#
+
+import numpy as np
+import multiprocessing
+import os
+import tempfile
+import time as wall
+
+import misc_utils as mu
+import dyn_model  as dm
+import control    as ctl
+import simulator  as sm
+
+magic = 0x0b1dc
+header_size = 8
+hd_magic = 0
+hd_ring_size = 1
+hd_ov_size = 2
+hd_iv_size = 3
+hd_stop = 4
+
+default_ring_size = 64
+
+# Polls of a slot before the waiter starts sleeping between polls. Spinning
+# only pays when the other process has a CPU of its own.
+spin_polls = 100000 if multiprocessing.cpu_count() > 1 else 0
+
+# Sleep between two polls past spin_polls, in s
+idle_pause = 1e-6
+
+#
+# Default file of a channel, in shared memory when the system has it
+#
+def default_filename():
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'pysim_cosim_{}'.format(os.getpid()))
+
+#
+# Shared memory channel
+#
+# The simulator creates it (create=True), the controller attaches to the
+# same file.
+class Channel(object):
+
+    def __init__(self, filename=None, ring_size=default_ring_size, create=True, timeout=10.):
+        self.filename = filename or default_filename()
+        self.timeout = timeout
+        if create:
+            size = header_size + ring_size * (2 + dm.ov_size) + ring_size * (1 + dm.iv_size)
+            self.buf = np.memmap(self.filename, dtype=float, mode='w+', shape=(size,))
+            self.buf[:] = -1
+            self.buf[hd_ring_size] = ring_size
+            self.buf[hd_ov_size] = dm.ov_size
+            self.buf[hd_iv_size] = dm.iv_size
+            self.buf[hd_stop] = 0
+            self.buf[hd_magic] = magic
+        else:
+            self.buf = np.memmap(self.filename, dtype=float, mode='r+')
+            if self.buf[hd_magic] != magic:
+                raise ValueError("{} is not a co-simulation channel".format(self.filename))
+            if self.buf[hd_ov_size] != dm.ov_size or self.buf[hd_iv_size] != dm.iv_size:
+                raise ValueError("{}: vector sizes do not match the model".format(self.filename))
+        self.ring_size = int(self.buf[hd_ring_size])
+        start = header_size
+        end = start + self.ring_size * (2 + dm.ov_size)
+        self.outputs = self.buf[start:end].reshape(self.ring_size, 2 + dm.ov_size)
+        self.commands = self.buf[end:].reshape(self.ring_size, 1 + dm.iv_size)
+
+    #
+    # Poll seq of slot until it reads k
+    #
+    # Returns False if the channel was stopped meanwhile
+    def wait(self, slot, k):
+        polls = 0
+        while slot[0] != k:
+            polls += 1
+            if polls > spin_polls:
+                break
+        else:
+            return True
+        deadline = wall.time() + self.timeout
+        while slot[0] != k:
+            if self.buf[hd_stop]:
+                return False
+            if wall.time() > deadline:
+                raise RuntimeError("{}: no answer for exchange {}".format(self.filename, k))
+            wall.sleep(idle_pause)
+        return True
+
+    #
+    # Simulator side
+    #
+    def put_output(self, k, t, Y):
+        slot = self.outputs[k % self.ring_size]
+        slot[1] = t
+        slot[2:] = Y
+        slot[0] = k
+
+    def get_command(self, k):
+        slot = self.commands[k % self.ring_size]
+        if not self.wait(slot, k):
+            raise RuntimeError("{}: stopped by the controller".format(self.filename))
+        return slot[1:]
+
+    #
+    # Controller side
+    #
+    # Returns the time and output vector of exchange k, None once stopped
+    def get_output(self, k):
+        slot = self.outputs[k % self.ring_size]
+        if not self.wait(slot, k):
+            return None
+        return slot[1], slot[2:]
+
+    def put_command(self, k, U):
+        slot = self.commands[k % self.ring_size]
+        slot[1:] = U
+        slot[0] = k
+
+    def stop(self):
+        self.buf[hd_stop] = 1
+
+    def close(self, remove=False):
+        del self.outputs, self.commands, self.buf
+        if remove and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+#
+# Run the simulation against the controller at the other end of channel for
+# steps periods
+#
+# Returns the time, state, output and input vectors as Simulator.run
+def run(sim, channel, steps, lag=0):
+    if lag >= channel.ring_size - 1:
+        raise ValueError("lag {} needs a ring of more than {} slots".format(lag, lag + 1))
+    time = np.zeros(steps)
+    X = np.zeros((steps, dm.sv_size))
+    Y = np.zeros((steps, dm.ov_size))
+    U = np.zeros((steps, dm.iv_size))
+    y = sim.output()
+    for k in range(steps):
+        time[k] = sim.t
+        X[k] = sim.X
+        Y[k] = y
+        channel.put_output(k, sim.t, y)
+        if k >= lag:
+            U[k] = channel.get_command(k - lag)
+        y = sim.step(U[k])
+    channel.stop()
+    return time, X, Y, U
+
+#
+# Stand-in controller: control.run at the other end of the channel in
+# filename, until the simulator stops
+#
+def stand_in(filename, P, Sp=0):
+    channel = Channel(filename, create=False)
+    k = 0
+    while True:
+        exchange = channel.get_output(k)
+        if exchange is None:
+            break
+        t, Y = exchange
+        channel.put_command(k, ctl.run(Sp, Y, t, P))
+        k += 1
+    channel.close()
+
+#
+# Start the stand-in controller in a child process
+#
+def start_stand_in(channel, P, Sp=0):
+    process = multiprocessing.Process(target=stand_in, args=(channel.filename, P, Sp))
+    process.daemon = True
+    process.start()
+    return process
+
+def main():
+    P = dm.MotorParams.from_pset(2)
+    X0 = [0, mu.rad_of_deg(0.1), 0, 0, 0]
+    W = [0, 1]
+    h = 1e-6
+    steps = 10000
+
+    sim = sm.Simulator(X0, W, P, h)
+    t0 = wall.time()
+    local = sim.run(steps)
+    local_wall = wall.time() - t0
+
+    channel = Channel()
+    controller = start_stand_in(channel, P)
+    sim = sm.Simulator(X0, W, P, h)
+    t0 = wall.time()
+    remote = run(sim, channel, steps)
+    remote_wall = wall.time() - t0
+    controller.join()
+    channel.close(remove=True)
+
+    print "in process: {:.3f} s, {:.1f} us per period".format(local_wall, 1e6 * local_wall / steps)
+    print "lockstep:   {:.3f} s, {:.1f} us per period".format(remote_wall, 1e6 * remote_wall / steps)
+    print "max state difference: {:g}".format(np.max(np.abs(remote[1] - local[1])))
+
+if __name__ == "__main__":
+    main()
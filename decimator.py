@@ -0,0 +1,210 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Streaming decimation
+#
+# A decimator reduces the rate of a stream handed over in blocks, a block
+# being a dictionary of arrays with one row per sample and a 'time' channel.
+# process(block) returns the decimated rows of the block (possibly none)
+# and flush() the rows still held back at the end of the stream. The state
+# is carried from one block to the next, so the result does not depend on
+# how the stream is cut into blocks.
+#
+# Modes:
+#   'stride'          keep every factor-th row, no filtering
+#   'fir'             linear phase low pass FIR, the time labels are delayed
+#                     by the filter delay so the rows stay aligned
+#   'iir'             Chebyshev type I low pass, the filtered channels lag
+#   'mean', 'min', 'max'
+#                     reduce every bucket of factor rows, labelled with the
+#                     time of its first row
+#
+
+import numpy as np
+
+# Taps of the FIR filter per unit of decimation factor
+fir_taps_per_factor = 20
+
+# Order and passband ripple (dB) of the IIR filter
+iir_order = 8
+iir_ripple = 0.05
+
+#
+# scipy.signal, slow to import and only needed by the filters
+#
+def scipy_signal():
+    from scipy import signal
+    return signal
+
+#
+# Rows of a channel as a 2D array, one column per component
+#
+def as_columns(a):
+    return a.reshape(len(a), -1)
+
+#
+# Keep every factor-th row of the stream
+#
+class StrideDecimator(object):
+
+    def __init__(self, factor):
+        self.factor = factor
+        self.count = 0       # rows of the stream seen so far
+
+    # indices of the rows of the next block of n rows that are kept
+    def keep(self, n):
+        first = (-self.count) % self.factor
+        self.count += n
+        return slice(first, n, self.factor)
+
+    def process(self, block):
+        keep = self.keep(len(block['time']))
+        return dict((name, a[keep]) for name, a in block.items())
+
+    def flush(self):
+        return None
+
+#
+# Low pass filter the channels then keep every factor-th row
+#
+# The time channel is not filtered. With a FIR filter it is delayed by the
+# filter delay instead: the first rows of the stream, for which there is no
+# delayed time, are dropped and flush pushes the last row through the delay.
+class FilterDecimator(object):
+
+    def __init__(self, factor, kind='fir'):
+        signal = scipy_signal()
+        self.factor = factor
+        if kind == 'fir':
+            taps = fir_taps_per_factor * factor + 1
+            self.b = signal.firwin(taps, 1. / factor)
+            self.sos = None
+            self.delay = (taps - 1) // 2
+        elif kind == 'iir':
+            # second order sections, the transfer function of high order low
+            # cutoff filters is numerically unstable
+            self.sos = signal.cheby1(iir_order, iir_ripple, 0.8 / factor, output='sos')
+            self.delay = 0
+        else:
+            raise ValueError("Unknown filter {}".format(kind))
+        self.count = 0       # rows of the stream seen so far
+        self.zi = None       # filter states of the channels
+        self.time_tail = np.zeros(0) # times of the last delay rows
+        self.last = None     # last row of the stream
+
+    def process(self, block):
+        time = block['time']
+        n = len(time)
+        if self.zi is None:
+            self.zi = dict((name, self.initial_state(as_columns(a)[0]))
+                           for name, a in block.items() if name != 'time')
+
+        # global index k of the rows kept, k >= delay and (k - delay) % factor == 0
+        k0 = self.count
+        first = max(self.delay, k0)
+        first += (-(first - self.delay)) % self.factor
+        keep = np.arange(first, k0 + n, self.factor) - k0
+
+        out = {}
+        for name, a in block.items():
+            if name == 'time':
+                continue
+            y, self.zi[name] = self.filter(as_columns(a), self.zi[name])
+            out[name] = y[keep].reshape((len(keep),) + a.shape[1:])
+
+        history = np.concatenate((self.time_tail, time))
+        out['time'] = history[keep + len(self.time_tail) - self.delay]
+        if self.delay > 0:
+            self.time_tail = history[-self.delay:]
+        self.count += n
+        if n > 0:
+            self.last = dict((name, a[-1:]) for name, a in block.items())
+        return out
+
+    def flush(self):
+        if self.delay == 0 or self.last is None:
+            return None
+        pad = dict((name, np.repeat(a, self.delay, axis=0)) for name, a in self.last.items())
+        self.last = None
+        return self.process(pad)
+
+    # filter state of a stream steady at x0
+    def initial_state(self, x0):
+        if self.sos is None:
+            return scipy_signal().lfilter_zi(self.b, 1.)[:, np.newaxis] * x0
+        return scipy_signal().sosfilt_zi(self.sos)[:, :, np.newaxis] * x0
+
+    def filter(self, x, zi):
+        if self.sos is None:
+            return scipy_signal().lfilter(self.b, 1., x, axis=0, zi=zi)
+        return scipy_signal().sosfilt(self.sos, x, axis=0, zi=zi)
+
+#
+# Reduce every bucket of factor rows to one row
+#
+# The rows of an incomplete bucket are held back until the next block, the
+# last incomplete bucket is reduced on flush.
+class BucketDecimator(object):
+
+    reductions = {'mean' : np.mean, 'min' : np.min, 'max' : np.max}
+
+    def __init__(self, factor, reduction='mean'):
+        if reduction not in self.reductions:
+            raise ValueError("Unknown reduction {}".format(reduction))
+        self.factor = factor
+        self.reduce = self.reductions[reduction]
+        self.pending = None  # rows of the incomplete bucket
+
+    def process(self, block):
+        if self.pending is not None:
+            block = dict((name, np.concatenate((self.pending[name], a))) for name, a in block.items())
+        n = len(block['time'])
+        full = (n // self.factor) * self.factor
+        self.pending = dict((name, a[full:]) for name, a in block.items())
+        return self.bucket(dict((name, a[:full]) for name, a in block.items()))
+
+    def flush(self):
+        if self.pending is None or len(self.pending['time']) == 0:
+            return None
+        pending = self.pending
+        self.pending = None
+        return self.bucket(pending, len(pending['time']))
+
+    def bucket(self, block, size=None):
+        if size is None:
+            size = self.factor
+        out = {}
+        for name, a in block.items():
+            rows = a.reshape((len(a) // size, size) + a.shape[1:])
+            if name == 'time':
+                out[name] = rows[:, 0]
+            else:
+                out[name] = self.reduce(rows, axis=1)
+        return out
+
+#
+# Decimator of a stream by factor in the given mode
+#
+def decimator(factor, mode='stride'):
+    if mode == 'stride' or factor == 1:
+        return StrideDecimator(factor)
+    if mode in ('fir', 'iir'):
+        return FilterDecimator(factor, mode)
+    return BucketDecimator(factor, mode)
@@ -22,53 +22,116 @@ import numpy as np
 import math
 import misc_utils as mu
 
-# parameters
-pset = 2
-
-if pset == 0:
-    Inertia = 0.0022 # aka. 'J' in kg/(m^2)
-    Damping = 0.001  # aka. 'B' in Nm/(rad/s)
-    Kv = 1700.       # aka. motor constant in RPM/V
-    L = 0.00312      # aka. Coil inductance in H
-    M = 0.0          # aka. Mutual inductance in H
-    R = 0.8          # aka. Phase resistence in Ohm
-    VDC = 100.       # aka. Supply voltage
-    NbPoles = 14.    # NbPoles / 2 = Number of pole pairs (you count the permanent magnets on the rotor to get NbPoles)
-    dvf = .7         # aka. freewheeling diode forward voltage
-elif pset == 1:
-    Inertia = 0.0022 # aka. 'J' in kg/(m^2)
-    Damping = 0.001  # aka. 'B' in Nm/(rad/s)
-    Kv = 70.         # aka. motor constant in RPM/V
-    L = 0.00521      # aka. Coil inductance in H
-    M = 0.0          # aka. Mutual inductance in H
-    R = 0.7          # aka. Phase resistence in Ohm
-    VDC = 100.       # aka. Supply voltage
-    NbPoles = 4.    # NbPoles / 2 = Number of pole pairs (you count the permanent magnets on the rotor to get NbPoles)
-    dvf = .7         # aka. freewheeling diode forward voltage
-elif pset == 2: #psim
-    Inertia = 0.000007            # aka. 'J' in kg/(m^2)
-    tau_shaft = 0.006
-    Damping = Inertia/tau_shaft   # aka. 'B' in Nm/(rad/s)
-    Kv = 1./32.3*1000             # aka. motor constant in RPM/V
-    L = 0.00207                   # aka. Coil inductance in H
-    M = -0.00069                  # aka. Mutual inductance in H
-    R = 11.9                      # aka. Phase resistence in Ohm
-    VDC = 100.                    # aka. Supply voltage
-    NbPoles = 4.                  #
-    dvf = .0                      # aka. freewheeling diode forward voltage
-elif pset == 3: #modified psim
-    Inertia = 0.000059            # aka. 'J' in kg/(m^2)
-    tau_shaft = 0.006
-    Damping = Inertia/tau_shaft   # aka. 'B' in Nm/(rad/s)
-    Kv = 1./32.3*1000             # aka. motor constant in RPM/V
-    L = 0.00207                   # aka. Coil inductance in H
-    M = -0.00069                  # aka. Mutual inductance in H
-    R = 11.9                      # aka. Phase resistence in Ohm
-    VDC = 300.                    # aka. Supply voltage
-    NbPoles = 4.                  #
-    dvf = .0                      # aka. freewheeling diode forward voltage
-else:
-    print "Unknown pset {}".format(pset)
+# Parameter sets
+psets = {
+    0 : {
+        'Inertia' : 0.0022, # aka. 'J' in kg/(m^2)
+        'Damping' : 0.001,  # aka. 'B' in Nm/(rad/s)
+        'Kv' : 1700.,       # aka. motor constant in RPM/V
+        'L' : 0.00312,      # aka. Coil inductance in H
+        'M' : 0.0,          # aka. Mutual inductance in H
+        'R' : 0.8,          # aka. Phase resistence in Ohm
+        'VDC' : 100.,       # aka. Supply voltage
+        'NbPoles' : 14.,    # NbPoles / 2 = Number of pole pairs (you count the permanent magnets on the rotor to get NbPoles)
+        'dvf' : .7,         # aka. freewheeling diode forward voltage
+        },
+    1 : {
+        'Inertia' : 0.0022, # aka. 'J' in kg/(m^2)
+        'Damping' : 0.001,  # aka. 'B' in Nm/(rad/s)
+        'Kv' : 70.,         # aka. motor constant in RPM/V
+        'L' : 0.00521,      # aka. Coil inductance in H
+        'M' : 0.0,          # aka. Mutual inductance in H
+        'R' : 0.7,          # aka. Phase resistence in Ohm
+        'VDC' : 100.,       # aka. Supply voltage
+        'NbPoles' : 4.,     # NbPoles / 2 = Number of pole pairs (you count the permanent magnets on the rotor to get NbPoles)
+        'dvf' : .7,         # aka. freewheeling diode forward voltage
+        },
+    2 : { #psim
+        'Inertia' : 0.000007,            # aka. 'J' in kg/(m^2)
+        'Damping' : 0.000007/0.006,      # aka. 'B' in Nm/(rad/s), Inertia/tau_shaft
+        'Kv' : 1./32.3*1000,             # aka. motor constant in RPM/V
+        'L' : 0.00207,                   # aka. Coil inductance in H
+        'M' : -0.00069,                  # aka. Mutual inductance in H
+        'R' : 11.9,                      # aka. Phase resistence in Ohm
+        'VDC' : 100.,                    # aka. Supply voltage
+        'NbPoles' : 4.,                  #
+        'dvf' : .0,                      # aka. freewheeling diode forward voltage
+        },
+    3 : { #modified psim
+        'Inertia' : 0.000059,            # aka. 'J' in kg/(m^2)
+        'Damping' : 0.000059/0.006,      # aka. 'B' in Nm/(rad/s), Inertia/tau_shaft
+        'Kv' : 1./32.3*1000,             # aka. motor constant in RPM/V
+        'L' : 0.00207,                   # aka. Coil inductance in H
+        'M' : -0.00069,                  # aka. Mutual inductance in H
+        'R' : 11.9,                      # aka. Phase resistence in Ohm
+        'VDC' : 300.,                    # aka. Supply voltage
+        'NbPoles' : 4.,                  #
+        'dvf' : .0,                      # aka. freewheeling diode forward voltage
+        },
+    }
+
+#
+# Motor parameters
+#
+# Holds one parameter set and the constants derived from it, which are
+# computed once here instead of in every model call. The parameters can also
+# be arrays, one value per member of an ensemble. Parameter objects are not
+# meant to be modified, use replace to get a variant.
+#
+class MotorParams(object):
+
+    names = ['Inertia', 'Damping', 'Kv', 'L', 'M', 'R', 'VDC', 'NbPoles', 'dvf']
+
+    def __init__(self, **values):
+        missing = [name for name in self.names if name not in values]
+        unknown = [name for name in values if name not in self.names]
+        if missing or unknown:
+            raise TypeError("missing motor parameters {} unknown {}".format(missing, unknown))
+        for name in self.names:
+            setattr(self, name, values[name])
+
+        self.ke = mu.vpradps_of_rpmpv(self.Kv) # aka. backemf constant in V/rad/s
+        self.pole_pairs = self.NbPoles / 2.
+        self.inv_L_M = 1. / (self.L - self.M)
+        self.inv_Inertia = 1. / self.Inertia
+        self.half_VDC = self.VDC / 2.
+
+    @classmethod
+    def from_pset(cls, pset):
+        if pset not in psets:
+            raise ValueError("Unknown pset {}".format(pset))
+        return cls(**psets[pset])
+
+    #
+    # Load a parameter file
+    #
+    # One 'name = value' per line, '#' starts a comment. Instead of Damping a
+    # shaft time constant tau_shaft can be given, Damping = Inertia/tau_shaft.
+    @classmethod
+    def load(cls, filename):
+        values = {}
+        for line in open(filename):
+            line = line.split('#')[0].strip()
+            if line:
+                name, value = line.split('=')
+                values[name.strip()] = float(value)
+        if 'tau_shaft' in values:
+            values['Damping'] = values['Inertia'] / values.pop('tau_shaft')
+        return cls(**values)
+
+    def save(self, filename):
+        f = open(filename, 'w')
+        for name in self.names:
+            f.write("{} = {!r}\n".format(name, getattr(self, name)))
+        f.close()
+
+    def values(self):
+        return dict((name, getattr(self, name)) for name in self.names)
+
+    def replace(self, **values):
+        new_values = self.values()
+        new_values.update(values)
+        return MotorParams(**new_values)
 
 # Components of the state vector
 sv_theta  = 0      # angle of the rotor
@@ -127,12 +190,17 @@ dv_size = 7
 #
 # Used to calculate the phase backemf aka. 'e'
 #
-def backemf(X,thetae_offset):
-    phase_thetae = mu.norm_angle((X[sv_theta] * (NbPoles / 2.)) + thetae_offset)
+def backemf(X, thetae_offset, P):
+    phase_thetae = mu.norm_angle((X[sv_theta] * P.pole_pairs) + thetae_offset)
 
-    bemf_constant = mu.vpradps_of_rpmpv(Kv) # aka. ke in V/rad/s
-    max_bemf = bemf_constant * X[sv_omega]
+    max_bemf = P.ke * X[sv_omega]
 
+    return backemf_shape(phase_thetae, max_bemf)
+
+#
+# Trapezoidal backemf at the phase electrical angle phase_thetae
+#
+def backemf_shape(phase_thetae, max_bemf):
     bemf = 0.
     if 0. <= phase_thetae <= (math.pi * (1./6.)):
         bemf = (max_bemf / (math.pi * (1./6.))) * phase_thetae
@@ -149,14 +217,44 @@ def backemf(X,thetae_offset):
 
     return bemf
 
+#
+# Slope of the trapezoidal backemf shape (backemf_shape with max_bemf 1) at
+# the phase electrical angle phase_thetae
+#
+def backemf_shape_slope(phase_thetae):
+    if 0. <= phase_thetae <= (math.pi * (1./6.)):
+        return 1. / (math.pi/6.)
+    elif (math.pi/6.) < phase_thetae <= (math.pi * (5./6.)):
+        return 0.
+    elif (math.pi * (5./6.)) < phase_thetae <= (math.pi * (7./6.)):
+        return -1. / (math.pi/6.)
+    elif (math.pi * (7./6.)) < phase_thetae <= (math.pi * (11./6.)):
+        return 0.
+    return 1. / (math.pi/6.)
+
+#
+# Backemfs of the three phases at the rotor angle theta and speed omega
+#
+# Returns a list [eu, ev, ew], out when given
+def phase_backemfs(theta, omega, P, out=None):
+    thetae = theta * P.pole_pairs
+    max_bemf = P.ke * omega
+    if out is None:
+        out = [0., 0., 0.]
+    out[0] = backemf_shape(mu.norm_angle(thetae + 0.), max_bemf)
+    out[1] = backemf_shape(mu.norm_angle(thetae + math.pi * (2./3.)), max_bemf)
+    out[2] = backemf_shape(mu.norm_angle(thetae + math.pi * (4./3.)), max_bemf)
+    return out
+
 #
 # Calculate phase voltages
 # Returns a vector of phase voltages in reference to the star point
-def voltages(X, U):
+def voltages(X, U, P):
 
-    eu = backemf(X, 0.)
-    ev = backemf(X, math.pi * (2./3.))
-    ew = backemf(X, math.pi * (4./3.))
+    eu = backemf(X, 0., P)
+    ev = backemf(X, math.pi * (2./3.), P)
+    ew = backemf(X, math.pi * (4./3.), P)
+    half_VDC = P.half_VDC
 
     # Check which phases are excited
     pux = (U[iv_hu] == 1) or \
@@ -175,19 +273,19 @@ def voltages(X, U):
 
     if pux and pvx and pwx:
         if (U[iv_hu] == 1):
-            vu = VDC/2.
+            vu = half_VDC
         else:
-            vu = -VDC/2.
+            vu = -half_VDC
 
         if (U[iv_hv] == 1):
-            vv = VDC/2.
+            vv = half_VDC
         else:
-            vv = -VDC/2.
+            vv = -half_VDC
 
         if (U[iv_hw] == 1):
-            vw = VDC/2.
+            vw = half_VDC
         else:
-            vw = -VDC/2.
+            vw = -half_VDC
 
         vm = (vu + vv + vw - eu - ev - ew) / 3.
 
@@ -195,14 +293,14 @@ def voltages(X, U):
 
         # calculate excited phase voltages
         if (U[iv_hu] == 1):
-            vu = VDC/2.
+            vu = half_VDC
         else:
-            vu = -VDC/2.
+            vu = -half_VDC
 
         if (U[iv_hv] == 1):
-            vv = VDC/2.
+            vv = half_VDC
         else:
-            vv = -VDC/2.
+            vv = -half_VDC
 
         # calculate star voltage
         vm = (vu + vv - eu - ev) / 2.
@@ -220,14 +318,14 @@ def voltages(X, U):
 
     elif pux and pwx:
         if (U[iv_hu] == 1):
-            vu = VDC/2.
+            vu = half_VDC
         else:
-            vu = -VDC/2.
+            vu = -half_VDC
 
         if (U[iv_hw] == 1):
-            vw = VDC/2.
+            vw = half_VDC
         else:
-            vw = -VDC/2.
+            vw = -half_VDC
 
         vm = (vu + vw - eu - ew) / 2.
         vv = ev + vm
@@ -242,14 +340,14 @@ def voltages(X, U):
 
     elif pvx and pwx:
         if (U[iv_hv] == 1):
-            vv = VDC/2.
+            vv = half_VDC
         else:
-            vv = -VDC/2.
+            vv = -half_VDC
 
         if (U[iv_hw] == 1):
-            vw = VDC/2.
+            vw = half_VDC
         else:
-            vw = -VDC/2.
+            vw = -half_VDC
 
         vm = (vv + vw - ev - ew) / 2.
         vu = eu + vm
@@ -264,9 +362,9 @@ def voltages(X, U):
 
     elif pux:
         if (U[iv_hu] == 1):
-            vu = VDC/2
+            vu = half_VDC
         else:
-            vu = -VDC/2.
+            vu = -half_VDC
 
         vm = (vu - eu)
         vv = ev + vm
@@ -276,18 +374,18 @@ def voltages(X, U):
 
     elif pvx:
         if (U[iv_hv] == 1):
-            vv = VDC/2
+            vv = half_VDC
         else:
-            vv = -VDC/2.
+            vv = -half_VDC
 
         vm = (vv - ev)
         vu = eu + vm
         vw = ew + vm
     elif pwx:
         if (U[iv_hw] == 1):
-            vw = VDC/2
+            vw = half_VDC
         else:
-            vw = -VDC/2.
+            vw = -half_VDC
 
         vm = (vw - ew)
         vu = eu + vm
@@ -353,48 +451,133 @@ def voltages(X, U):
 
     return V
 
+#
+# Mechanical torque on the rotor for a given electromagnetic torque
+#
+# Takes the damping, load torque and dry friction into account
+def mtorque_of_etorque(etorque, omega, W, P):
+    mtorque = ((etorque * P.pole_pairs) - (P.Damping * omega) - W[pv_torque])
+
+    if ((mtorque > 0) and (mtorque <= W[pv_friction])):
+        mtorque = 0
+    elif (mtorque >= W[pv_friction]):
+        mtorque = mtorque - W[pv_friction]
+    elif ((mtorque < 0) and (mtorque >= (-W[pv_friction]))):
+	mtorque = 0
+    elif (mtorque <= (-W[pv_friction])):
+	mtorque = mtorque + W[pv_friction]
+
+    return mtorque
+
+# Low and high side switches of each phase
+phase_switches = ((ph_U, iv_lu, iv_hu), (ph_V, iv_lv, iv_hv), (ph_W, iv_lw, iv_hw))
+
+# Backemf gains already computed, indexed by the switch states
+backemf_gain_cache = {}
+
+#
+# Gain of the backemfs on the voltage driving the currents
+#
+# The terminal and star voltages being affine in the backemfs for a given
+# switch vector U, returns G such that V - e - vm = G e + g. The floating
+# phases follow their backemf, their rows are 0.
+def backemf_gain(U):
+    key = tuple(U[k] == 1 for k in range(iv_size))
+    if key not in backemf_gain_cache:
+        excited = [ph for ph, lo, hi in phase_switches if U[hi] == 1 or U[lo] == 1]
+        G = np.zeros((3, 3))
+        if excited:
+            for ph in excited:
+                G[ph, excited] = 1. / len(excited)
+                G[ph, ph] -= 1.
+        else: # the star follows the U backemf and U is held at 0
+            G[:, ph_U] = [-2., -1., -1.]
+        G.flags.writeable = False
+        backemf_gain_cache[key] = G
+    return backemf_gain_cache[key]
+
+# Non zero entries of the Jacobian of dyn
+jacobian_sparsity = np.array([[0, 1, 0, 0, 0],
+                              [1, 1, 1, 1, 1],
+                              [1, 1, 1, 0, 0],
+                              [1, 1, 0, 1, 0],
+                              [1, 1, 0, 0, 1]])
+
+#
+# Jacobian of the dynamic model
+#
+# X state, t time, U input, W perturbation
+#
+# Returns the matrix (sv_size, sv_size) of the derivatives of dyn with
+# respect to the state, the backemf being differentiated piecewise on its
+# trapezoid. Same arguments as dyn, so that it can be given as the Dfun of
+# odeint.
+def jacobian(X, t, U, W, P):
+    pole_pairs = P.pole_pairs
+    thetae = X[sv_theta] * pole_pairs
+    omega = X[sv_omega]
+    I = X[sv_iu:sv_iw+1]
+    shape = np.zeros(3)
+    slope = np.zeros(3)
+    for ph, offset in ((ph_U, 0.), (ph_V, math.pi * (2./3.)), (ph_W, math.pi * (4./3.))):
+        phase_thetae = mu.norm_angle(thetae + offset)
+        shape[ph] = backemf_shape(phase_thetae, 1.)
+        slope[ph] = backemf_shape_slope(phase_thetae)
+
+    # derivatives of the backemfs
+    dE_dtheta = P.ke * omega * pole_pairs * slope
+    dE_domega = P.ke * shape
+
+    Jac = np.zeros((sv_size, sv_size))
+    Jac[sv_theta, sv_omega] = 1.
+
+    # the torque is ke sum(shape i), it only moves the rotor out of the dry
+    # friction band
+    etorque = P.ke * np.dot(shape, I)
+    mtorque = etorque * pole_pairs - P.Damping * omega - W[pv_torque]
+    if abs(mtorque) > W[pv_friction]:
+        Jac[sv_omega, sv_theta] = P.ke * pole_pairs * np.dot(slope, I) * pole_pairs * P.inv_Inertia
+        Jac[sv_omega, sv_omega] = -P.Damping * P.inv_Inertia
+        Jac[sv_omega, sv_iu:sv_iw+1] = dE_domega * pole_pairs * P.inv_Inertia
+
+    G = backemf_gain(U)
+    Jac[sv_iu:sv_iw+1, sv_theta] = np.dot(G, dE_dtheta) * P.inv_L_M
+    Jac[sv_iu:sv_iw+1, sv_omega] = np.dot(G, dE_domega) * P.inv_L_M
+    Jac[sv_iu:sv_iw+1, sv_iu:sv_iw+1] = -P.R * P.inv_L_M * np.eye(3)
+
+    return Jac
+
 #
 # Dynamic model
 #
 # X state, t time, U input, W perturbation
 #
-def dyn(X, t, U, W):
-    Xd, Xdebug = dyn_debug(X, t, U, W)
+def dyn(X, t, U, W, P):
+    Xd, Xdebug = dyn_debug(X, t, U, W, P)
 
     return Xd
 
 # Dynamic model with debug vector
-def dyn_debug(X, t, U, W):
+def dyn_debug(X, t, U, W, P):
 
-    eu = backemf(X, 0.)
-    ev = backemf(X, math.pi * (2./3.))
-    ew = backemf(X, math.pi * (4./3.))
+    eu = backemf(X, 0., P)
+    ev = backemf(X, math.pi * (2./3.), P)
+    ew = backemf(X, math.pi * (4./3.), P)
 
     # Electromagnetic torque
     etorque = (eu * X[sv_iu] + ev * X[sv_iv] + ew * X[sv_iw])/X[sv_omega]
 
     # Mechanical torque
-    mtorque = ((etorque * (NbPoles / 2)) - (Damping * X[sv_omega]) - W[pv_torque])
-
-    if ((mtorque > 0) and (mtorque <= W[pv_friction])):
-        mtorque = 0
-    elif (mtorque >= W[pv_friction]):
-        mtorque = mtorque - W[pv_friction]
-    elif ((mtorque < 0) and (mtorque >= (-W[pv_friction]))):
-	mtorque = 0
-    elif (mtorque <= (-W[pv_friction])):
-	mtorque = mtorque + W[pv_friction]
+    mtorque = mtorque_of_etorque(etorque, X[sv_omega], W, P)
 
     # Acceleration of the rotor
-    omega_dot = mtorque / Inertia
+    omega_dot = mtorque * P.inv_Inertia
 
-    V = voltages(X, U)
+    V = voltages(X, U, P)
 
-    pdt = VDC/2 + dvf
-
-    iu_dot = (V[ph_U] - (R * X[sv_iu]) - eu - V[ph_star]) / (L - M)
-    iv_dot = (V[ph_V] - (R * X[sv_iv]) - ev - V[ph_star]) / (L - M)
-    iw_dot = (V[ph_W] - (R * X[sv_iw]) - ew - V[ph_star]) / (L - M)
+    iu_dot = (V[ph_U] - (P.R * X[sv_iu]) - eu - V[ph_star]) * P.inv_L_M
+    iv_dot = (V[ph_V] - (P.R * X[sv_iv]) - ev - V[ph_star]) * P.inv_L_M
+    iw_dot = (V[ph_W] - (P.R * X[sv_iw]) - ew - V[ph_star]) * P.inv_L_M
 
     Xd = [  X[sv_omega],
             omega_dot,
@@ -419,12 +602,331 @@ def dyn_debug(X, t, U, W):
 #
 #
 #
-def output(X, U):
+def output(X, U, P):
 
-    V = voltages(X, U)
+    V = voltages(X, U, P)
 
     Y = [X[sv_iu], X[sv_iv], X[sv_iw],
          V[ph_U], V[ph_V], V[ph_W],
          X[sv_theta], X[sv_omega]]
 
     return Y
+
+#
+# Fused model evaluation
+#
+# Evaluates the backemfs, the phase and star voltages and the derivatives of
+# one state in a single pass and keeps them in buffers, so that the output
+# and debug vectors of the last evaluated state are copied from there instead
+# of being computed again. The evaluation is done in steps: set_state
+# computes the backemfs, set_command the voltages for a command vector and
+# derivatives the state derivative. The buffers are allocated once and
+# overwritten by every evaluation.
+#
+class Model(object):
+
+    def __init__(self, P):
+        self.P = P
+        self.x = [0.] * sv_size          # state last evaluated
+        self.E = [0., 0., 0.]            # backemfs
+        self.V = [0., 0., 0., 0.]        # phase and star voltages
+        self.V_off = [0., 0., 0., 0.]    # voltages of the off command when averaging
+        self.excited = [False] * 3       # whether each phase is driven
+        self.Xd = np.zeros(sv_size)      # state derivative
+
+    # E, the backemfs of X, when already known
+    def set_state(self, X, E=None):
+        self.X = X
+        self.x = x = X.tolist() if isinstance(X, np.ndarray) else list(X)
+        if E is None:
+            phase_backemfs(x[sv_theta], x[sv_omega], self.P, self.E)
+        else:
+            self.E[:] = E
+
+    # same as voltages, the floating phases follow their backemf
+    def set_command(self, U):
+        half_VDC = self.P.half_VDC
+        E = self.E
+        V = self.V
+        excited = self.excited
+        n_excited = 0
+        vm = 0.
+        for ph, lo, hi in phase_switches:
+            if U[hi] == 1:
+                V[ph] = half_VDC
+            elif U[lo] == 1:
+                V[ph] = -half_VDC
+            else:
+                excited[ph] = False
+                continue
+            excited[ph] = True
+            n_excited += 1
+            vm += V[ph]
+
+        if n_excited:
+            for ph in (ph_U, ph_V, ph_W):
+                if excited[ph]:
+                    vm -= E[ph]
+            vm /= n_excited
+            for ph in (ph_U, ph_V, ph_W):
+                if not excited[ph]:
+                    V[ph] = E[ph] + vm
+        else:
+            vm = E[ph_U]
+            V[ph_U] = 0.
+            V[ph_V] = E[ph_V]
+            V[ph_W] = E[ph_W]
+
+        V[ph_star] = vm
+
+    #
+    # PWM averaged voltages: U_on during the duty fraction of the PWM cycle
+    # and U_off during the rest
+    #
+    # The current derivatives being affine in the voltages, this gives the
+    # mean of the switching model derivatives over a PWM cycle.
+    def set_average_command(self, U_on, U_off, duty):
+        self.set_command(U_off)
+        V_off = self.V_off
+        V_off[:] = self.V
+        self.set_command(U_on)
+        V = self.V
+        for k in range(len(V)):
+            V[k] = duty * V[k] + (1. - duty) * V_off[k]
+
+    #
+    # Jacobian of dyn, for odeint Dfun and the jac of the implicit solve_ivp
+    # methods
+    #
+    def jacobian(self, X, t, U, W):
+        return jacobian(X, t, U, W, self.P)
+
+    #
+    # State derivative of the last state and command, written to out, the
+    # model buffer by default
+    #
+    def derivatives(self, W, out=None):
+        P = self.P
+        X = self.x
+        eu, ev, ew = self.E
+        V = self.V
+        vm = V[ph_star]
+        omega = X[sv_omega]
+
+        etorque = (eu * X[sv_iu] + ev * X[sv_iv] + ew * X[sv_iw])/omega
+        omega_dot = mtorque_of_etorque(etorque, omega, W, P) * P.inv_Inertia
+
+        if out is None:
+            out = self.Xd
+        out[:] = (omega,
+                  omega_dot,
+                  (V[ph_U] - (P.R * X[sv_iu]) - eu - vm) * P.inv_L_M,
+                  (V[ph_V] - (P.R * X[sv_iv]) - ev - vm) * P.inv_L_M,
+                  (V[ph_W] - (P.R * X[sv_iw]) - ew - vm) * P.inv_L_M)
+        return out
+
+    #
+    # Dynamic model, as dyn, returning the derivative in out, the model
+    # buffer by default
+    #
+    def dyn(self, X, t, U, W, out=None):
+        self.set_state(X)
+        self.set_command(U)
+        return self.derivatives(W, out)
+
+    #
+    # Copy the output vector of the last evaluation to Y
+    #
+    def output_into(self, Y):
+        x = self.x
+        V = self.V
+        Y[:] = (x[sv_iu], x[sv_iv], x[sv_iw],
+                V[ph_U], V[ph_V], V[ph_W],
+                x[sv_theta], x[sv_omega])
+
+    #
+    # Copy the debug vector of the last evaluation to Xdebug
+    #
+    def debug_into(self, Xdebug):
+        Xdebug[:3] = self.E
+        Xdebug[3:] = self.V
+
+#
+# Vectorized versions of the model functions
+#
+# They take arrays of states X (..., sv_size) and commands U (..., iv_size)
+# and evaluate all the samples (time steps or ensemble members) in one pass.
+#
+# The parameters of P can be scalars or arrays broadcasting against the
+# leading axes of X, one value per ensemble member.
+#
+
+# Trapezoidal backemf shape over one electrical revolution
+bemf_shape_thetae = np.array([0., math.pi * (1./6.), math.pi * (5./6.),
+                              math.pi * (7./6.), math.pi * (11./6.), 2. * math.pi])
+bemf_shape_value = np.array([0., 1., 1., -1., -1., 0.])
+
+# Slope of the trapezoidal backemf shape on each of its segments
+bemf_shape_slope = np.diff(bemf_shape_value) / np.diff(bemf_shape_thetae)
+
+# Electrical angle offsets of the U, V and W phases
+phase_thetae_offset = np.array([0., math.pi * (2./3.), math.pi * (4./3.)])
+
+#
+# Parameter value as a column, broadcasting against (..., 3) arrays
+#
+def param_col(value):
+    return np.asarray(value, dtype=float)[..., np.newaxis]
+
+#
+# Electrical angle of the three phases
+#
+def phase_thetae_vec(X, P):
+    thetae = X[..., sv_theta] * np.asarray(P.pole_pairs)
+    return mu.norm_angle_vec(thetae[..., np.newaxis] + phase_thetae_offset)
+
+#
+# Calculate the backemf of the three phases
+#
+# Returns an array (..., 3) of [eu, ev, ew]
+def backemf_vec(X, P):
+    X = np.asarray(X, dtype=float)
+    phase_thetae = phase_thetae_vec(X, P)
+
+    max_bemf = np.asarray(P.ke) * X[..., sv_omega]
+
+    shape = np.interp(phase_thetae, bemf_shape_thetae, bemf_shape_value)
+
+    return shape * max_bemf[..., np.newaxis]
+
+#
+# Derivative of the backemf of the three phases with respect to the rotor
+# (mechanical) angle, omega being held constant
+#
+# Returns an array (..., 3) of [deu, dev, dew]
+def backemf_slope_vec(X, P):
+    X = np.asarray(X, dtype=float)
+    phase_thetae = phase_thetae_vec(X, P)
+
+    max_bemf = np.asarray(P.ke) * X[..., sv_omega] * np.asarray(P.pole_pairs)
+
+    segment = np.searchsorted(bemf_shape_thetae, phase_thetae, side='right') - 1
+    segment = np.clip(segment, 0, bemf_shape_slope.size - 1)
+
+    return bemf_shape_slope[segment] * max_bemf[..., np.newaxis]
+
+#
+# Calculate phase voltages
+#
+# Returns an array (..., ph_size) of [vu, vv, vw, vm], vm being the star voltage
+def voltages_vec(X, U, P, E=None):
+    U = np.asarray(U)
+    if E is None:
+        E = backemf_vec(X, P)
+
+    high = U[..., [iv_hu, iv_hv, iv_hw]] == 1
+    excited = high | (U[..., [iv_lu, iv_lv, iv_lw]] == 1)
+    high, excited, E = np.broadcast_arrays(high, excited, E)
+    nb_excited = excited.sum(axis=-1)
+
+    # imposed voltage on the excited phases
+    half_vdc = param_col(P.half_VDC)
+    vi = np.where(high, half_vdc, -half_vdc)
+
+    # star voltage, the floating phases follow their backemf
+    vm = np.where(excited, vi - E, 0.).sum(axis=-1) / np.maximum(nb_excited, 1)
+    vm = np.where(nb_excited > 0, vm, E[..., ph_U])
+
+    V = np.empty(E.shape[:-1] + (ph_size,))
+    V[..., :ph_star] = np.where(excited, vi, E + vm[..., np.newaxis])
+    V[..., ph_star] = vm
+
+    # no phase excited at all
+    off = nb_excited == 0
+    V[off, ph_U] = 0.
+    V[off, ph_V] = E[off, ph_V]
+    V[off, ph_W] = E[off, ph_W]
+
+    return V
+
+#
+# Mechanical torque on the rotor for a given electromagnetic torque
+#
+def mtorque_of_etorque_vec(etorque, omega, W, P):
+    W = np.asarray(W, dtype=float)
+    friction = W[..., pv_friction]
+
+    mtorque = ((etorque * np.asarray(P.pole_pairs)) - (np.asarray(P.Damping) * omega)
+               - W[..., pv_torque])
+
+    return np.where(mtorque > friction, mtorque - friction,
+                    np.where(mtorque < -friction, mtorque + friction, 0.))
+
+#
+# Dynamic model
+#
+# Returns the state derivative (..., sv_size)
+def dyn_vec(X, U, W, P):
+    X = np.asarray(X, dtype=float)
+    E = backemf_vec(X, P)
+    V = voltages_vec(X, U, P, E)
+    I = X[..., sv_iu:sv_iw+1]
+
+    # Electromagnetic torque
+    etorque = (E * I).sum(axis=-1) / X[..., sv_omega]
+
+    mtorque = mtorque_of_etorque_vec(etorque, X[..., sv_omega], W, P)
+
+    Xd = np.empty(E.shape[:-1] + (sv_size,))
+    Xd[..., sv_theta] = X[..., sv_omega]
+    Xd[..., sv_omega] = mtorque * np.asarray(P.inv_Inertia)
+    Xd[..., sv_iu:sv_iw+1] = ((V[..., :ph_star] - (param_col(P.R) * I) - E
+                              - V[..., ph_star, np.newaxis]) * param_col(P.inv_L_M))
+
+    return Xd
+
+#
+# Debug vector
+#
+# Returns an array (..., dv_size), same content as the Xdebug of dyn_debug
+def debug_vec(X, U, P):
+    E = backemf_vec(X, P)
+    V = voltages_vec(X, U, P, E)
+
+    Xdebug = np.empty(E.shape[:-1] + (dv_size,))
+    Xdebug[..., dv_eu:dv_ew+1] = E
+    Xdebug[..., dv_ph_U:dv_ph_star+1] = V
+
+    return Xdebug
+
+#
+# Output vector
+#
+# Returns an array (..., ov_size), same content as output
+def output_vec(X, U, P):
+    X = np.asarray(X, dtype=float)
+    V = voltages_vec(X, U, P)
+    X = np.broadcast_to(X, V.shape[:-1] + (sv_size,))
+
+    Y = np.empty(V.shape[:-1] + (ov_size,))
+    Y[..., ov_iu] = X[..., sv_iu]
+    Y[..., ov_iv] = X[..., sv_iv]
+    Y[..., ov_iw] = X[..., sv_iw]
+    Y[..., ov_vu] = V[..., ph_U]
+    Y[..., ov_vv] = V[..., ph_V]
+    Y[..., ov_vw] = V[..., ph_W]
+    Y[..., ov_theta] = X[..., sv_theta]
+    Y[..., ov_omega] = X[..., sv_omega]
+
+    return Y
+
+#
+# PWM average of a vectorized model function (output_vec, debug_vec)
+#
+# U_on is applied during the duty fraction of the PWM cycle and U_off during
+# the rest, duty can be one value per sample. The functions being affine in
+# the voltages, this is the function of the averaged voltages.
+#
+def average_vec(fn, X, U_on, U_off, duty, P):
+    duty = np.asarray(duty, dtype=float)[..., np.newaxis]
+    return duty * fn(X, U_on, P) + (1. - duty) * fn(X, U_off, P)
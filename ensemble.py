@@ -0,0 +1,139 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Ensemble simulation
+#
+# N variants of the same scenario are advanced in lockstep. The states are
+# stored in a (N, sv_size) matrix and every simulation step runs the
+# controller, the model and the solver once for all of them.
+#
+
+import numpy as np
+from scipy import integrate
+
+import misc_utils as mu
+import dyn_model  as dm
+import control    as ctl
+import traj_store as ts
+import profiling  as pf
+
+#
+# Motor parameters of N ensemble members
+#
+# Every parameter becomes an array of shape (N,), the ones not given in
+# values are taken from the base parameters.
+def params(base, N, **values):
+    members = base.values()
+    members.update(values)
+    for name in members:
+        members[name] = np.asarray(members[name], dtype=float) * np.ones(N)
+    return dm.MotorParams(**members)
+
+#
+# Number of members of the ensemble parameters P
+#
+def size(P):
+    return np.size(P.Inertia)
+
+#
+# Flattened dynamic model, as odeint wants it
+#
+def dyn_flat(x, t, U, W, P):
+    X = x.reshape(-1, dm.sv_size)
+    return dm.dyn_vec(X, U, W, P).ravel()
+
+#
+# Trajectory channels of an ensemble of N members, a row holding the vectors
+# of all the members one after the other
+#
+def channels(N):
+    return [('time', None),
+            ('X', N * dm.sv_size),
+            ('Y', N * dm.ov_size),
+            ('U', N * dm.iv_size),
+            ('Xdebug', N * dm.dv_size)]
+
+#
+# Simulate the ensemble from X0 over [0, t_end[ with the step size dt
+#
+# P are ensemble parameters (see params), X0 is a (N, sv_size) matrix or a
+# single state shared by all the members, W a (N, pv_size) matrix or a single
+# perturbation vector and duty the PWM duty cycles (N,). As in
+# sim_1.run_fixed_step, the output of a sample is the one the controller sees,
+# with the input of the previous sample, and the debug vector is the one of
+# the previous sample.
+#
+# The samples are handed over to writer, which must have the channels of the
+# ensemble (see channels), in chunks of chunk_size rows. When no writer is
+# given the time (T,), state (T, N, sv_size), output (T, N, ov_size), input
+# (T, N, iv_size) and debug (T, N, dv_size) vectors are returned. The stages
+# are timed with profile, if given.
+#
+def simulate(X0, t_end, W, dt, P, Sp=0, duty=None, writer=None, chunk_size=4096, profile=None):
+    N = size(P)
+    if writer is None:
+        memory = ts.MemoryWriter(channels(N))
+        simulate(X0, t_end, W, dt, P, Sp, duty, memory, chunk_size, profile)
+        time, X, Y, U, Xdebug = memory.arrays()
+        return (time, X.reshape(-1, N, dm.sv_size), Y.reshape(-1, N, dm.ov_size),
+                U.reshape(-1, N, dm.iv_size), Xdebug.reshape(-1, N, dm.dv_size))
+
+    prof = profile or pf.null_profile
+    W = np.asarray(W, dtype=float) * np.ones((N, dm.pv_size))
+    Xc = np.asarray(X0, dtype=float) * np.ones((N, dm.sv_size))
+    Yim1 = np.zeros((N, dm.ov_size))            # output of the last step
+    Uim1 = np.zeros((N, dm.iv_size))            # input of the last step
+    Dim1 = np.zeros((N, dm.dv_size))            # debug data of the last step
+
+    steps = ts.nb_samples(t_end, dt)
+    for k0 in range(0, steps, chunk_size):
+        time = np.arange(k0, min(k0 + chunk_size, steps)) * dt
+        X = np.zeros((time.size, N, dm.sv_size))
+        Y = np.zeros((time.size, N, dm.ov_size))
+        U = np.zeros((time.size, N, dm.iv_size))
+        Xdebug = np.zeros((time.size, N, dm.dv_size))
+        for j in range(time.size):
+            X[j] = Xc
+            Xdebug[j] = Dim1
+            if k0 + j < steps - 1:
+                t = prof.clock()
+                Y[j] = dm.output_vec(Xc, Uim1, P)
+                t = prof.lap('output', t)
+                U[j] = ctl.run_vec(Sp, Y[j], time[j], P, duty)
+                t = prof.lap('control', t)
+                Dim1 = dm.debug_vec(Xc, U[j], P)
+                t = prof.lap('debug', t)
+                tmp = integrate.odeint(dyn_flat, Xc.ravel(), [time[j], time[j] + dt], args=(U[j], W, P))
+                Xc = tmp[1,:].reshape(N, dm.sv_size)
+                Xc[:, dm.sv_theta] = mu.norm_angle_vec(Xc[:, dm.sv_theta])
+                prof.lap('integrator', t)
+            else:
+                Y[j] = Yim1
+                U[j] = Uim1
+            Yim1 = Y[j]
+            Uim1 = U[j]
+
+        t = prof.clock()
+        writer.append(time=time, X=X.reshape(time.size, -1), Y=Y.reshape(time.size, -1),
+                      U=U.reshape(time.size, -1), Xdebug=Xdebug.reshape(time.size, -1))
+        prof.lap('writer', t)
+
+    writer.close()
+    prof.stop()
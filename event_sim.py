@@ -0,0 +1,289 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Event driven simulation engine
+#
+# The switch vector U only changes on PWM edges and when the rotor crosses
+# a commutation boundary. Instead of restarting the solver every simulation
+# step we integrate each interval of constant U in one go, locating the
+# commutation boundaries with the solver root finding, and only sample the
+# solution on the output grid.
+#
+# In the PWM averaged mode the switching intervals are replaced by the PWM
+# cycle average of the model (see dyn_model.Model.set_average_command), so
+# that U only changes on commutations and the solver steps are bounded by the
+# electrical time constants instead of the PWM carrier. The full switching
+# model can be kept inside a time window, e.g. to look at the current ripple
+# at a given point of a long speed profile.
+#
+
+import numpy as np
+import math
+from scipy import integrate
+
+import misc_utils as mu
+import dyn_model  as dm
+import control    as ctl
+import traj_store as ts
+import profiling  as pf
+
+# Commutation boundaries are at (2k+1) * pi/6 electrical, which also are
+# the breakpoints of the trapezoidal backemf
+sector_angle = math.pi / 3.
+sector_offset = math.pi / 6.
+
+# Electrical angle we place the rotor past a boundary once it was crossed,
+# so that the controller sees the new sector without ambiguity
+angle_eps = 1e-9
+
+# Two PWM edges closer than that (in cycles) are considered the same
+edge_eps = 1e-9
+
+# solve_ivp methods given the analytic Jacobian of the model
+implicit_methods = ['BDF', 'Radau', 'LSODA']
+
+#
+# Time of the first PWM edge strictly after t
+#
+def next_pwm_edge(t):
+    cycle_start = math.floor(t / ctl.PWM_cycle_time) * ctl.PWM_cycle_time
+    eps = edge_eps * ctl.PWM_cycle_time
+    for edge in [cycle_start + ctl.PWM_duty_time,
+                 cycle_start + ctl.PWM_cycle_time,
+                 cycle_start + ctl.PWM_cycle_time + ctl.PWM_duty_time]:
+        if edge > t + eps:
+            return edge
+
+#
+# Index of the commutation sector the electrical angle thetae is in
+#
+def sector_of_thetae(thetae):
+    return int(math.floor((thetae - sector_offset) / sector_angle))
+
+#
+# Build the solver events firing when the rotor leaves its current sector
+#
+# Returns the events and the electrical angle of the boundary each one
+# corresponds to
+def sector_events(X, P):
+    pole_pairs = P.pole_pairs
+    sector = sector_of_thetae(X[dm.sv_theta] * pole_pairs)
+    lower = sector_offset + sector * sector_angle
+    upper = lower + sector_angle
+
+    def cross_upper(t, x):
+        return x[dm.sv_theta] * pole_pairs - upper
+    cross_upper.terminal = True
+    cross_upper.direction = 1.
+
+    def cross_lower(t, x):
+        return x[dm.sv_theta] * pole_pairs - lower
+    cross_lower.terminal = True
+    cross_lower.direction = -1.
+
+    return [cross_upper, cross_lower], [upper, lower]
+
+#
+# Run the controller for the interval starting at t and ending at t_edge
+#
+# The controller is probed in the middle of the interval so that being
+# exactly on a PWM edge does not matter.
+def command(Sp, X, U, t, t_edge, P):
+    Y = dm.output(X, U, P)
+    return ctl.run(Sp, Y, 0.5 * (t + t_edge), P)
+
+#
+# Run the PWM averaged controller, see control.run_average
+#
+def average_command(Sp, X, U, t, P):
+    Y = dm.output(X, U, P)
+    return ctl.run_average(Sp, Y, t, P)
+
+#
+# Jacobian option of solve_ivp for an interval with the command U, or U and
+# U_off averaged with duty
+#
+# Only the implicit methods use it, the others would warn about it.
+def jacobian_option(method, model, W, U, U_off, duty):
+    if method not in implicit_methods:
+        return {}
+    if duty == 1.:
+        return {'jac' : lambda t, x: model.jacobian(x, t, U, W)}
+    return {'jac' : lambda t, x: (duty * model.jacobian(x, t, U, W) +
+                                  (1. - duty) * model.jacobian(x, t, U_off, W))}
+
+#
+# Whether t is inside the switching window (start, end), None being empty
+#
+def in_window(t, window):
+    return window is not None and window[0] <= t < window[1]
+
+#
+# Simulate from X0 over [0, t_end[ and record the result every dt_out
+#
+# The samples are handed over to writer in chunks of chunk_size rows. When no
+# writer is given the time, state, output, input and debug vectors on the
+# output grid are returned. The stages are timed with profile, if given,
+# which also gets the solver statistics.
+#
+# Every checkpoint_every of simulated time, on_checkpoint is called with the
+# state of the loop, a dictionary (t, X, U, n_out) from which a run can be
+# carried on by passing it as start (see checkpoint). Everything sampled
+# before it has been handed over to writer by then. checkpoint_every, a
+# positive period, is required with on_checkpoint.
+#
+# With average the PWM averaged model is used, except inside
+# switching_window, (start, end) in s. The samples of the averaged intervals
+# hold the averaged outputs and the duty cycle of every switch in U.
+#
+def simulate(X0, t_end, W, dt_out, P, Sp=0, method='RK45', rtol=1e-6, atol=1e-9,
+             writer=None, chunk_size=4096, profile=None,
+             start=None, on_checkpoint=None, checkpoint_every=None,
+             average=False, switching_window=None):
+    if on_checkpoint is not None and not (checkpoint_every > 0):
+        raise ValueError("on_checkpoint needs a positive checkpoint_every, got {!r}".format(checkpoint_every))
+    if writer is None:
+        memory = ts.MemoryWriter()
+        simulate(X0, t_end, W, dt_out, P, Sp, method, rtol, atol, memory, chunk_size, profile,
+                 start, on_checkpoint, checkpoint_every, average, switching_window)
+        return memory.arrays()
+
+    prof = profile or pf.null_profile
+
+    def emit(time, X, U, U_off, duty):
+        X[:, dm.sv_theta] = mu.norm_angle_vec(X[:, dm.sv_theta])
+        if average:
+            writer.append(time=time, X=X, Y=dm.average_vec(dm.output_vec, X, U, U_off, duty, P),
+                          U=duty[:, np.newaxis] * U + (1. - duty[:, np.newaxis]) * U_off,
+                          Xdebug=dm.average_vec(dm.debug_vec, X, U, U_off, duty, P))
+        else:
+            writer.append(time=time, X=X, Y=dm.output_vec(X, U, P), U=U,
+                          Xdebug=dm.debug_vec(X, U, P))
+    samples = ts.ChunkBuffer([('time', None), ('X', dm.sv_size), ('U', dm.iv_size),
+                              ('U_off', dm.iv_size), ('duty', None)],
+                             chunk_size, emit)
+
+    n = ts.nb_samples(t_end, dt_out)
+    t_last = (n - 1) * dt_out
+
+    model = dm.Model(P)
+    if start is None:
+        t = 0.
+        Xc = np.array(X0, dtype=float)
+        Uc = np.zeros(dm.iv_size)
+        n_out = 0
+    else:
+        t = start['t']
+        Xc = np.array(start['X'], dtype=float)
+        Uc = np.array(start['U'], dtype=float)
+        n_out = start['n_out']
+    if on_checkpoint is not None:
+        t_checkpoint = (math.floor(t / checkpoint_every) + 1) * checkpoint_every
+
+    while n_out < n:
+        if on_checkpoint is not None and t >= t_checkpoint:
+            samples.flush()
+            on_checkpoint({'t' : t, 'X' : Xc.copy(), 'U' : Uc.copy(), 'n_out' : n_out})
+            t_checkpoint = (math.floor(t / checkpoint_every) + 1) * checkpoint_every
+
+        t_prof = prof.clock()
+        if average and not in_window(t, switching_window):
+            # averaged up to the next commutation or the switching window
+            Uc, U_off, duty = average_command(Sp, Xc, Uc, t, P)
+            t_next = t_last
+            if switching_window is not None and t < switching_window[0]:
+                t_next = min(t_next, switching_window[0])
+
+            def fun(t, x, Uc=Uc, U_off=U_off, duty=duty):
+                model.set_state(x)
+                model.set_average_command(Uc, U_off, duty)
+                return model.derivatives(W, np.empty(dm.sv_size))
+        else:
+            t_edge = next_pwm_edge(t)
+            Uc = command(Sp, Xc, Uc, t, t_edge, P)
+            U_off, duty = Uc, 1.
+            t_next = min(t_edge, t_last)
+            if average:
+                t_next = min(t_next, switching_window[1])
+
+            # solve_ivp keeps the derivatives it is given, each evaluation
+            # gets its own array instead of the model buffer
+            def fun(t, x, Uc=Uc):
+                return model.dyn(x, t, Uc, W, np.empty(dm.sv_size))
+        options = jacobian_option(method, model, W, Uc, U_off, duty)
+        t_prof = prof.lap('control', t_prof)
+        events, boundaries = sector_events(Xc, P)
+
+        if t_next > t:
+            sol = integrate.solve_ivp(fun, (t, t_next), Xc, method=method,
+                                      events=events, dense_output=True,
+                                      rtol=rtol, atol=atol, **options)
+            if sol.status < 0:
+                raise RuntimeError("integration failed at t={}: {}".format(t, sol.message))
+            sol_at = sol.sol
+            prof.count('nfev', sol.nfev)
+            prof.count('njev', sol.njev)
+            prof.count('steps', sol.t.size - 1)
+            prof.count('segments')
+        else: # only the last sample is left
+            sol = None
+            sol_at = lambda time: np.tile(Xc, (len(time), 1)).T
+
+        t_prof = prof.lap('solver', t_prof)
+
+        t_stop = t_next
+        if sol is not None and sol.status == 1: # crossed a commutation boundary
+            prof.count('events')
+            for event_t, boundary, direction in zip(sol.t_events, boundaries, [1., -1.]):
+                if event_t.size > 0:
+                    t_stop = event_t[0]
+                    Xn = sol.sol(t_stop)
+                    Xn[dm.sv_theta] = (boundary + direction * angle_eps) / P.pole_pairs
+                    break
+        elif sol is not None:
+            Xn = sol.y[:,-1]
+
+        # sample the output grid from t up to where we stopped, the samples
+        # at t_stop belong to the next interval
+        if t_stop >= t_last:
+            n_grid = n
+        else:
+            n_grid = ts.grid_index(t_stop, dt_out)
+        if n_grid > n_out:
+            time = np.arange(n_out, n_grid) * dt_out
+            t_prof = prof.clock()
+            X = sol_at(time).T
+            t_prof = prof.lap('sampling', t_prof)
+            samples.push(time=time, X=X, U=np.tile(Uc, (n_grid - n_out, 1)),
+                         U_off=np.tile(U_off, (n_grid - n_out, 1)),
+                         duty=np.repeat(duty, n_grid - n_out))
+            prof.lap('writer', t_prof)
+            n_out = n_grid
+
+        if sol is not None:
+            Xc = Xn
+            Xc[dm.sv_theta] = mu.norm_angle(Xc[dm.sv_theta]) # normalize the angle in the state
+        t = t_stop
+
+    t_prof = prof.clock()
+    samples.flush()
+    writer.close()
+    prof.lap('writer', t_prof)
+    prof.stop()
@@ -0,0 +1,200 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Fixed step simulation solving the phase currents exactly
+#
+# For a given switch vector the terminal and star voltages are affine in the
+# backemfs, so the current equations of dyn_model.dyn_debug are linear:
+#
+#   i' = -R/(L-M) i + (G_U e + g_U)/(L-M)
+#
+# Holding omega constant over a step, e moves linearly with time. Augmenting
+# the currents with e, its rate and a constant gives a linear system whose
+# matrix exponential propagates the currents exactly over the step. One
+# propagator is computed per switch state and step size and then cached.
+# The mechanical states are advanced with the torque averaged over the step.
+#
+
+import numpy as np
+from scipy import linalg
+
+import misc_utils as mu
+import dyn_model  as dm
+import control    as ctl
+import traj_store as ts
+import profiling  as pf
+
+# Components of the augmented state
+av_i = 0           # phase currents (3)
+av_e = 3           # phase backemfs (3)
+av_edot = 6        # backemf rates (3)
+av_one = 9         # constant
+av_size = 10
+
+# Number of switch states
+nb_switch_states = 2 ** dm.iv_size
+
+# Propagators already computed, indexed by the parameters they depend on
+# and the step size
+propagator_cache = {}
+
+#
+# Index of the switch vector U in [0, nb_switch_states[
+#
+def switch_state_index(U):
+    index = 0
+    for k in range(dm.iv_size):
+        if U[k] == 1:
+            index += 1 << k
+    return index
+
+#
+# Switch vector of a given switch state index
+#
+def switch_state_of_index(index):
+    return np.array([(index >> k) & 1 for k in range(dm.iv_size)], dtype=float)
+
+#
+# Affine map from backemfs to the voltage driving the currents
+#
+# Returns G, g such that V - e - vm = G e + g for the switch vector U
+def voltage_map(U, P):
+    g = dm.voltages_vec(np.zeros(dm.sv_size), U, P, np.zeros(3))
+    g = g[:dm.ph_star] - g[dm.ph_star]
+    G = np.zeros((3, 3))
+    for k in range(3):
+        E = np.zeros(3)
+        E[k] = 1.
+        V = dm.voltages_vec(np.zeros(dm.sv_size), U, P, E)
+        G[:,k] = V[:dm.ph_star] - E - V[dm.ph_star] - g
+    return G, g
+
+#
+# Matrix of the augmented linear system for the switch vector U
+#
+def augmented_matrix(U, P):
+    G, g = voltage_map(U, P)
+    A = np.zeros((av_size, av_size))
+    A[av_i:av_i+3, av_i:av_i+3] = -P.R * P.inv_L_M * np.eye(3)
+    A[av_i:av_i+3, av_e:av_e+3] = G * P.inv_L_M
+    A[av_i:av_i+3, av_one] = g * P.inv_L_M
+    A[av_e:av_e+3, av_edot:av_edot+3] = np.eye(3)
+    return A
+
+#
+# Current propagators of all the switch states for the step size h
+#
+# Returns an array (nb_switch_states, 3, av_size), only the rows giving the
+# currents are kept
+def propagators(h, P):
+    key = (P.R, P.inv_L_M, P.VDC, h)
+    if key not in propagator_cache:
+        Phi = np.zeros((nb_switch_states, 3, av_size))
+        for index in range(nb_switch_states):
+            A = augmented_matrix(switch_state_of_index(index), P)
+            Phi[index] = linalg.expm(A * h)[av_i:av_i+3,:]
+        propagator_cache[key] = Phi
+    return propagator_cache[key]
+
+#
+# Advance the state X by h with the switch vector U
+#
+def step(X, U, W, h, P):
+    Phi = propagators(h, P)[switch_state_index(U)]
+
+    E0 = dm.backemf_vec(X, P)
+    Edot = dm.backemf_slope_vec(X, P) * X[dm.sv_omega]
+
+    z = np.empty(av_size)
+    z[av_i:av_i+3] = X[dm.sv_iu:dm.sv_iw+1]
+    z[av_e:av_e+3] = E0
+    z[av_edot:av_edot+3] = Edot
+    z[av_one] = 1.
+    I1 = np.dot(Phi, z)
+
+    # Electromagnetic torque averaged over the step
+    E1 = E0 + Edot * h
+    etorque = 0.5 * (np.dot(E0, z[av_i:av_i+3]) + np.dot(E1, I1)) / X[dm.sv_omega]
+
+    omega_dot = dm.mtorque_of_etorque(etorque, X[dm.sv_omega], W, P) * P.inv_Inertia
+
+    X1 = np.empty(dm.sv_size)
+    X1[dm.sv_omega] = X[dm.sv_omega] + omega_dot * h
+    X1[dm.sv_theta] = mu.norm_angle(X[dm.sv_theta] + 0.5 * (X[dm.sv_omega] + X1[dm.sv_omega]) * h)
+    X1[dm.sv_iu:dm.sv_iw+1] = I1
+
+    return X1
+
+#
+# Simulate from X0 over [0, t_end[ with the step size h
+#
+# The samples are handed over to writer in chunks of chunk_size rows. When no
+# writer is given the time, state, output, input and debug vectors are
+# returned. The stages are timed with profile, if given.
+#
+def simulate(X0, t_end, W, h, P, Sp=0, writer=None, chunk_size=4096, profile=None):
+    if writer is None:
+        memory = ts.MemoryWriter()
+        simulate(X0, t_end, W, h, P, Sp, memory, chunk_size, profile)
+        return memory.arrays()
+
+    prof = profile or pf.null_profile
+    t = prof.clock()
+    cached = len(propagator_cache)
+    propagators(h, P)
+    prof.count('propagators', nb_switch_states * (len(propagator_cache) - cached))
+    prof.lap('propagators', t)
+
+    n = ts.nb_samples(t_end, h)
+    model = dm.Model(P)
+    Xc = np.array(X0, dtype=float)
+    Uc = np.zeros(dm.iv_size)
+    for k0 in range(0, n, chunk_size):
+        time = np.arange(k0, min(k0 + chunk_size, n)) * h
+        X = np.zeros((time.size, dm.sv_size))
+        Y = np.zeros((time.size, dm.ov_size))
+        U = np.zeros((time.size, dm.iv_size))
+        Xdebug = np.zeros((time.size, dm.dv_size))
+        for j in range(time.size):
+            t = prof.clock()
+            X[j,:] = Xc
+            model.set_state(Xc)
+            if k0 + j < n - 1:
+                model.set_command(Uc)
+                model.output_into(Y[j,:])
+                t = prof.lap('output', t)
+                Uc = ctl.run(Sp, Y[j,:], time[j], P)
+                t = prof.lap('control', t)
+            U[j,:] = Uc
+            model.set_command(Uc)
+            model.output_into(Y[j,:])
+            model.debug_into(Xdebug[j,:])
+            t = prof.lap('record', t)
+            if k0 + j < n - 1:
+                Xc = step(Xc, Uc, W, h, P)
+                prof.lap('step', t)
+                prof.count('steps')
+
+        t = prof.clock()
+        writer.append(time=time, X=X, Y=Y, U=U, Xdebug=Xdebug)
+        prof.lap('writer', t)
+
+    writer.close()
+    prof.stop()
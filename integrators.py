@@ -0,0 +1,389 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Integrator backends
+#
+# A backend advances the state over one step with the command held:
+#
+#   b = integrators.backend('rk4', P, W)
+#   X = b.step(X, t, U, h)
+#
+# X and U are flat float arrays laid out as in dyn_model (sv_, iv_ indices).
+# The fixed step loops (sim_1.run_fixed_step, simulator.Simulator) take the
+# name of their backend, so that speed or accuracy is picked per run:
+#
+#   odeint       scipy LSODA, restarted every step, with the analytic Jacobian
+#   solve_ivp    scipy solve_ivp, method given as an option
+#   expm         exact current propagators (see expm_sim)
+#   rk4, heun    fixed step Runge-Kutta kernels over flat float arrays,
+#                compiled with numba when it is installed
+#   rk4_python, heun_python
+#                the same kernels not compiled, when numba is installed
+#
+# The kernels only use floats, flat arrays and math so that numba can
+# compile them; the motor parameters and the perturbation are handed over to
+# them as a flat parameter block (pb_ indices).
+#
+# check_backend runs a backend on a short startup and compares it with a
+# reference run of solve_ivp at a tight tolerance; test_integrators.py runs
+# it on every registered backend, and python integrators.py prints the
+# comparison.
+#
+
+import numpy as np
+import abc
+import math
+import time as wall
+from scipy import integrate
+
+import misc_utils as mu
+import dyn_model  as dm
+import expm_sim   as xs
+import profiling  as pf
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Components of the parameter block of the kernels
+pb_ke = 0
+pb_pole_pairs = 1
+pb_R = 2
+pb_inv_L_M = 3
+pb_inv_Inertia = 4
+pb_Damping = 5
+pb_half_VDC = 6
+pb_torque = 7
+pb_friction = 8
+pb_size = 9
+
+#
+# Parameter block of the motor parameters P and perturbation W
+#
+def parameter_block(P, W):
+    block = np.zeros(pb_size)
+    block[pb_ke] = P.ke
+    block[pb_pole_pairs] = P.pole_pairs
+    block[pb_R] = P.R
+    block[pb_inv_L_M] = P.inv_L_M
+    block[pb_inv_Inertia] = P.inv_Inertia
+    block[pb_Damping] = P.Damping
+    block[pb_half_VDC] = P.half_VDC
+    block[pb_torque] = W[dm.pv_torque]
+    block[pb_friction] = W[dm.pv_friction]
+    return block
+
+#
+# Build the kernels, jit compiling each of them with jit
+#
+# Returns the fixed step functions rk4 and heun, fn(x, u, p, h, out) writing
+# the state after the step h from x to out
+def make_kernels(jit):
+
+    @jit
+    def norm_angle(alpha):
+        alpha_n = math.fmod(alpha, 2. * math.pi)
+        if alpha_n < 0.:
+            alpha_n = (2. * math.pi) + alpha_n
+        return alpha_n
+
+    # same as dyn_model.backemf_shape
+    @jit
+    def backemf_shape(phase_thetae, max_bemf):
+        if 0. <= phase_thetae <= (math.pi * (1./6.)):
+            return (max_bemf / (math.pi * (1./6.))) * phase_thetae
+        elif (math.pi/6.) < phase_thetae <= (math.pi * (5./6.)):
+            return max_bemf
+        elif (math.pi * (5./6.)) < phase_thetae <= (math.pi * (7./6.)):
+            return -((max_bemf/(math.pi/6.)) * (phase_thetae - math.pi))
+        elif (math.pi * (7./6.)) < phase_thetae <= (math.pi * (11./6.)):
+            return -max_bemf
+        return (max_bemf/(math.pi/6.)) * (phase_thetae - (2. * math.pi))
+
+    # same as dyn_model.Model.dyn
+    @jit
+    def derivatives(x, u, p, xd):
+        thetae = x[dm.sv_theta] * p[pb_pole_pairs]
+        omega = x[dm.sv_omega]
+        max_bemf = p[pb_ke] * omega
+        eu = backemf_shape(norm_angle(thetae + 0.), max_bemf)
+        ev = backemf_shape(norm_angle(thetae + math.pi * (2./3.)), max_bemf)
+        ew = backemf_shape(norm_angle(thetae + math.pi * (4./3.)), max_bemf)
+
+        # imposed voltages, the floating phases follow their backemf
+        half_VDC = p[pb_half_VDC]
+        xu = u[dm.iv_hu] == 1 or u[dm.iv_lu] == 1
+        xv = u[dm.iv_hv] == 1 or u[dm.iv_lv] == 1
+        xw = u[dm.iv_hw] == 1 or u[dm.iv_lw] == 1
+        vu = half_VDC if u[dm.iv_hu] == 1 else -half_VDC
+        vv = half_VDC if u[dm.iv_hv] == 1 else -half_VDC
+        vw = half_VDC if u[dm.iv_hw] == 1 else -half_VDC
+        n = 0
+        vm = 0.
+        if xu:
+            vm += vu - eu
+            n += 1
+        if xv:
+            vm += vv - ev
+            n += 1
+        if xw:
+            vm += vw - ew
+            n += 1
+        if n > 0:
+            vm /= n
+            if not xu:
+                vu = eu + vm
+            if not xv:
+                vv = ev + vm
+            if not xw:
+                vw = ew + vm
+        else:
+            vm = eu
+            vu = 0.
+            vv = ev
+            vw = ew
+
+        etorque = (eu * x[dm.sv_iu] + ev * x[dm.sv_iv] + ew * x[dm.sv_iw]) / omega
+        mtorque = etorque * p[pb_pole_pairs] - p[pb_Damping] * omega - p[pb_torque]
+        friction = p[pb_friction]
+        if mtorque > friction:
+            mtorque -= friction
+        elif mtorque < -friction:
+            mtorque += friction
+        else:
+            mtorque = 0.
+
+        R = p[pb_R]
+        inv_L_M = p[pb_inv_L_M]
+        xd[dm.sv_theta] = omega
+        xd[dm.sv_omega] = mtorque * p[pb_inv_Inertia]
+        xd[dm.sv_iu] = (vu - R * x[dm.sv_iu] - eu - vm) * inv_L_M
+        xd[dm.sv_iv] = (vv - R * x[dm.sv_iv] - ev - vm) * inv_L_M
+        xd[dm.sv_iw] = (vw - R * x[dm.sv_iw] - ew - vm) * inv_L_M
+
+    @jit
+    def rk4(x, u, p, h, out):
+        n = x.shape[0]
+        k1 = np.empty(n)
+        k2 = np.empty(n)
+        k3 = np.empty(n)
+        k4 = np.empty(n)
+        xt = np.empty(n)
+        derivatives(x, u, p, k1)
+        for i in range(n):
+            xt[i] = x[i] + 0.5 * h * k1[i]
+        derivatives(xt, u, p, k2)
+        for i in range(n):
+            xt[i] = x[i] + 0.5 * h * k2[i]
+        derivatives(xt, u, p, k3)
+        for i in range(n):
+            xt[i] = x[i] + h * k3[i]
+        derivatives(xt, u, p, k4)
+        for i in range(n):
+            out[i] = x[i] + h / 6. * (k1[i] + 2. * k2[i] + 2. * k3[i] + k4[i])
+
+    @jit
+    def heun(x, u, p, h, out):
+        n = x.shape[0]
+        k1 = np.empty(n)
+        k2 = np.empty(n)
+        xt = np.empty(n)
+        derivatives(x, u, p, k1)
+        for i in range(n):
+            xt[i] = x[i] + h * k1[i]
+        derivatives(xt, u, p, k2)
+        for i in range(n):
+            out[i] = x[i] + 0.5 * h * (k1[i] + k2[i])
+
+    return rk4, heun
+
+python_kernels = make_kernels(lambda fn: fn)
+numba_kernels = make_kernels(numba.njit) if numba is not None else None
+
+#
+# Backend interface
+#
+# P motor parameters, W perturbation, the model evaluations are counted in
+# profile if given
+#
+class Backend(object):
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, P, W, profile=None):
+        self.P = P
+        self.W = W
+        self.profile = profile
+        self.prof = profile or pf.null_profile
+
+    #
+    # State after the step h from X at t, with the command U
+    #
+    @abc.abstractmethod
+    def step(self, X, t, U, h):
+        pass
+
+class OdeintBackend(Backend):
+
+    def __init__(self, P, W, profile=None):
+        Backend.__init__(self, P, W, profile)
+        self.model = dm.Model(P)
+
+    def step(self, X, t, U, h):
+        if self.profile is None:
+            return integrate.odeint(self.model.dyn, X, [t, t + h], args=(U, self.W),
+                                    Dfun=self.model.jacobian)[1,:]
+        Xs, info = integrate.odeint(self.model.dyn, X, [t, t + h], args=(U, self.W),
+                                    Dfun=self.model.jacobian, full_output=True)
+        self.prof.count('nfev', info['nfe'][-1])
+        self.prof.count('njev', info['nje'][-1])
+        self.prof.count('steps', info['nst'][-1])
+        return Xs[1,:]
+
+class SolveIvpBackend(Backend):
+
+    def __init__(self, P, W, profile=None, method='RK45', rtol=1e-6, atol=1e-9):
+        Backend.__init__(self, P, W, profile)
+        self.model = dm.Model(P)
+        self.method = method
+        self.rtol = rtol
+        self.atol = atol
+
+    def step(self, X, t, U, h):
+        model, W = self.model, self.W
+        # solve_ivp keeps the derivatives it is given, each evaluation gets
+        # its own array instead of the model buffer
+        sol = integrate.solve_ivp(lambda t, x: model.dyn(x, t, U, W, np.empty(dm.sv_size)),
+                                  (t, t + h), X,
+                                  method=self.method, rtol=self.rtol, atol=self.atol)
+        self.prof.count('nfev', sol.nfev)
+        self.prof.count('njev', sol.njev)
+        self.prof.count('steps', sol.t.size - 1)
+        return sol.y[:,-1]
+
+class ExpmBackend(Backend):
+
+    def step(self, X, t, U, h):
+        self.prof.count('steps')
+        return xs.step(X, U, self.W, h, self.P)
+
+class KernelBackend(Backend):
+
+    def __init__(self, kernel, stages, P, W, profile=None):
+        Backend.__init__(self, P, W, profile)
+        self.kernel = kernel
+        self.stages = stages
+        self.block = parameter_block(P, W)
+
+    def step(self, X, t, U, h):
+        out = np.empty(dm.sv_size)
+        self.kernel(np.asarray(X, dtype=float), np.asarray(U, dtype=float), self.block, h, out)
+        self.prof.count('nfev', self.stages)
+        self.prof.count('steps')
+        return out
+
+#
+# Backend registry, name -> factory(P, W, profile=None, **options)
+#
+backends = {}
+
+def register(name, factory):
+    backends[name] = factory
+
+register('odeint', OdeintBackend)
+register('solve_ivp', SolveIvpBackend)
+register('expm', ExpmBackend)
+kernels = numba_kernels or python_kernels
+register('rk4', lambda P, W, profile=None: KernelBackend(kernels[0], 4, P, W, profile))
+register('heun', lambda P, W, profile=None: KernelBackend(kernels[1], 2, P, W, profile))
+if numba_kernels is not None:
+    register('rk4_python', lambda P, W, profile=None: KernelBackend(python_kernels[0], 4, P, W, profile))
+    register('heun_python', lambda P, W, profile=None: KernelBackend(python_kernels[1], 2, P, W, profile))
+
+def names():
+    return sorted(backends.keys())
+
+#
+# Backend instance of a given name
+#
+def backend(name, P, W, profile=None, **options):
+    if name not in backends:
+        raise ValueError("Unknown integrator backend {}, known ones are {}".format(name, names()))
+    return backends[name](P, W, profile, **options)
+
+# Scenario of the check: startup at 1 MHz
+check_t_end = 1e-3
+check_h = 1e-6
+check_X0 = [0, mu.rad_of_deg(0.1), 0, 0, 0]
+check_W = [0, 1]
+
+# Backend and options of the reference run, independent of the backends
+# checked with their default options
+check_reference = ('solve_ivp', {'method' : 'RK45', 'rtol' : 1e-10, 'atol' : 1e-12})
+
+# Largest deviation from the reference on the currents (A) and speed
+# (rad/s) of the check. expm holds the rotor over a step, its mechanics are
+# only first order.
+check_tol = 1e-3
+check_tol_backend = {'expm' : 1e-1}
+
+# Reference runs of the check, indexed by pset
+check_references = {}
+
+#
+# States of a run of the check scenario with a backend, and its wall time
+#
+def check_run(name, P, **options):
+    import simulator as sm
+    steps = int(round(check_t_end / check_h))
+    sim = sm.Simulator(check_X0, check_W, P, check_h, backend=name, **options)
+    t0 = wall.time()
+    time, X, Y, U = sim.run(steps)
+    return X, wall.time() - t0
+
+#
+# Run a backend on the check scenario and compare it with the reference
+#
+# Returns the largest deviation, the wall time and the tolerance
+def check_backend(name, pset=2):
+    P = dm.MotorParams.from_pset(pset)
+    if pset not in check_references:
+        reference_name, options = check_reference
+        check_references[pset] = check_run(reference_name, P, **options)[0]
+    reference = check_references[pset]
+    X, elapsed = check_run(name, P)
+    deviation = np.max(np.abs(X[:, dm.sv_omega:] - reference[:, dm.sv_omega:]))
+    return deviation, elapsed, check_tol_backend.get(name, check_tol)
+
+def main():
+    print "{:<12} {:>12} {:>10} {:>6}".format('backend', 'deviation', 'wall (s)', '')
+    passed = True
+    for name in names():
+        deviation, elapsed, tol = check_backend(name)
+        passed = passed and deviation <= tol
+        print "{:<12} {:12.3g} {:10.3f} {:>6}".format(name, deviation, elapsed,
+                                                     'ok' if deviation <= tol else 'FAIL')
+    if numba is None:
+        print "numba is not installed, the kernels are not compiled"
+    if not passed:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,7 @@
 #
 
 import math
+import numpy as np
 
 #
 def rad_of_deg(d): return d/180.*math.pi
@@ -45,3 +46,9 @@ def norm_angle(alpha):
         alpha_n = (2*math.pi) + alpha_n
 
     return alpha_n
+
+#
+# Array version of norm_angle, wraps every element into [0, 2pi)
+#
+def norm_angle_vec(alpha):
+    return np.mod(alpha, 2*math.pi)
@@ -0,0 +1,144 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Multi-rate fixed step simulation
+#
+# The phase currents settle in microseconds while the shaft time constant is
+# in milliseconds. The currents and the controller are sub-cycled with the
+# step size h, the currents being propagated exactly as in expm_sim. The
+# mechanical states, with the load and dry friction, are only advanced every
+# ratio sub-steps (the mechanical step H = ratio * h) with the electromagnetic
+# torque averaged over the sub-steps:
+#
+#   - over a mechanical step the rotor is extrapolated with the acceleration
+#     a of the last mechanical step, omega = omega_m + a s and
+#     theta = theta_m + (omega_m + a s / 2) s, s = t - t_m
+#   - the backemf at the end of a sub-step is the one at the start of the
+#     next, its rate over a sub-step is the secant of the two, so each
+#     sub-step evaluates the backemfs once
+#   - at the end of the mechanical step the acceleration is computed from
+#     the averaged torque, and the load and friction at the mid-step speed,
+#     omega is advanced with it and theta with the mean of the old and new
+#     speeds
+#
+
+import numpy as np
+
+import misc_utils as mu
+import dyn_model  as dm
+import control    as ctl
+import expm_sim   as xs
+import traj_store as ts
+import profiling  as pf
+
+#
+# Simulate from X0 over [0, t_end[ with the sub-step size h and the
+# mechanical step ratio * h
+#
+# The samples, one per sub-step, are handed over to writer in chunks of
+# chunk_size rows. When no writer is given the time, state, output, input and
+# debug vectors are returned. The stages are timed with profile, if given.
+#
+def simulate(X0, t_end, W, h, P, Sp=0, ratio=10, writer=None, chunk_size=4096, profile=None):
+    if writer is None:
+        memory = ts.MemoryWriter()
+        simulate(X0, t_end, W, h, P, Sp, ratio, memory, chunk_size, profile)
+        return memory.arrays()
+
+    prof = profile or pf.null_profile
+    t = prof.clock()
+    Phi = xs.propagators(h, P)
+    prof.lap('propagators', t)
+
+    n = ts.nb_samples(t_end, h)
+    model = dm.Model(P)
+    theta_m = X0[dm.sv_theta]           # rotor angle at the start of the mechanical step
+    omega = X0[dm.sv_omega]             # speed at the start of the mechanical step
+    accel = 0.
+    I = np.array(X0[dm.sv_iu:dm.sv_iw+1], dtype=float)
+    E = dm.phase_backemfs(theta_m, omega, P)
+    sub = 0                             # sub-steps done in the mechanical step
+    etorque_sum = 0.
+    Uc = np.zeros(dm.iv_size)
+    Xc = np.empty(dm.sv_size)
+    z = np.empty(xs.av_size)
+    z[xs.av_one] = 1.
+    for k0 in range(0, n, chunk_size):
+        time = np.arange(k0, min(k0 + chunk_size, n)) * h
+        X = np.zeros((time.size, dm.sv_size))
+        Y = np.zeros((time.size, dm.ov_size))
+        U = np.zeros((time.size, dm.iv_size))
+        Xdebug = np.zeros((time.size, dm.dv_size))
+        for j in range(time.size):
+            t = prof.clock()
+            s = sub * h
+            Xc[dm.sv_theta] = mu.norm_angle(theta_m + (omega + 0.5 * accel * s) * s)
+            Xc[dm.sv_omega] = omega + accel * s
+            Xc[dm.sv_iu:dm.sv_iw+1] = I
+            X[j,:] = Xc
+            model.set_state(Xc, E)
+            if k0 + j < n - 1:
+                model.set_command(Uc)
+                model.output_into(Y[j,:])
+                t = prof.lap('output', t)
+                Uc = ctl.run(Sp, Y[j,:], time[j], P)
+                t = prof.lap('control', t)
+            U[j,:] = Uc
+            model.set_command(Uc)
+            model.output_into(Y[j,:])
+            model.debug_into(Xdebug[j,:])
+            t = prof.lap('record', t)
+            if k0 + j == n - 1:
+                break
+
+            # currents over the sub-step
+            s += h
+            E1 = dm.phase_backemfs(theta_m + (omega + 0.5 * accel * s) * s, omega + accel * s, P)
+            z[xs.av_i:xs.av_i+3] = I
+            z[xs.av_e:xs.av_e+3] = E
+            z[xs.av_edot:xs.av_edot+3] = np.subtract(E1, E) / h
+            I1 = np.dot(Phi[xs.switch_state_index(Uc)], z)
+            etorque_sum += 0.5 * (np.dot(E, I) + np.dot(E1, I1)) / (omega + accel * (s - 0.5 * h))
+            I = I1
+            E = E1
+            sub += 1
+            t = prof.lap('step', t)
+            prof.count('steps')
+
+            # mechanical states at the end of the mechanical step
+            if sub == ratio or k0 + j == n - 2:
+                H = sub * h
+                etorque = etorque_sum / sub
+                accel = dm.mtorque_of_etorque(etorque, omega + 0.5 * accel * H, W, P) * P.inv_Inertia
+                omega1 = omega + accel * H
+                theta_m = mu.norm_angle(theta_m + 0.5 * (omega + omega1) * H)
+                omega = omega1
+                E = dm.phase_backemfs(theta_m, omega, P)
+                sub = 0
+                etorque_sum = 0.
+                prof.lap('mechanics', t)
+                prof.count('mechanical steps')
+
+        t = prof.clock()
+        writer.append(time=time, X=X, Y=Y, U=U, Xdebug=Xdebug)
+        prof.lap('writer', t)
+
+    writer.close()
+    prof.stop()
@@ -17,19 +17,99 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+#
+# PSIM reference captures
+#
+# The exports are parsed in blocks of csv_chunk_lines lines into float64
+# columns and streamed to a sidecar directory next to the CSV file (see
+# traj_store). The sidecar records the size and modification time of the
+# CSV it was made from; as long as they match, later reads memory map it
+# instead of parsing the CSV again.
+#
+
 import numpy      as np
+import os
+import shutil
+import itertools
+
 import dyn_model  as dm
 import misc_utils as mu
+import traj_store as ts
+
+# Channels of a PSIM capture
+psim_channels = [('time', None), ('Y', dm.ov_size)]
+
+# Output vector components read from the PSIM columns, with their unit
+# conversion
+psim_columns = [('ia',  dm.ov_iu,    None),
+                ('ib',  dm.ov_iv,    None),
+                ('ic',  dm.ov_iw,    None),
+                ('vag', dm.ov_vu,    None),
+                ('vbg', dm.ov_vv,    None),
+                ('vcg', dm.ov_vw,    None),
+                ('nm',  dm.ov_omega, mu.radps_of_rpm)]
+
+# Lines parsed at once
+csv_chunk_lines = 65536
+
+# Suffix of the sidecar directory of a CSV file
+cache_suffix = '.cache'
+
+# File of the sidecar identifying the CSV it was made from
+cache_source_file = 'source.txt'
+
+#
+# Identification of the current version of a file
+#
+def source_key(filename):
+    st = os.stat(filename)
+    return "size = {!r}\nmtime = {!r}\n".format(st.st_size, st.st_mtime)
+
+#
+# Parse a PSIM CSV export, handing the samples over to writer
+#
+def parse_csv(filename, writer):
+    f = open(filename)
+    names = [n.strip().strip('"').lower() for n in f.readline().split(',')]
+    col_time = names.index('time')
+    cols = [(names.index(name), ov, conv) for name, ov, conv in psim_columns]
+    while True:
+        lines = list(itertools.islice(f, csv_chunk_lines))
+        if not lines:
+            break
+        values = np.fromstring(''.join(lines).replace('\n', ','), dtype=np.float64, sep=',')
+        values = values.reshape(-1, len(names))
+        Y = np.zeros((values.shape[0], dm.ov_size))
+        for col, ov, conv in cols:
+            Y[:,ov] = values[:,col] if conv is None else conv(values[:,col])
+        writer.append(time=values[:,col_time], Y=Y)
+    f.close()
+    writer.close()
+
+#
+# Read a PSIM CSV export
+#
+# Returns the time and output vectors, memory mapped from the sidecar unless
+# cache is False.
+#
+def read_csv(filename, cache=True):
+    if not cache:
+        memory = ts.MemoryWriter(psim_channels)
+        parse_csv(filename, memory)
+        return memory.arrays()
+
+    cache_dir = filename + cache_suffix
+    key = source_key(filename)
+    source = os.path.join(cache_dir, cache_source_file)
+    if not os.path.exists(source) or open(source).read() != key:
+        tmp_dir = cache_dir + '.tmp'
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        parse_csv(filename, ts.TrajWriter(tmp_dir, psim_channels))
+        open(os.path.join(tmp_dir, cache_source_file), 'w').write(key)
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.rename(tmp_dir, cache_dir)
 
-def read_csv(filename):
-    my_records = np.recfromcsv(filename)
-    Y = np.zeros((my_records.time.size, dm.ov_size))
-    Y[:,dm.ov_iu] = my_records.ia
-    Y[:,dm.ov_iv] = my_records.ib
-    Y[:,dm.ov_iw] = my_records.ic
-    Y[:,dm.ov_vu] = my_records.vag
-    Y[:,dm.ov_vv] = my_records.vbg
-    Y[:,dm.ov_vw] = my_records.vcg
-    Y[:,dm.ov_omega] = mu.radps_of_rpm(my_records.nm)
-#    import code; code.interact(local=locals())
-    return my_records.time, Y
+    traj = ts.Trajectory(cache_dir, psim_channels)
+    return traj.time, traj.Y
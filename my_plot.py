@@ -17,6 +17,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import numpy as np
 import matplotlib.pyplot as plt
 
 import dyn_model  as dm
@@ -26,32 +27,152 @@ ang_unit_rad_s = 0
 ang_unit_deg_s = 1
 ang_unit_rpm = 2
 
-def plot_output(time, Y, ls):
+#
+# Level of detail plotting
+#
+# Long channels are drawn from a min/max pyramid: level l holds the minimum
+# and maximum of every bucket of lod_factor**(l+1) samples. Only the level giving
+# about two points per horizontal pixel in the visible time range is drawn,
+# as the min/max envelope, and the level is picked again on zoom and pan.
+# A unit conversion of a channel is given as a transform, applied to the rows
+# as they are read, so that memory mapped channels are never converted as a
+# whole.
+#
+
+# Channels longer than this are drawn with level of detail
+lod_threshold = 100000
+
+# Samples per bucket of a level in buckets of the level below
+lod_factor = 4
+
+# Rows processed at once when building the first level
+lod_chunk = 1 << 20
+
+#
+# Min/max pyramid of a channel transform(y) sampled at time
+#
+class MinMaxPyramid(object):
+
+    def __init__(self, time, y, transform=None):
+        self.time = time
+        self.y = y
+        self.transform = transform or np.asarray
+        self.levels = []     # (time of the first sample, min, max) of the buckets
+        n = len(y)
+        # first level, built in chunks so that memory mapped channels are
+        # never loaded as a whole
+        step = lod_chunk - lod_chunk % lod_factor
+        parts = []
+        for k in range(0, n, step):
+            y_k = self.transform(y[k:k+step])
+            parts.append(self.reduce(np.asarray(time[k:k+step]), y_k, y_k))
+        level = [np.concatenate([p[i] for p in parts]) for i in range(3)]
+        while True:
+            self.levels.append(level)
+            if len(level[0]) <= lod_factor:
+                break
+            level = self.reduce(*level)
+
+    # buckets of lod_factor samples of a level, the last one can be partial
+    @staticmethod
+    def reduce(t, lo, hi):
+        n = len(t)
+        full = n - n % lod_factor
+        t_b = t[:full:lod_factor]
+        lo_b = lo[:full].reshape(-1, lod_factor).min(axis=1)
+        hi_b = hi[:full].reshape(-1, lod_factor).max(axis=1)
+        if full < n:
+            t_b = np.append(t_b, t[full])
+            lo_b = np.append(lo_b, lo[full:].min())
+            hi_b = np.append(hi_b, hi[full:].max())
+        return t_b, lo_b, hi_b
+
+    #
+    # Points drawing the channel over [t_start, t_end] with at most about
+    # n_points points
+    #
+    def envelope(self, t_start, t_end, n_points):
+        k0 = max(np.searchsorted(self.time, t_start) - 1, 0)
+        k1 = min(np.searchsorted(self.time, t_end) + 1, len(self.time))
+        if k1 - k0 <= n_points:
+            return np.asarray(self.time[k0:k1]), self.transform(self.y[k0:k1])
+        for level in self.levels:
+            t, lo, hi = level
+            b0 = max(np.searchsorted(t, t_start, side='right') - 1, 0)
+            b1 = min(np.searchsorted(t, t_end) + 1, len(t))
+            if 2 * (b1 - b0) <= n_points or level is self.levels[-1]:
+                break
+        t = np.repeat(t[b0:b1], 2)
+        y = np.column_stack((lo[b0:b1], hi[b0:b1])).ravel()
+        return t, y
+
+#
+# Line drawn from a min/max pyramid, updated on the limits changes of its axes
+#
+class LodLine(object):
+
+    def __init__(self, ax, time, y, transform=None, *args, **kwargs):
+        self.ax = ax
+        self.pyramid = MinMaxPyramid(time, y, transform)
+        self.line, = ax.plot(time[:1], self.pyramid.transform(y[:1]), *args, **kwargs)
+        ax.set_xlim(time[0], time[-1])
+        self.update(ax)
+        # the callbacks only keep weak references to bound methods
+        ax.callbacks.connect('xlim_changed', lambda ax: self.update(ax))
+
+    def update(self, ax):
+        t_start, t_end = ax.get_xlim()
+        n_points = 2 * max(int(ax.bbox.width), 1)
+        self.line.set_data(*self.pyramid.envelope(t_start, t_end, n_points))
+
+#
+# Plot transform(y) against time in the current axes, with level of detail
+# for long channels
+#
+def plot(time, y, *args, **kwargs):
+    transform = kwargs.pop('transform', None)
+    if len(time) <= lod_threshold:
+        return plt.plot(time, y if transform is None else transform(y), *args, **kwargs)
+    ax = plt.gca()
+    lod = LodLine(ax, time, y, transform, *args, **kwargs)
+    ax.relim()
+    ax.autoscale_view(scalex=False)
+    return [lod.line]
+
+#
+# Plot the output vectors
+#
+# time can also be a trajectory (see traj_store.Trajectory or a window of
+# one), whose time and output channels are plotted then.
+#
+def plot_output(time, Y=None, ls='-'):
+    if Y is None:
+        time, Y = time.time, time.Y
     ang_unit = ang_unit_rpm
 
     # Phase current
     ax = plt.subplot(4, 1, 1)
     ax.yaxis.set_label_text('A', {'color'    : 'k', 'fontsize'   : 15 })
-    plt.plot(time,Y[:,dm.ov_iu], ls, linewidth=1.5)
-    plt.plot(time,Y[:,dm.ov_iv], ls, linewidth=1.5)
-    plt.plot(time,Y[:,dm.ov_iw], ls, linewidth=1.5)
+    plot(time,Y[:,dm.ov_iu], ls, linewidth=1.5)
+    plot(time,Y[:,dm.ov_iv], ls, linewidth=1.5)
+    plot(time,Y[:,dm.ov_iw], ls, linewidth=1.5)
     plt.legend(['$i_u$', '$i_v$', '$i_w$'], loc='upper right')
     plt.title('Phase current')
 
     # Phase terminal voltage
     ax = plt.subplot(4, 1, 2)
     ax.yaxis.set_label_text('V', {'color'    : 'k', 'fontsize'   : 15 })
-    plt.plot(time,Y[:,dm.ov_vu], ls, linewidth=1.5)
-    plt.plot(time,Y[:,dm.ov_vv], ls, linewidth=1.5)
-    plt.plot(time,Y[:,dm.ov_vw], ls, linewidth=1.5)
+    plot(time,Y[:,dm.ov_vu], ls, linewidth=1.5)
+    plot(time,Y[:,dm.ov_vv], ls, linewidth=1.5)
+    plot(time,Y[:,dm.ov_vw], ls, linewidth=1.5)
     plt.legend(['$v_u$', '$v_v$', '$v_w$'], loc='upper right')
     plt.title('Phase terminal voltage')
 
     # Rotor mechanical position
     ax = plt.subplot(4, 1, 3)
     ax.yaxis.set_label_text('Deg', {'color'    : 'k', 'fontsize'   : 15 })
-    plt.plot(time,mu.deg_of_rad(Y[:,dm.ov_theta]), ls, linewidth=1.5)
-#    plt.plot(time, Y[:,dm.ov_theta], ls, linewidth=1.5)
+    plot(time,Y[:,dm.ov_theta], ls, linewidth=1.5, transform=mu.deg_of_rad)
+#    plot(time, Y[:,dm.ov_theta], ls, linewidth=1.5)
     plt.title('Rotor angular position')
 
     # Rotor mechanical angular speed
@@ -59,34 +180,41 @@ def plot_output(time, Y, ls):
 
     if (ang_unit == ang_unit_rad_s):
         ax.yaxis.set_label_text('Rad/s', {'color'    : 'k', 'fontsize'   : 15 })
-        plt.plot(time,Y[:,dm.ov_omega], ls, linewidth=1.5)
+        plot(time,Y[:,dm.ov_omega], ls, linewidth=1.5)
     elif (ang_unit == ang_unit_deg_s):
         ax.yaxis.set_label_text('Deg/s', {'color'    : 'k', 'fontsize'   : 15 })
-        plt.plot(time,mu.degps_of_radps(Y[:,dm.ov_omega]), ls, linewidth=1.5)
+        plot(time,Y[:,dm.ov_omega], ls, linewidth=1.5, transform=mu.degps_of_radps)
     elif (ang_unit == ang_unit_rpm):
         ax.yaxis.set_label_text('RPM', {'color'    : 'k', 'fontsize'   : 15 })
-        plt.plot(time,mu.rpm_of_radps(Y[:,dm.ov_omega]), ls, linewidth=1.5)
+        plot(time,Y[:,dm.ov_omega], ls, linewidth=1.5, transform=mu.rpm_of_radps)
 
     plt.title('Rotor Rotational Velocity')
 
-def plot_debug(time, Xdebug):
+#
+# Plot the debug vectors
+#
+# time can also be a trajectory, as for plot_output
+#
+def plot_debug(time, Xdebug=None):
+    if Xdebug is None:
+        time, Xdebug = time.time, time.Xdebug
     plt.subplot(4, 1, 1)
 
-    plt.plot(time,Xdebug[:,dm.dv_eu], linewidth=1.5)
-    plt.plot(time,Xdebug[:,dm.dv_ev], linewidth=1.5)
-    plt.plot(time,Xdebug[:,dm.dv_ew], linewidth=1.5)
+    plot(time,Xdebug[:,dm.dv_eu], linewidth=1.5)
+    plot(time,Xdebug[:,dm.dv_ev], linewidth=1.5)
+    plot(time,Xdebug[:,dm.dv_ew], linewidth=1.5)
     plt.legend(['$U_{BEMF}$', '$V_{BEMF}$', '$W_{BEMF}$'], loc='upper right')
 
     plt.subplot(4, 1, 2)
 
-    plt.plot(time,Xdebug[:,dm.dv_ph_U], linewidth=1.5)
-    plt.plot(time,Xdebug[:,dm.dv_ph_V], linewidth=1.5)
-    plt.plot(time,Xdebug[:,dm.dv_ph_W], linewidth=1.5)
+    plot(time,Xdebug[:,dm.dv_ph_U], linewidth=1.5)
+    plot(time,Xdebug[:,dm.dv_ph_V], linewidth=1.5)
+    plot(time,Xdebug[:,dm.dv_ph_W], linewidth=1.5)
     plt.legend(['$U$', '$V$', '$W$'], loc='upper right')
 
     plt.subplot(4, 1, 3)
 
-    plt.plot(time,Xdebug[:,dm.dv_ph_star], linewidth=1.5)
+    plot(time,Xdebug[:,dm.dv_ph_star], linewidth=1.5)
     plt.legend(['$star$'], loc='upper right')
 
 def plot_diodes(time, D):
@@ -95,5 +223,5 @@ def plot_diodes(time, D):
 
     for i in range(0, dm.adc_size):
         plt.subplot(6, 2, 2*i+1)
-        plt.plot(time,D[:,i], 'r', linewidth=1.5)
+        plot(time,D[:,i], 'r', linewidth=1.5)
         plt.title(titles_diodes[i])
@@ -0,0 +1,131 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Simulation loop profiling
+#
+# The engines take an optional profile and time their stages with it:
+#
+#   t = profile.clock()
+#   ... controller ...
+#   t = profile.lap('control', t)
+#   ... solver ...
+#   t = profile.lap('solver', t)
+#
+# and count solver statistics with profile.count('nfev', n). Without a
+# profile they use null_profile, whose methods do nothing.
+#
+
+import json
+import timeit
+
+clock = timeit.default_timer
+
+#
+# Time per stage and counters of a run
+#
+class Profile(object):
+
+    def __init__(self):
+        self.stages = {}     # stage name -> [calls, seconds]
+        self.order = []      # stage names in the order they were first seen
+        self.counters = {}
+        self.start = clock()
+        self.wall = None
+
+    def clock(self):
+        return clock()
+
+    #
+    # Add the time since t0 to the stage, returns the current time
+    #
+    def lap(self, stage, t0):
+        t = clock()
+        try:
+            entry = self.stages[stage]
+        except KeyError:
+            entry = self.stages[stage] = [0, 0.]
+            self.order.append(stage)
+        entry[0] += 1
+        entry[1] += t - t0
+        return t
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    #
+    # Mark the end of the run
+    #
+    def stop(self):
+        self.wall = clock() - self.start
+
+    def total_wall(self):
+        return self.wall if self.wall is not None else clock() - self.start
+
+    #
+    # Summary table of the stages and counters
+    #
+    def summary(self):
+        wall = self.total_wall()
+        lines = ["{:<12} {:>10} {:>10} {:>10} {:>7}".format('stage', 'calls', 'total (s)', 'per call', '%')]
+        timed = 0.
+        for stage in self.order:
+            calls, seconds = self.stages[stage]
+            timed += seconds
+            lines.append("{:<12} {:10d} {:10.4f} {:8.2f}us {:6.1f}%".format(
+                stage, calls, seconds, 1e6 * seconds / calls, 100. * seconds / wall))
+        lines.append("{:<12} {:>10} {:10.4f} {:>10} {:6.1f}%".format(
+            'other', '', wall - timed, '', 100. * (wall - timed) / wall))
+        lines.append("{:<12} {:>10} {:10.4f}".format('wall', '', wall))
+        for name in sorted(self.counters):
+            lines.append("{:<12} {:10d}".format(name, int(self.counters[name])))
+        return '\n'.join(lines)
+
+    def as_dict(self):
+        return {'wall'     : self.total_wall(),
+                'stages'   : dict((stage, {'calls' : calls, 'seconds' : seconds})
+                                  for stage, (calls, seconds) in self.stages.items()),
+                'counters' : self.counters}
+
+    #
+    # Write the profile to a JSON file
+    #
+    def dump(self, filename):
+        f = open(filename, 'w')
+        json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+        f.close()
+
+#
+# Profile doing nothing, for the runs that are not profiled
+#
+class NullProfile(object):
+
+    def clock(self):
+        return 0.
+
+    def lap(self, stage, t0):
+        return 0.
+
+    def count(self, name, n=1):
+        pass
+
+    def stop(self):
+        pass
+
+null_profile = NullProfile()
@@ -18,24 +18,27 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import matplotlib
-matplotlib.use('MacOSX')
-#matplotlib.use('GTKCairo')
 import numpy as np
-import pylab as pl
-import matplotlib.pyplot as plt
-from scipy import integrate
-from scipy.signal import decimate
+import os
+import sys
+
+# matplotlib and my_plot are only imported when plotting, so that the
+# simulation can run on machines without a display (see cli.py)
 
 import misc_utils as mu
 import dyn_model  as dm
 import control    as ctl
 import my_io      as mio
-import my_plot    as mp
+import event_sim  as es
+import expm_sim   as xs
+import traj_store as ts
+import profiling  as pf
+import integrators
 
 
 
 def display_state_and_command(time, X, U):
+    import matplotlib.pyplot as plt
 
     titles_state = ['$\\theta$', '$\omega$', '$i_u$', '$i_v$', '$i_w$']
     titles_cmd = ['$u_l$', '$u_h$', '$v_l$', '$v_h$', '$w_l$', '$w_h$']
@@ -58,65 +61,125 @@ def print_simulation_progress(count, steps):
         if (sim_perc_last != sim_perc):
             print "{}%".format(sim_perc)
 
-def drop_it(a, factor):
-	new = []
-	for n, x in enumerate(a):
-		if ((n % factor) == 0):
-			new.append(x)
-	return np.array(new)
-
-def compress(a, factor):
-	return drop_it(a, factor)
-	#return decimate(a, 8, n=8, axis=0)
+#
+# Original fixed step loop, restarting odeint every simulation step
+#
+# The samples are handed over to writer in chunks of chunk_size rows. When no
+# writer is given the time, state, output, input and debug vectors are
+# returned. The stages are timed with profile, if given, which also gets the
+# integrator statistics. backend is the integrator, see integrators. The
+# progress is printed unless progress is False.
+#
+def run_fixed_step(X0, t_end, W, dt, P, writer=None, chunk_size=4096, profile=None, backend='odeint',
+                   progress=True):
+    if writer is None:
+        memory = ts.MemoryWriter()
+        run_fixed_step(X0, t_end, W, dt, P, memory, chunk_size, profile, backend, progress)
+        return memory.arrays()
+
+    prof = profile or pf.null_profile
+    integrator = integrators.backend(backend, P, W, profile)
+
+    steps = ts.nb_samples(t_end, dt)
+    model = dm.Model(P)                         # model evaluation buffers
+    Xi = np.array(X0, dtype=float)              # state of the current step
+    Yim1 = np.zeros(dm.ov_size)                 # output of the last step
+    Uim1 = np.zeros(dm.iv_size)                 # input of the last step
+    Dim1 = np.zeros(dm.dv_size)                 # debug data of the last step
+    for k0 in range(0, steps, chunk_size):
+        time = np.arange(k0, min(k0 + chunk_size, steps)) * dt # time slice of the chunk
+        X = np.zeros((time.size, dm.sv_size))       # allocate state vector
+        Xdebug = np.zeros((time.size, dm.dv_size))  # allocate debug data vector
+        Y = np.zeros((time.size, dm.ov_size))       # allocate output vector
+        U = np.zeros((time.size, dm.iv_size))       # allocate input vector
+        for j in range(time.size):
+            i = k0 + j
+            X[j,:] = Xi
+            Xdebug[j,:] = Dim1
+            if i < steps - 1:
+                t = prof.clock()
+                model.set_state(Xi)                                 # backemfs of the step
+                model.set_command(Uim1)
+                model.output_into(Y[j,:])                           # get the output for the step
+                t = prof.lap('output', t)
+                U[j,:] = ctl.run(0, Y[j,:], time[j], P)             # run the controller for the step
+                t = prof.lap('control', t)
+                model.set_command(U[j,:])
+                model.debug_into(Dim1)                              # debug data, recorded on the next step
+                t = prof.lap('debug', t)
+                Xi = integrator.step(Xi, time[j], U[j,:], dt)      # integrate
+                t = prof.lap('integrator', t)
+                Xi[dm.sv_theta] = mu.norm_angle(Xi[dm.sv_theta]) # normalize the angle in the state
+            else:
+                Y[j,:] = Yim1
+                U[j,:] = Uim1
+            Yim1 = Y[j,:]
+            Uim1 = U[j,:]
+            if progress:
+                t = prof.clock()
+                print_simulation_progress(i+1, steps)
+                prof.lap('progress', t)
+
+        t = prof.clock()
+        writer.append(time=time, X=X, Y=Y, U=U, Xdebug=Xdebug)
+        prof.lap('writer', t)
+
+    writer.close()
+    prof.stop()
 
 def main():
+    import matplotlib
+    if sys.platform == 'darwin':
+        matplotlib.use('MacOSX')
+    #matplotlib.use('GTKCairo')
+    import matplotlib.pyplot as plt
+    import my_plot as mp
+
 #    t_psim, Y_psim =  mio.read_csv('bldc_startup_psim_1us_resolution.csv')
 #    mp.plot_output(t_psim, Y_psim, '.')
 
     freq_sim = 1e6                              # simulation frequency
     compress_factor = 3
-    time = pl.arange(0.0, 0.01, 1./freq_sim) # create time slice vector
-    X = np.zeros((time.size, dm.sv_size))       # allocate state vector
-    Xdebug = np.zeros((time.size, dm.dv_size))  # allocate debug data vector
-    Y = np.zeros((time.size, dm.ov_size))       # allocate output vector
-    U = np.zeros((time.size, dm.iv_size))       # allocate input vector
+    compress_mode = 'stride'                    # decimator mode, 'stride', 'fir', 'iir',
+                                                # 'mean', 'min' or 'max' (the filters
+                                                # smear the wraps of theta)
+    engine = 'event'                            # 'event': integrate between switching events
+                                                # 'expm': exact current propagators, fixed step
+                                                # 'step': odeint restarted every step
+    P = dm.MotorParams.from_pset(2)             # motor parameters
     X0 = [0, mu.rad_of_deg(0.1), 0, 0, 0]       #
-    X[0,:] = X0
     W = [0, 1]
-    for i in range(1,time.size):
-
-        if i==1:
-            Uim2 = np.zeros(dm.iv_size)
-        else:
-            Uim2 = U[i-2,:]
-
-        Y[i-1,:] = dm.output(X[i-1,:], Uim2)                  # get the output for the last step
-        U[i-1,:] = ctl.run(0, Y[i-1,:], time[i-1])            # run the controller for the last step
-        tmp = integrate.odeint(dm.dyn, X[i-1,:], [time[i-1], time[i]], args=(U[i-1,:], W)) # integrate
-        X[i,:] = tmp[1,:] # copy integration output to the current step
-        X[i, dm.sv_theta] = mu.norm_angle( X[i, dm.sv_theta]) # normalize the angle in the state
-        tmp, Xdebug[i,:] = dm.dyn_debug(X[i-1,:], time[i-1], U[i-1,:], W) # get debug data
-        print_simulation_progress(i, time.size)
-
-    Y[-1,:] = Y[-2,:]
-    U[-1,:] = U[-2,:]
-
-    if compress_factor > 1:
-        time = compress(time, compress_factor)
-        Y = compress(Y, compress_factor)
-        X = compress(X, compress_factor)
-        U = compress(U, compress_factor)
-        Xdebug = compress(Xdebug, compress_factor)
-
-    mp.plot_output(time, Y, '-')
-#    pl.show()
+
+    t_end = 0.01
+    traj_dir = 'traj'                           # directory the trajectory is streamed to
+    do_profile = False                          # time the simulation stages
+
+    profile = pf.Profile() if do_profile else None
+
+    # the trajectory is decimated while it is streamed
+    writer = ts.TrajWriter(traj_dir, decimation=compress_factor, mode=compress_mode)
+    if engine == 'event':
+        es.simulate(X0, t_end, W, 1./freq_sim, P, writer=writer, profile=profile)
+    elif engine == 'expm':
+        xs.simulate(X0, t_end, W, 1./freq_sim, P, writer=writer, profile=profile)
+    else:
+        run_fixed_step(X0, t_end, W, 1./freq_sim, P, writer=writer, profile=profile)
+
+    if profile is not None:
+        print profile.summary()
+        profile.dump(os.path.join(traj_dir, 'profile.json'))
+
+    traj = ts.Trajectory(traj_dir)
+
+    mp.plot_output(traj, ls='-')
+#    plt.show()
     plt.figure(figsize=(10.24, 5.12))
-    display_state_and_command(time, X, U)
+    display_state_and_command(traj.time, traj.X, traj.U)
 
     plt.figure(figsize=(10.24, 5.12))
-    mp.plot_debug(time, Xdebug)
+    mp.plot_debug(traj)
 
-    pl.show()
+    plt.show()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,99 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Step by step simulation
+#
+# The motor and inverter advance one control period at a time with the
+# switch vector given by the caller, who gets the output vector back. This
+# leaves the loop, and the controller, to the caller:
+#
+#   sim = Simulator(X0, W, P, h)
+#   Y = sim.output()
+#   while sim.t < t_end:
+#       Y = sim.step(controller(Y, sim.t))
+#
+# The state is advanced by an integrator backend (see integrators), by
+# default the exact current propagators of expm_sim, built with the given
+# backend options.
+#
+
+import numpy as np
+
+import dyn_model  as dm
+import control    as ctl
+import expm_sim   as xs
+import integrators
+
+class Simulator(object):
+
+    def __init__(self, X0, W, P, h, t0=0., backend='expm', **options):
+        self.P = P
+        self.W = W
+        self.h = h                           # control period
+        self.t0 = t0
+        self.t = t0
+        self.n = 0                           # periods done
+        self.X = np.array(X0, dtype=float)
+        self.U = np.zeros(dm.iv_size)        # switch vector of the last period
+        self.Y = np.zeros(dm.ov_size)
+        self.model = dm.Model(P)
+        self.integrator = integrators.backend(backend, P, W, **options)
+        if backend == 'expm':
+            xs.propagators(h, P)             # not in the first step
+
+    #
+    # Output vector of the current state, the switches being as in the last
+    # period
+    #
+    def output(self):
+        self.model.set_state(self.X)
+        self.model.set_command(self.U)
+        self.model.output_into(self.Y)
+        return self.Y
+
+    #
+    # Advance one control period with the switch vector U
+    #
+    # Returns the output vector at the end of the period
+    def step(self, U):
+        self.U = np.array(U, dtype=float)
+        self.X = self.integrator.step(self.X, self.t, self.U, self.h)
+        self.n += 1
+        self.t = self.t0 + self.n * self.h   # no drift of the PWM edges
+        return self.output()
+
+    #
+    # Run the Python controller (control.run) for steps periods
+    #
+    # Returns the time, state, output and input vectors, the output and input
+    # of a row being the ones the controller got and gave
+    def run(self, steps, Sp=0):
+        time = np.zeros(steps)
+        X = np.zeros((steps, dm.sv_size))
+        Y = np.zeros((steps, dm.ov_size))
+        U = np.zeros((steps, dm.iv_size))
+        y = self.output()
+        for k in range(steps):
+            time[k] = self.t
+            X[k] = self.X
+            Y[k] = y
+            U[k] = ctl.run(Sp, y, self.t, self.P)
+            y = self.step(U[k])
+        return time, X, Y, U
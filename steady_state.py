@@ -0,0 +1,417 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Periodic steady state by shooting
+#
+# Instead of simulating the spin-up until it settles, the operating point at
+# a given load and duty is found directly. The rotor is started at the
+# electrical angle 0 with the speed and currents x = (omega, iu, iv), iw
+# being -iu-iv, and integrated until it has turned one electrical revolution.
+# The steady state is the x that revolution brings back to itself, found
+# with a root finder on the revolution map.
+#
+# The PWM averaged model (see event_sim) is shot first with a damped Newton
+# iteration, starting from the speed at which the duty cycle would balance
+# the damping and the load. Its steady state and the Jacobian of its
+# revolution map there start the switched model shooting, which keeps that
+# Jacobian (chord method) so that every iteration only costs one switched
+# revolution. The PWM carrier starts with the revolution; as it is not
+# synchronous with the rotor, the switched steady state is the revolution
+# seen with that carrier phase.
+#
+# The Newton steps are least squares solutions, the speed changing by at
+# most max_speed_change in a step. They are halved until the rotor turns
+# forward with currents below current_limit times the stall current and, for
+# the averaged model, until the residual decreases. A revolution taking more
+# than max_revolution_nfev model evaluations fails the shooting.
+#
+# When the mechanical time constant Inertia/Damping is much longer than a
+# revolution (pset 0: 2.2 s against 0.6 ms at the starting speed), the speed
+# hardly changes over a revolution and the Newton iteration can find no step
+# decreasing the residual, which the currents dominate. The averaged shooting
+# then falls back to bracketing the speed: the currents are made periodic at
+# every speed tried, by Newton iterations on the currents only, and the
+# speed residual left is solved with brentq, starting from the speed reached
+# by halving or doubling the starting one until it changes sign. The Newton
+# iteration carries on from there and 'bracketed' is set in the averaged
+# statistics. This takes a few hundred revolutions instead of tens.
+#
+# With dry friction every speed at which the motor torque does not overcome
+# the friction is a steady state: the speed does not come back after a
+# revolution and the row of the Jacobian of the speed is 0. The averaged
+# steady state found is then the one at the starting speed, the switched
+# shooting lets the speed follow the revolutions as long as the PWM ripple
+# beats the friction, and 'dead_band' is set in the result.
+#
+#   op = steady_state.solve([0, 1], P)
+#   time, X, Y, U, Xdebug = op['trajectory']
+#
+
+import numpy as np
+import math
+import sys
+from scipy import integrate
+from scipy import optimize
+
+import misc_utils as mu
+import dyn_model  as dm
+import control    as ctl
+import event_sim  as es
+
+# Longest revolution, in s, before the rotor is considered stalled
+max_period = 1.
+
+# Most model evaluations of a revolution
+max_revolution_nfev = 200000
+
+# Largest phase current of the shooting, relative to the stall current VDC/R
+current_limit = 2.
+
+# Convergence of the Newton iteration on the averaged revolution map,
+# relative to the state. The map is only smooth to the integration tolerance.
+xtol = 1e-5
+
+# Relative step of the finite difference Jacobian of the revolution map, well
+# above the integration tolerance
+jacobian_step = 1e-3
+
+# Convergence of the switched shooting, relative to the state. Its map is only
+# smooth to the PWM ripple and the integration tolerance.
+switched_tol = 1e-4
+max_iterations = 20
+
+# Halvings of a Newton step before giving up, and the largest change of the
+# speed in a step, relative to the speed
+max_halvings = 20
+max_speed_change = 0.5
+
+#
+# Speed the duty cycle gives without load: the PWM averaged voltage applied
+# across the two conducting phases matching their backemf
+#
+def no_load_speed(P):
+    return ctl.PWM_duty * P.VDC / (2. * P.ke)
+
+#
+# Speed at which the duty cycle balances the damping and load torque, the
+# two conducting phases being taken as a DC motor (the dry friction is left
+# out). Never above no_load_speed.
+#
+def start_speed(W, P):
+    V = ctl.PWM_duty * P.VDC
+    omega = ((P.ke * P.pole_pairs * V / P.R - W[dm.pv_torque]) /
+             (P.Damping + 2. * P.ke ** 2 * P.pole_pairs / P.R))
+    return min(max(omega, 0.01 * no_load_speed(P)), no_load_speed(P))
+
+#
+# State of the section for x = (omega, iu, iv)
+#
+def section_state(x):
+    omega, iu, iv = x
+    return np.array([0., omega, iu, iv, -iu - iv])
+
+#
+# Whether x = (omega, iu, iv) is a state the shooting can start a revolution
+# from: the rotor turns forward and the currents are within current_limit
+#
+def in_range(x, P):
+    omega, iu, iv = x
+    i_max = current_limit * P.VDC / P.R
+    return omega > 0. and max(abs(iu), abs(iv), abs(iu + iv)) <= i_max
+
+#
+# Integrate from X at t = 0 until the rotor has turned one electrical
+# revolution
+#
+# Returns the duration of the revolution, the state at its end, the rotor
+# angle not being normalized, and the number of model evaluations
+def revolution(X, W, P, Sp=0, average=False, method='RK45', rtol=1e-6, atol=1e-9):
+    if X[dm.sv_omega] <= 0.:
+        raise RuntimeError("the rotor does not turn forward, omega = {}".format(X[dm.sv_omega]))
+    model = dm.Model(P)
+    theta_end = X[dm.sv_theta] + 2. * math.pi / P.pole_pairs
+
+    def cross_end(t, x):
+        return x[dm.sv_theta] - theta_end
+    cross_end.terminal = True
+    cross_end.direction = 1.
+
+    t = 0.
+    Xc = np.array(X, dtype=float)
+    Uc = np.zeros(dm.iv_size)
+    nfev = 0
+    while True:
+        if average:
+            Uc, U_off, duty = es.average_command(Sp, Xc, Uc, t, P)
+            t_next = max_period
+
+            def fun(t, x, Uc=Uc, U_off=U_off, duty=duty):
+                model.set_state(x)
+                model.set_average_command(Uc, U_off, duty)
+                return model.derivatives(W, np.empty(dm.sv_size))
+        else:
+            t_next = es.next_pwm_edge(t)
+            Uc = es.command(Sp, Xc, Uc, t, t_next, P)
+            U_off, duty = Uc, 1.
+
+            def fun(t, x, Uc=Uc):
+                return model.dyn(x, t, Uc, W, np.empty(dm.sv_size))
+        if t >= max_period:
+            raise RuntimeError("no revolution within {} s, the rotor stalls".format(max_period))
+        if nfev > max_revolution_nfev:
+            raise RuntimeError("no revolution within {} model evaluations".format(max_revolution_nfev))
+
+        events, boundaries = es.sector_events(Xc, P)
+        sol = integrate.solve_ivp(fun, (t, t_next), Xc, method=method,
+                                  events=events + [cross_end], dense_output=True,
+                                  rtol=rtol, atol=atol,
+                                  **es.jacobian_option(method, model, W, Uc, U_off, duty))
+        if sol.status < 0:
+            raise RuntimeError("integration failed at t={}: {}".format(t, sol.message))
+        nfev += sol.nfev
+
+        if sol.status == 1:
+            # first of the events that fired
+            fired = [(event_t[0], k) for k, event_t in enumerate(sol.t_events) if event_t.size > 0]
+            t, k = min(fired)
+            Xc = sol.sol(t)
+            if k == len(events):
+                Xc[dm.sv_theta] = theta_end
+                return t, Xc, nfev
+            direction = [1., -1.][k]
+            Xc[dm.sv_theta] = (boundaries[k] + direction * es.angle_eps) / P.pole_pairs
+        else:
+            t = t_next
+            Xc = sol.y[:,-1]
+
+#
+# Revolution map, as the residual x' - x, of x = (omega, iu, iv)
+#
+# Returns the residual and the duration of the revolution, stats accumulates
+# the number of revolutions and model evaluations
+def residual(x, W, P, Sp, average, solver, stats):
+    period, Xe, nfev = revolution(section_state(x), W, P, Sp, average, **solver)
+    stats['revolutions'] += 1
+    stats['nfev'] += nfev
+    return np.array([Xe[dm.sv_omega] - x[0], Xe[dm.sv_iu] - x[1], Xe[dm.sv_iv] - x[2]]), period
+
+#
+# Finite difference Jacobian of the residual at x, r being the residual there
+#
+# Only the given columns are computed, all of them by default.
+def jacobian(x, r, W, P, Sp, average, solver, stats, columns=None):
+    if columns is None:
+        columns = range(len(x))
+    J = np.empty((len(x), len(columns)))
+    for c, k in enumerate(columns):
+        dx = np.zeros(len(x))
+        dx[k] = jacobian_step * max(abs(x[k]), 1.)
+        J[:,c] = (residual(x + dx, W, P, Sp, average, solver, stats)[0] - r) / dx[k]
+    return J
+
+#
+# Newton step of the residual r with the Jacobian J, least squares as J is
+# singular in the friction dead band
+#
+def newton_step(J, r):
+    return np.linalg.lstsq(J, -r, rcond=None)[0]
+
+#
+# Damped step from x along dx
+#
+# The step is halved until x + dx is in range and, with descent, until the
+# residual decreases from r, both scaled by x. Returns the new x, its
+# residual and revolution duration.
+def damped_step(x, r, dx, W, P, Sp, average, solver, stats, descent):
+    scale = np.maximum(np.abs(x), 1.)
+    if abs(dx[0]) > max_speed_change * x[0]:
+        dx = dx * (max_speed_change * x[0] / abs(dx[0]))
+    for k in range(max_halvings):
+        x1 = x + dx
+        if in_range(x1, P):
+            r1, period = residual(x1, W, P, Sp, average, solver, stats)
+            if not descent or np.linalg.norm(r1 / scale) < np.linalg.norm(r / scale):
+                return x1, r1, period
+        dx = 0.5 * dx
+    raise RuntimeError("no Newton step within range decreasing the residual from {}".format(x))
+
+#
+# Periodic currents of the averaged revolution map at the speed omega
+#
+# Newton iterations on the currents only, from i0 = (iu, iv), stopping at
+# xtol or when the residual of the currents stops decreasing, the map being
+# only smooth to the integration tolerance. Returns x = (omega, iu, iv) and
+# its residual.
+def periodic_currents(omega, i0, W, P, Sp, solver, stats):
+    x = np.array([omega, i0[0], i0[1]], dtype=float)
+    r = residual(x, W, P, Sp, True, solver, stats)[0]
+    for k in range(max_iterations):
+        J = jacobian(x, r, W, P, Sp, True, solver, stats, columns=[1, 2])
+        x1 = x.copy()
+        x1[1:] += newton_step(J[1:], r[1:])
+        if not in_range(x1, P):
+            break
+        r1 = residual(x1, W, P, Sp, True, solver, stats)[0]
+        if np.linalg.norm(r1[1:]) >= np.linalg.norm(r[1:]):
+            break
+        converged = np.all(np.abs(x1 - x) <= xtol * np.maximum(np.abs(x1), 1.))
+        x, r = x1, r1
+        if converged:
+            break
+    return x, r
+
+#
+# Averaged steady state by bracketing the speed from omega0, the currents
+# being periodic at every speed tried
+#
+# Returns x = (omega, iu, iv)
+def bracket_speed(omega0, W, P, Sp, solver, stats):
+    currents = [np.zeros(2)]
+
+    def speed_residual(omega):
+        x, r = periodic_currents(omega, currents[0], W, P, Sp, solver, stats)
+        currents[0] = x[1:]
+        return r[0]
+
+    omega, r = omega0, speed_residual(omega0)
+    factor = 0.5 if r < 0. else 2.
+    for k in range(max_halvings):
+        omega1 = omega * factor
+        r1 = speed_residual(omega1)
+        if r * r1 <= 0.:
+            break
+        omega, r = omega1, r1
+    else:
+        raise RuntimeError("the averaged speed residual keeps its sign from {} to {} rad/s".format(
+            omega0, omega1))
+    omega = optimize.brentq(speed_residual, min(omega, omega1), max(omega, omega1), rtol=xtol)
+    return periodic_currents(omega, currents[0], W, P, Sp, solver, stats)[0]
+
+#
+# Shoot the averaged revolution map from x0 = (omega, iu, iv)
+#
+# The speed is bracketed (bracket_speed) when no Newton step decreases the
+# residual. Returns the steady state x, the revolution duration, the
+# Jacobian of the residual there and the solver statistics
+def shoot_average(x0, W, P, Sp=0, **solver):
+    stats = {'revolutions' : 0, 'nfev' : 0, 'bracketed' : False}
+    x = np.array(x0, dtype=float)
+    if not in_range(x, P):
+        raise RuntimeError("the shooting cannot start from {}".format(x))
+    r, period = residual(x, W, P, Sp, True, solver, stats)
+    for k in range(max_iterations):
+        J = jacobian(x, r, W, P, Sp, True, solver, stats)
+        dx = newton_step(J, r)
+        if np.all(np.abs(dx) <= xtol * np.maximum(np.abs(x), 1.)):
+            stats['residual'] = np.max(np.abs(r))
+            return x, period, J, stats
+        try:
+            x, r, period = damped_step(x, r, dx, W, P, Sp, True, solver, stats, True)
+        except RuntimeError:
+            if stats['bracketed']:
+                raise
+            x = bracket_speed(x[0], W, P, Sp, solver, stats)
+            r, period = residual(x, W, P, Sp, True, solver, stats)
+            stats['bracketed'] = True
+    raise RuntimeError("no averaged steady state after {} iterations".format(max_iterations))
+
+#
+# Shoot the switched revolution map from x0 with the residual Jacobian J
+#
+# Returns the steady state x, the revolution duration and the solver
+# statistics
+def shoot_switched(x0, J, W, P, Sp=0, **solver):
+    stats = {'revolutions' : 0, 'nfev' : 0}
+    x = np.array(x0, dtype=float)
+    r, period = residual(x, W, P, Sp, False, solver, stats)
+    for k in range(max_iterations):
+        dx = newton_step(J, r)
+        if np.all(np.abs(dx) <= switched_tol * np.maximum(np.abs(x), 1.)):
+            stats['residual'] = np.max(np.abs(r))
+            return x, period, stats
+        x, r, period = damped_step(x, r, dx, W, P, Sp, False, solver, stats, False)
+    raise RuntimeError("no switched steady state after {} revolutions".format(max_iterations))
+
+#
+# Periodic steady state of the switched model at the load W
+#
+# The controller settings (PWM_duty, ...) are the ones of control. Returns a
+# dictionary with the state at the start of the revolution 'X', its duration
+# 'period', the trajectory over it sampled every dt_out, 'trajectory' (time,
+# state, output, input and debug vectors as event_sim.simulate), whether the
+# speed is in the friction dead band, 'dead_band', and the statistics of the
+# averaged and switched shootings.
+#
+def solve(W, P, Sp=0, dt_out=1e-6, omega0=None, **solver):
+    if omega0 is None:
+        omega0 = start_speed(W, P)
+    x_avg, period_avg, J, stats_avg = shoot_average([omega0, 0., 0.], W, P, Sp, **solver)
+    dead_band = not np.any(J[0])
+    if dead_band:
+        # the PWM ripple can still beat the friction, the speed then follows
+        # the switched revolutions until it stops changing
+        J = J.copy()
+        J[0] = [-1., 0., 0.]
+    x, period, stats = shoot_switched(x_avg, J, W, P, Sp, **solver)
+
+    X = section_state(x)
+    trajectory = es.simulate(X, period, W, dt_out, P, Sp, **solver)
+
+    return {'X'          : X,
+            'period'     : period,
+            'trajectory' : trajectory,
+            'dead_band'  : dead_band,
+            'average'    : dict(stats_avg, X=section_state(x_avg), period=period_avg),
+            'stats'      : stats}
+
+#
+# Electromagnetic torque on the rotor of a trajectory, and its mean and peak
+# to peak ripple
+#
+def torque_ripple(trajectory, P):
+    time, X, Y, U, Xdebug = trajectory[:5]
+    E = Xdebug[:, dm.dv_eu:dm.dv_ew+1]
+    I = X[:, dm.sv_iu:dm.sv_iw+1]
+    etorque = (E * I).sum(axis=1) / X[:, dm.sv_omega] * P.pole_pairs
+    return etorque, np.mean(etorque), np.ptp(etorque)
+
+#
+# Operating point of a parameter set, python steady_state.py [pset [torque [friction]]]
+#
+def main():
+    pset = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    W = [float(w) for w in sys.argv[2:4]] + [0., 0.][len(sys.argv[2:4]):]
+    P = dm.MotorParams.from_pset(pset)
+    op = solve(W, P)
+    etorque, mean, ripple = torque_ripple(op['trajectory'], P)
+    I = op['trajectory'][1][:, dm.sv_iu:dm.sv_iw+1]
+    print "speed {:.2f} rpm, electrical period {:.3f} ms".format(
+        mu.rpm_of_radps(op['X'][dm.sv_omega]), 1e3 * op['period'])
+    print "torque {:.4g} Nm, ripple {:.4g} Nm peak to peak".format(mean, ripple)
+    print "phase current rms {:.4g} A".format(np.sqrt(np.mean(I ** 2)))
+    if op['dead_band']:
+        print "in the friction dead band, every speed around is a steady state"
+    if op['average']['bracketed']:
+        print "averaged speed bracketed, the mechanics are much slower than a revolution"
+    print "revolutions: {} averaged, {} switched".format(op['average']['revolutions'],
+                                                         op['stats']['revolutions'])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Parameter sweeps
+#
+# Every run of a sweep is a dictionary of settings overriding the defaults:
+# the parameter set 'pset' and any of its motor parameters (the
+# dyn_model.MotorParams names), the controller settings (control.settings(),
+# PWM_freq, PWM_duty and pattern), the load 'torque' and 'friction', the initial state 'X0' and the run
+# length 't_end'. The runs are spread over a pool of worker processes; each
+# worker only sends back a summary of its run and, optionally, a decimated
+# output trace. The summary is computed while the run is streamed, so the
+# memory of a worker does not grow with the run length.
+#
+
+import numpy as np
+import itertools
+import multiprocessing
+
+import misc_utils as mu
+import dyn_model  as dm
+import control    as ctl
+import event_sim  as es
+import traj_store as ts
+
+# Settings of a run that are not given
+defaults = {
+    'pset'     : 2,
+    't_end'    : 0.01,
+    'dt'       : 1e-6,        # output resolution the summary is computed on
+    'X0'       : [0, mu.rad_of_deg(0.1), 0, 0, 0],
+    'torque'   : 0.,
+    'friction' : 1.,
+    }
+defaults.update(ctl.settings())
+
+# Relative band around the final speed the rotor has to stay in to be settled
+settle_band = 0.02
+
+# Buckets of the speed envelope the settling time is found on, at most
+settle_buckets = 1000
+
+# Columns of the results table
+summary_dtype = [('run', int),
+                 ('peak_iu', float), ('peak_iv', float), ('peak_iw', float),
+                 ('final_omega', float), ('settling_time', float)]
+
+#
+# Cartesian product of the values given for each setting
+#
+# grid(R=[8., 11.9], PWM_duty=[0.4, 0.6]) gives the 4 runs
+#
+def grid(**axes):
+    names = sorted(axes.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[axes[n] for n in names])]
+
+#
+# Time after which omega stays within settle_band of its final value
+#
+# omega is given as its low and high envelope over buckets of samples, the
+# bucket k spanning [time[k], time[k+1][ and the last one ending at t_last.
+def settling_time(time, low, high, final, t_last):
+    band = settle_band * abs(final)
+    outside = np.nonzero((final - low > band) | (high - final > band))[0]
+    if outside.size == 0:
+        return time[0]
+    return np.append(time[1:], t_last)[outside[-1]]
+
+#
+# Writer summarizing a run as it is streamed
+#
+# The current peaks and the final speed are exact. The speed is kept as its
+# min/max envelope over at most settle_buckets buckets of rows, so the
+# settling time is exact up to a bucket and the memory used does not depend
+# on the run length. With trace_stride, every trace_stride-th output row is
+# kept as well.
+class SummaryWriter(object):
+
+    def __init__(self, n, trace_stride=None):
+        size = max(1, -(-n // settle_buckets))
+        omega = [('time', None), ('omega', None)]
+        self.low = ts.MemoryWriter(omega, size, 'min')
+        self.high = ts.MemoryWriter(omega, size, 'max')
+        self.trace = None
+        if trace_stride:
+            self.trace = ts.MemoryWriter([('time', None), ('Y', dm.ov_size)], trace_stride)
+        self.peaks = np.zeros(3)
+        self.t_last = np.nan
+        self.final_omega = np.nan
+
+    def append(self, **block):
+        time, Y = block['time'], block['Y']
+        if len(time) == 0:
+            return
+        self.peaks = np.maximum(self.peaks, np.abs(Y[:, dm.ov_iu:dm.ov_iw+1]).max(axis=0))
+        self.t_last = time[-1]
+        self.final_omega = Y[-1, dm.ov_omega]
+        self.low.append(time=time, omega=Y[:, dm.ov_omega])
+        self.high.append(time=time, omega=Y[:, dm.ov_omega])
+        if self.trace is not None:
+            self.trace.append(time=time, Y=Y)
+
+    def close(self):
+        for writer in (self.low, self.high, self.trace):
+            if writer is not None:
+                writer.close()
+
+    #
+    # Peak currents, final speed and settling time
+    #
+    def summary(self):
+        time, low = self.low.arrays()
+        high = self.high.arrays()[1]
+        return tuple(self.peaks) + (self.final_omega,
+                                    settling_time(time, low, high, self.final_omega, self.t_last))
+
+#
+# Motor parameters of a run
+#
+def motor_params(settings):
+    P = dm.MotorParams.from_pset(settings['pset'])
+    return P.replace(**dict((name, settings[name]) for name in P.names if name in settings))
+
+#
+# Apply the controller settings of a run to the controller module
+#
+def apply_settings(settings):
+    ctl.apply_settings(**dict((name, settings[name]) for name in ctl.settings()))
+
+#
+# Check the settings of the runs before starting any of them
+#
+def check_runs(runs):
+    known = set(defaults) | set(dm.MotorParams.names)
+    for r in runs:
+        unknown = sorted(name for name in r if name not in known)
+        if unknown:
+            raise ValueError("unknown sweep settings {}".format(unknown))
+        if r.get('pattern', ctl.pattern) not in ctl.patterns:
+            raise ValueError("Unknown pattern {}".format(r['pattern']))
+
+#
+# Type of the results column of a swept setting, object for the settings that
+# are not numbers (pattern)
+#
+def column_type(values):
+    if all(isinstance(v, (int, long, float, np.number)) for v in values):
+        return float
+    return object
+
+#
+# Simulate one run and summarize it, this is what the workers execute
+#
+def run_one(job):
+    index, run, trace_stride = job
+    settings = dict(defaults)
+    settings.update(run)
+    apply_settings(settings)
+    P = motor_params(settings)
+
+    W = [settings['torque'], settings['friction']]
+    writer = SummaryWriter(ts.nb_samples(settings['t_end'], settings['dt']), trace_stride)
+    es.simulate(settings['X0'], settings['t_end'], W, settings['dt'], P, writer=writer)
+
+    trace = None
+    if trace_stride:
+        trace = tuple(writer.trace.arrays())
+
+    return (index,) + writer.summary(), trace
+
+#
+# Run all the runs on a pool of processes
+#
+# runs is a list of settings dictionaries (see grid). With trace_stride set,
+# the output of every run decimated by that factor is returned as well.
+#
+# Returns the results table, a record array with the summary of every run
+# and the settings that were swept, and the list of (time, Y) traces
+#
+def run(runs, processes=None, chunksize=None, trace_stride=None):
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if chunksize is None:
+        chunksize = max(1, len(runs) // (4 * processes))
+
+    check_runs(runs)
+    jobs = [(index, r, trace_stride) for index, r in enumerate(runs)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        outputs = pool.map(run_one, jobs, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+    swept = sorted(set(name for r in runs for name in r if name != 'X0'))
+    dtype = summary_dtype + [(name, column_type([r[name] for r in runs if name in r]))
+                             for name in swept]
+    results = np.zeros(len(runs), dtype=dtype)
+    for (summary, trace), r in zip(outputs, runs):
+        row = results[summary[0]]
+        for (name, t), value in zip(summary_dtype, summary):
+            row[name] = value
+        settings = dict(defaults)
+        settings.update(r)
+        P = motor_params(settings)
+        for name in swept:
+            row[name] = getattr(P, name) if name in P.names else settings[name]
+
+    traces = None
+    if trace_stride:
+        traces = [trace for summary, trace in outputs]
+
+    return results.view(np.recarray), traces
+
+def main():
+    runs = grid(PWM_duty=[0.4, 0.5, 0.6, 0.7], Inertia=[0.000007, 0.000014, 0.000028])
+    results, traces = run(runs)
+    print "{:>4} {:>10} {:>10} {:>10} {:>10} {:>10}".format('run', 'duty', 'inertia', 'peak iu', 'rpm', 'settle')
+    for r in results:
+        print "{:4d} {:10.2f} {:10.2e} {:10.3f} {:10.1f} {:10.4f}".format(
+            r.run, r.PWM_duty, r.Inertia, r.peak_iu, mu.rpm_of_radps(r.final_omega), r.settling_time)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Integrator backends check, one test per registered backend
+#
+# python -m unittest test_integrators
+#
+
+import unittest
+import numpy as np
+
+import dyn_model  as dm
+import integrators
+
+class TestBackends(unittest.TestCase):
+    pass
+
+#
+# Test of the backend name against the reference run
+#
+def backend_test(name):
+    def test(self):
+        deviation, elapsed, tol = integrators.check_backend(name)
+        self.assertLessEqual(deviation, tol, "{} deviates by {} from the reference".format(name, deviation))
+    return test
+
+for name in integrators.names():
+    setattr(TestBackends, 'test_' + name, backend_test(name))
+
+#
+# The compiled kernels give the same states as the Python ones
+#
+@unittest.skipUnless(integrators.numba is not None, 'numba is not installed')
+class TestCompiledKernels(unittest.TestCase):
+
+    def check_kernel(self, name):
+        P = dm.MotorParams.from_pset(2)
+        X = integrators.check_run(name, P)[0]
+        X_python = integrators.check_run(name + '_python', P)[0]
+        np.testing.assert_allclose(X, X_python, rtol=1e-9, atol=1e-12)
+
+    def test_rk4(self):
+        self.check_kernel('rk4')
+
+    def test_heun(self):
+        self.check_kernel('heun')
+
+if __name__ == "__main__":
+    unittest.main()
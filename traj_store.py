@@ -0,0 +1,389 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Trajectory store
+#
+# The simulation engines hand their results over in blocks of rows to a
+# writer, which decimates them on the fly (see decimator). TrajWriter streams them to one
+# .npy file per channel in a directory, going through a fixed size buffer so
+# that the memory used does not depend on the run length. MemoryWriter keeps
+# them in memory for short runs.
+#
+# Trajectory reads a written directory back through memory maps: nothing is
+# loaded until it is used, and a time window only pages in its own rows. The
+# writer records the time grid in meta.txt so that times map to rows without
+# searching.
+#
+
+import numpy as np
+import copy
+import math
+import os
+import struct
+
+import dyn_model  as dm
+import decimator  as dec
+
+# Channels written by the simulation engines, with the width of their rows
+sim_channels = [('time', None),
+                ('X', dm.sv_size),
+                ('Y', dm.ov_size),
+                ('U', dm.iv_size),
+                ('Xdebug', dm.dv_size)]
+
+# Name of the file holding the time grid of a trajectory directory
+meta_file = 'meta.txt'
+
+# Rows whose time is within this fraction of a step of t are taken to be at t
+index_eps = 1e-6
+
+# Size of the .npy headers we write, large enough for any shape and keeping
+# the data aligned
+npy_header_size = 128
+
+#
+# Header of a version 1.0 .npy file, padded to npy_header_size
+#
+def npy_header(shape, dtype):
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+        np.dtype(dtype).str, tuple(shape))
+    header = header.ljust(npy_header_size - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+#
+# Shape of a channel holding n rows of the given width
+#
+def channel_shape(n, width):
+    if width is None:
+        return (n,)
+    return (n, width)
+
+#
+# Number of samples of a run of length t_end sampled every dt, the length of
+# np.arange(0, t_end, dt)
+#
+def nb_samples(t_end, dt):
+    return int(math.ceil(t_end / dt))
+
+#
+# Index of the first sample at or after t on a grid sampled every dt
+#
+def grid_index(t, dt):
+    if not dt > 0:
+        raise ValueError("sampling period {!r} is not positive".format(dt))
+    k = int(math.ceil(t / dt))
+    if k > 0 and (k - 1) * dt >= t:
+        k -= 1
+    elif k * dt < t:
+        k += 1
+    return k
+
+#
+# Buffer collecting rows and handing them over in blocks of chunk_size rows
+#
+# emit is called with one array per channel.
+class ChunkBuffer(object):
+
+    def __init__(self, channels, chunk_size, emit):
+        self.channels = channels
+        self.chunk_size = chunk_size
+        self.emit = emit
+        self.buffered = 0
+        self.buffers = dict((name, np.empty(channel_shape(chunk_size, width)))
+                            for name, width in channels)
+
+    def push(self, **rows):
+        n = len(rows[self.channels[0][0]])
+        done = 0
+        while done < n:
+            n_copy = min(n - done, self.chunk_size - self.buffered)
+            for name, width in self.channels:
+                self.buffers[name][self.buffered:self.buffered+n_copy] = rows[name][done:done+n_copy]
+            self.buffered += n_copy
+            done += n_copy
+            if self.buffered == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        if self.buffered > 0:
+            self.emit(**dict((name, self.buffers[name][:self.buffered])
+                             for name, width in self.channels))
+        self.buffered = 0
+
+#
+# Size in bytes of the rows of a channel
+#
+def row_bytes(width):
+    return np.dtype(float).itemsize * (1 if width is None else width)
+
+#
+# Copy the first rows of the channel files of a directory to another one
+#
+def copy_prefix(src, dst, rows, channels=sim_channels):
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+    for name, width in channels:
+        fin = open(os.path.join(src, name + '.npy'), 'rb')
+        fout = open(os.path.join(dst, name + '.npy'), 'wb')
+        left = npy_header_size + rows * row_bytes(width)
+        while left > 0:
+            data = fin.read(min(left, 1 << 20))
+            if not data:
+                break
+            fout.write(data)
+            left -= len(data)
+        fout.close()
+        fin.close()
+
+#
+# Writer streaming the channels to .npy files in a directory
+#
+# With position, a value returned by position() of an earlier writer on the
+# same directory, the files are cut back to that position and the writer
+# carries on from there.
+class TrajWriter(object):
+
+    # attributes making up the position of a writer
+    position_names = ['rows', 't0', 't_last', 'step', 'uniform', 'decimator']
+
+    def __init__(self, directory, channels=sim_channels, chunk_size=65536, decimation=1, mode='stride',
+                 position=None):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.channels = channels
+        self.decimator = dec.decimator(decimation, mode)
+        self.buffer = ChunkBuffer(channels, chunk_size, self.write)
+        self.rows = 0        # rows written to the files
+        self.t0 = None       # time of the first row
+        self.t_last = None   # time of the last row
+        self.step = None     # time between the first two rows
+        self.uniform = True  # whether all the rows are step apart
+        self.files = {}
+        if position is None:
+            for name, width in channels:
+                f = open(os.path.join(directory, name + '.npy'), 'wb')
+                f.write(npy_header(channel_shape(0, width), float))
+                self.files[name] = f
+        else:
+            for name in self.position_names:
+                setattr(self, name, copy.deepcopy(position[name]))
+            for name, width in channels:
+                f = open(os.path.join(directory, name + '.npy'), 'r+b')
+                f.truncate(npy_header_size + self.rows * row_bytes(width))
+                f.seek(0, os.SEEK_END)
+                self.files[name] = f
+
+    #
+    # Position of the writer in the stream, everything appended so far being
+    # written to the files
+    #
+    def position(self):
+        self.buffer.flush()
+        for f in self.files.values():
+            f.flush()
+        return dict((name, copy.deepcopy(getattr(self, name))) for name in self.position_names)
+
+    #
+    # Append a block of rows, one array per channel, all with the same length
+    #
+    def append(self, **block):
+        block = self.decimator.process(dict((name, block[name]) for name, width in self.channels))
+        self.buffer.push(**block)
+
+    #
+    # Write a chunk of rows to the files
+    #
+    def write(self, **chunk):
+        for name, width in self.channels:
+            self.files[name].write(np.ascontiguousarray(chunk[name], dtype=float).tobytes())
+        self.rows += len(chunk[self.channels[0][0]])
+        if 'time' in chunk:
+            self.follow_time(chunk['time'])
+
+    #
+    # Keep track of the time grid of the rows written
+    #
+    def follow_time(self, time):
+        if self.t_last is not None:
+            time = np.concatenate(([self.t_last], time))
+        else:
+            self.t0 = time[0]
+        if self.step is None and time.size > 1:
+            self.step = time[1] - time[0]
+            # rows at the same time, or going back, are not a grid
+            self.uniform = self.step > 0
+        if self.step is not None and self.uniform:
+            self.uniform = bool(np.all(np.abs(np.diff(time) - self.step) <= index_eps * self.step))
+        self.t_last = time[-1]
+
+    #
+    # Flush and write the final shapes in the file headers
+    #
+    def close(self):
+        block = self.decimator.flush()
+        if block is not None:
+            self.buffer.push(**block)
+        self.buffer.flush()
+        for name, width in self.channels:
+            f = self.files[name]
+            f.seek(0)
+            f.write(npy_header(channel_shape(self.rows, width), float))
+            f.close()
+        if self.t0 is not None:
+            write_meta(self.directory, self.rows, self.t0, self.t_last, self.uniform)
+
+#
+# Writer keeping the channels in memory
+#
+class MemoryWriter(object):
+
+    def __init__(self, channels=sim_channels, decimation=1, mode='stride'):
+        self.channels = channels
+        self.decimator = dec.decimator(decimation, mode)
+        self.blocks = dict((name, []) for name, width in channels)
+
+    def append(self, **block):
+        self.store(self.decimator.process(dict((name, block[name]) for name, width in self.channels)))
+
+    def store(self, block):
+        for name, width in self.channels:
+            self.blocks[name].append(np.array(block[name], dtype=float))
+
+    def close(self):
+        block = self.decimator.flush()
+        if block is not None:
+            self.store(block)
+
+    #
+    # The channels, as a list of arrays in the channels order
+    #
+    def arrays(self):
+        return [np.concatenate(self.blocks[name]) if self.blocks[name]
+                else np.zeros(channel_shape(0, width))
+                for name, width in self.channels]
+
+#
+# Load a trajectory written by TrajWriter
+#
+# Returns the channels as a list of arrays in the channels order
+def load(directory, channels=sim_channels):
+    return [np.load(os.path.join(directory, name + '.npy')) for name, width in channels]
+
+#
+# Write the time grid of a trajectory directory
+#
+# A single row, or rows not moving forward in time, make no grid: they are
+# recorded as non uniform and searched.
+def write_meta(directory, rows, t0, t_last, uniform):
+    uniform = uniform and rows > 1 and t_last > t0
+    f = open(os.path.join(directory, meta_file), 'w')
+    f.write("rows = {!r}\n".format(rows))
+    f.write("t0 = {!r}\n".format(float(t0)))
+    f.write("t_last = {!r}\n".format(float(t_last)))
+    f.write("uniform = {!r}\n".format(int(uniform)))
+    f.close()
+
+#
+# Read the time grid of a trajectory directory, None if it has none
+#
+def read_meta(directory):
+    filename = os.path.join(directory, meta_file)
+    if not os.path.exists(filename):
+        return None
+    meta = {}
+    for line in open(filename):
+        line = line.split('#')[0].strip()
+        if line:
+            name, value = line.split('=')
+            meta[name.strip()] = float(value)
+    meta['rows'] = int(meta['rows'])
+    meta['uniform'] = bool(meta['uniform'])
+    return meta
+
+#
+# Trajectory read lazily from a directory written by TrajWriter
+#
+# The channels are attributes (traj.time, traj.X, traj.Y, ...) holding read
+# only memory maps of the files. traj.window(t_start, t_end) gives the
+# trajectory restricted to [t_start, t_end[ without reading anything.
+#
+class Trajectory(object):
+
+    def __init__(self, directory, channels=sim_channels):
+        self.directory = directory
+        self.channels = channels
+        self.first = 0
+        for name, width in channels:
+            setattr(self, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r'))
+        self.rows = len(getattr(self, channels[0][0]))
+
+        meta = read_meta(directory)
+        if meta is None:
+            meta = {'rows'    : self.rows,
+                    't0'      : self.time[0] if self.rows else 0.,
+                    't_last'  : self.time[-1] if self.rows else 0.,
+                    'uniform' : False}
+        self.t0 = meta['t0']
+        self.dt = (meta['t_last'] - meta['t0']) / (meta['rows'] - 1) if meta['rows'] > 1 else 0.
+        self.uniform = meta['uniform'] and self.dt > 0.
+
+    def __len__(self):
+        return self.rows
+
+    #
+    # Row of the first sample at or after the time t, in [0, len(self)]
+    #
+    # On a uniform grid this is computed without looking at the samples.
+    def index(self, t):
+        if not self.uniform:
+            return int(np.searchsorted(self.time, t - index_eps * self.dt))
+        k = int(math.ceil((t - self.t0) / self.dt - index_eps)) - self.first
+        return min(max(k, 0), self.rows)
+
+    #
+    # Trajectory restricted to the rows in [t_start, t_end[
+    #
+    def window(self, t_start=None, t_end=None):
+        k0 = 0 if t_start is None else self.index(t_start)
+        k1 = self.rows if t_end is None else max(k0, self.index(t_end))
+        return self[k0:k1]
+
+    #
+    # Trajectory restricted to a slice of rows
+    #
+    def __getitem__(self, rows):
+        if not isinstance(rows, slice) or rows.step not in (None, 1):
+            raise IndexError('trajectories can only be sliced by contiguous rows')
+        k0, k1, step = rows.indices(self.rows)
+        k1 = max(k0, k1)
+        view = object.__new__(Trajectory)
+        view.__dict__.update(self.__dict__)
+        for name, width in self.channels:
+            setattr(view, name, getattr(self, name)[k0:k1])
+        view.first = self.first + k0
+        view.rows = k1 - k0
+        return view
+
+    #
+    # The channels, as a list of arrays in the channels order
+    #
+    def arrays(self):
+        return [getattr(self, name) for name, width in self.channels]
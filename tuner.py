@@ -0,0 +1,259 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Step size and tolerance tuner
+#
+# A short startup is simulated with a high resolution reference setting of
+# the engine, then with coarser and coarser settings until one of the output
+# channels ov_* leaves the error bound. The coarsest setting within the bound
+# is kept, with the speedup it gives over the default setting, in a cache
+# file indexed by engine and parameter set. cli.py --tuned runs with it.
+#
+# The setting is the step size of the fixed step engines (expm, multirate,
+# step), doubled at every try, and the relative tolerance of the event
+# engine, multiplied by 10 at every try, the output being sampled on the
+# reference grid. The error of a channel is the RMS of its deviation from the
+# reference relative to the RMS of the reference channels of its kind (the
+# three currents, the three voltages, the angle, the speed), so that a phase
+# that stays off does not need to be matched to the rounding; the search
+# assumes it grows with the setting. The wall times compared are the best of
+# timing_repeat runs, after a run filling the propagator caches of the expm
+# and multirate engines, so that every setting is timed with a warm cache.
+#
+# python tuner.py --engine expm --pset 2 --bound 0.01
+#
+
+import numpy as np
+import argparse
+import json
+import os
+import time as wall
+
+import misc_utils as mu
+import dyn_model  as dm
+import control    as ctl
+import traj_store as ts
+import integrators
+import cli
+
+# Cache file, next to this one
+cache_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tuning.json')
+
+# Startup scenario of the tuning
+tune_t_end = 2e-3
+tune_X0 = [0, mu.rad_of_deg(0.1), 0, 0, 0]
+tune_W = [0, 1]
+
+# Default settings the speedup is measured against, the one of sim_1 for the
+# fixed step engines
+default_dt = 1e-6
+default_rtol = 1e-6
+atol_ratio = 1e-3                       # atol = atol_ratio * rtol
+
+# Reference settings, the number of coarser settings tried and the loosest
+# tolerance tried
+reference_dt = default_dt / 8.
+reference_rtol = 1e-10
+max_tries = 10
+max_rtol = 1e-3
+
+# Timed runs of every setting whose wall time is compared
+timing_repeat = 3
+
+# Factor between two settings tried
+dt_factor = 2
+rtol_factor = 10.
+
+channel_names = ['iu', 'iv', 'iw', 'vu', 'vv', 'vw', 'theta', 'omega']
+channel_kinds = [slice(dm.ov_iu, dm.ov_iw+1), slice(dm.ov_vu, dm.ov_vw+1),
+                 slice(dm.ov_theta, dm.ov_theta+1), slice(dm.ov_omega, dm.ov_omega+1)]
+
+#
+# Name of the tuned setting of an engine, 'dt' or 'rtol'
+#
+def knob(engine):
+    return 'rtol' if engine == 'event' else 'dt'
+
+#
+# Cache key of an engine and parameter set
+#
+def cache_key(engine, pset, backend='odeint'):
+    if engine == 'step':
+        engine = 'step/{}'.format(backend)
+    return '{}/{}'.format(engine, pset)
+
+#
+# Outputs of a run of the scenario with the given setting, and its wall time
+#
+# dt is the step of the fixed step engines and the sampling of the event
+# engine
+def run(engine, P, dt, rtol, t_end=tune_t_end, backend='odeint'):
+    memory = ts.MemoryWriter()
+    t0 = wall.time()
+    cli.simulate(engine, tune_X0, t_end, tune_W, dt, P, memory, None,
+                 backend=backend, rtol=rtol, atol=atol_ratio * rtol, progress=False)
+    elapsed = wall.time() - t0
+    return memory.arrays()[2], elapsed
+
+#
+# Wall time of a run of the scenario with the given setting, the best of
+# timing_repeat runs after an untimed one filling the propagator caches
+#
+def wall_time(engine, P, dt, rtol, t_end=tune_t_end, backend='odeint'):
+    run(engine, P, dt, rtol, t_end, backend)
+    return min(run(engine, P, dt, rtol, t_end, backend)[1] for k in range(timing_repeat))
+
+#
+# Error of every output channel of Y against the reference Yref, sampled
+# every stride reference samples
+#
+def channel_errors(Y, Yref, stride=1):
+    Yref = Yref[::stride][:len(Y)]
+    D = Y[:len(Yref)] - Yref
+    D[:, dm.ov_theta] = mu.norm_angle_vec(D[:, dm.ov_theta] + np.pi) - np.pi
+    rms = np.sqrt(np.mean(D ** 2, axis=0))
+    scale = np.empty(dm.ov_size)
+    for kind in channel_kinds:
+        scale[kind] = np.sqrt(np.mean(Yref[:, kind] ** 2))
+    # channels staying at 0 in the reference must stay at 0
+    return rms / np.maximum(scale, np.finfo(float).tiny)
+
+#
+# Search the coarsest setting of engine keeping every output channel within
+# bound, a scalar or one bound per ov_* channel
+#
+# Returns a dictionary with the setting, the channel errors with it, the
+# wall time of the reference, default and tuned runs and the speedup of the
+# tuned run over the default one
+def tune(engine, P, bound, t_end=tune_t_end, backend='odeint'):
+    bound = np.broadcast_to(np.asarray(bound, dtype=float), (dm.ov_size,))
+    fixed_step = knob(engine) == 'dt'
+    Yref = run(engine, P, reference_dt, reference_rtol, t_end, backend)[0]
+
+    setting = None
+    errors = None
+    for k in range(1, max_tries + 1):
+        if fixed_step:
+            dt, rtol, stride = reference_dt * dt_factor ** k, default_rtol, dt_factor ** k
+            value = dt
+        else:
+            dt, rtol, stride = reference_dt, reference_rtol * rtol_factor ** k, 1
+            value = rtol
+            if rtol > max_rtol:
+                break
+        Y = run(engine, P, dt, rtol, t_end, backend)[0]
+        e = channel_errors(Y, Yref, stride)
+        if np.any(e > bound):
+            failed = [channel_names[i] for i in np.flatnonzero(e > bound)]
+            break
+        setting, errors, tuned = value, e, (dt, rtol)
+    if setting is None:
+        raise RuntimeError("the {} engine leaves the bound on {} at the first setting coarser "
+                           "than the reference".format(engine, ', '.join(failed)))
+
+    ref_wall = wall_time(engine, P, reference_dt, reference_rtol, t_end, backend)
+    if fixed_step:
+        default_wall = wall_time(engine, P, default_dt, default_rtol, t_end, backend)
+    else:
+        default_wall = wall_time(engine, P, reference_dt, default_rtol, t_end, backend)
+    tuned_wall = wall_time(engine, P, tuned[0], tuned[1], t_end, backend)
+    return {knob(engine)     : setting,
+            'errors'         : dict(zip(channel_names, errors.tolist())),
+            'bound'          : bound.tolist(),
+            't_end'          : t_end,
+            'reference_wall' : ref_wall,
+            'default_wall'   : default_wall,
+            'tuned_wall'     : tuned_wall,
+            'speedup'        : default_wall / tuned_wall}
+
+def load_cache():
+    if not os.path.exists(cache_file):
+        return {}
+    return json.load(open(cache_file))
+
+def save_cache(cache):
+    f = open(cache_file, 'w')
+    json.dump(cache, f, indent=1, sort_keys=True)
+    f.close()
+
+#
+# Cached tuning of an engine and parameter set, None when there is none or
+# when it was made with other motor parameters or controller settings
+#
+def cached(engine, pset, P, backend='odeint'):
+    entry = load_cache().get(cache_key(engine, pset, backend))
+    if entry is None or entry['params'] != P.values() or entry['controller'] != ctl.settings():
+        return None
+    return entry
+
+#
+# Tune an engine for a parameter set and store the result in the cache
+#
+def tune_and_cache(engine, pset, P, bound, t_end=tune_t_end, backend='odeint'):
+    entry = tune(engine, P, bound, t_end, backend)
+    entry['params'] = P.values()
+    entry['controller'] = ctl.settings()
+    cache = load_cache()
+    cache[cache_key(engine, pset, backend)] = entry
+    save_cache(cache)
+    return entry
+
+def report(key, entry):
+    name = [n for n in ('dt', 'rtol') if n in entry][0]
+    print "{}: {} = {:g}".format(key, name, entry[name])
+    print "{:<8} {:>10} {:>10}".format('channel', 'error', 'bound')
+    for k, channel in enumerate(channel_names):
+        print "{:<8} {:10.3g} {:10.3g}".format(channel, entry['errors'][channel], entry['bound'][k])
+    print "wall: reference {:.3f} s, default {:.3f} s, tuned {:.3f} s, speedup {:.2f}x".format(
+        entry['reference_wall'], entry['default_wall'], entry['tuned_wall'], entry['speedup'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Step size and tolerance tuner')
+    parser.add_argument('--engine', choices=cli.engines, default='expm')
+    parser.add_argument('--backend', choices=integrators.names(), default='odeint',
+                        help='integrator (step engine)')
+    parser.add_argument('--pset', type=int, default=2, help='parameter set')
+    parser.add_argument('--params', help='parameter file, overrides --pset')
+    parser.add_argument('--duty', type=float, default=ctl.PWM_duty, help='PWM duty cycle')
+    parser.add_argument('--bound', type=float, nargs='+', default=[0.01],
+                        help='relative RMS error bound, one or one per output channel')
+    parser.add_argument('--t-end', type=float, default=tune_t_end, help='scenario length in s')
+    parser.add_argument('--cached', action='store_true', help='only show the cached tuning')
+    args = parser.parse_args()
+
+    if args.params:
+        P = dm.MotorParams.load(args.params)
+        pset = os.path.basename(args.params)
+    else:
+        P = dm.MotorParams.from_pset(args.pset)
+        pset = args.pset
+    ctl.apply_settings(PWM_duty=args.duty)
+    key = cache_key(args.engine, pset, args.backend)
+
+    if args.cached:
+        entry = cached(args.engine, pset, P, args.backend)
+        if entry is None:
+            raise SystemExit("no tuning of {} for these settings".format(key))
+    else:
+        entry = tune_and_cache(args.engine, pset, P, args.bound, args.t_end, args.backend)
+    report(key, entry)
+
+if __name__ == "__main__":
+    main()
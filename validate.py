@@ -0,0 +1,132 @@
+#
+# Open-BLDC pysim - Open BrushLess DC Motor Controller python simulator
+# Copyright (C) 2011 by Antoine Drouin <poinix@gmail.com>
+# Copyright (C) 2011 by Piotr Esden-Tempski <piotr@esden.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Comparison of a simulation against a reference trace
+#
+# Both output vectors are resampled on a common time grid covering the time
+# span they share, then every compared output gets its RMS and peak error
+# and the lag of the simulation behind the reference, all outputs at once.
+#
+# python validate.py capture.csv compares the default simulation with a PSIM
+# capture.
+#
+
+import numpy as np
+import sys
+
+import misc_utils as mu
+import dyn_model  as dm
+import my_io      as mio
+import event_sim  as es
+
+# Outputs compared, the ones PSIM captures
+compared_outputs = [ov for name, ov, conv in mio.psim_columns]
+
+# Names of the outputs in the reports
+output_names = ['iu', 'iv', 'iw', 'vu', 'vv', 'vw', 'theta', 'omega']
+
+# Columns of the metrics table
+metrics_dtype = [('output', 'S8'),
+                 ('rms', float), ('rel_rms', float), ('peak', float), ('lag', float)]
+
+#
+# Mean time step of a time vector
+#
+def mean_step(time):
+    return (time[-1] - time[0]) / (len(time) - 1)
+
+#
+# Linear interpolation of all the columns of Y, sampled at time, on grid
+#
+def resample(time, Y, grid):
+    k = np.clip(np.searchsorted(time, grid, side='right'), 1, len(time) - 1)
+    t0 = time[k-1]
+    t1 = time[k]
+    w = ((grid - t0) / np.where(t1 > t0, t1 - t0, 1.))[:,np.newaxis]
+    return (1. - w) * Y[k-1] + w * Y[k]
+
+#
+# Lag of every column of A behind the same column of B, in samples
+#
+# The lag maximizing the cross correlation of the centered columns, searched
+# within [-max_lag, max_lag].
+def lags(A, B, max_lag):
+    n = A.shape[0]
+    size = 2 ** int(np.ceil(np.log2(2 * n)))
+    FA = np.fft.rfft(A - A.mean(axis=0), size, axis=0)
+    FB = np.fft.rfft(B - B.mean(axis=0), size, axis=0)
+    xcorr = np.fft.irfft(FA * np.conj(FB), size, axis=0)
+    candidates = np.concatenate((np.arange(0, max_lag + 1), np.arange(-max_lag, 0)))
+    return candidates[np.argmax(xcorr[candidates], axis=0)]
+
+#
+# Compare the simulated outputs Y_sim with the reference outputs Y_ref
+#
+# The grid step dt defaults to the coarser step of the two traces, max_lag
+# is the largest lag searched, in seconds, a tenth of the compared span by
+# default.
+#
+# Returns a record array with one row per compared output
+#
+def compare(t_sim, Y_sim, t_ref, Y_ref, dt=None, max_lag=None, outputs=compared_outputs):
+    t_start = max(t_sim[0], t_ref[0])
+    t_end = min(t_sim[-1], t_ref[-1])
+    if t_end <= t_start:
+        raise ValueError('the traces do not overlap in time')
+    if dt is None:
+        dt = max(mean_step(t_sim), mean_step(t_ref))
+    if max_lag is None:
+        max_lag = 0.1 * (t_end - t_start)
+
+    grid = t_start + np.arange(int(np.floor((t_end - t_start) / dt)) + 1) * dt
+    A = resample(t_sim, Y_sim, grid)[:,outputs]
+    B = resample(t_ref, Y_ref, grid)[:,outputs]
+
+    E = A - B
+    metrics = np.zeros(len(outputs), dtype=metrics_dtype).view(np.recarray)
+    metrics.output = [output_names[ov] for ov in outputs]
+    metrics.rms = np.sqrt(np.mean(E ** 2, axis=0))
+    ref_rms = np.sqrt(np.mean(B ** 2, axis=0))
+    metrics.rel_rms = metrics.rms / np.where(ref_rms > 0, ref_rms, np.nan)
+    metrics.peak = np.abs(E).max(axis=0)
+    metrics.lag = lags(A, B, min(int(max_lag / dt), grid.size - 1)) * dt
+    return metrics
+
+#
+# Compact text report of the metrics of compare
+#
+def report(metrics):
+    lines = ["{:>8} {:>12} {:>10} {:>12} {:>12}".format('output', 'rms', 'rel rms', 'peak', 'lag (us)')]
+    for m in metrics:
+        lines.append("{:>8} {:12.5g} {:10.3%} {:12.5g} {:12.2f}".format(
+            m.output, m.rms, m.rel_rms, m.peak, m.lag * 1e6))
+    return '\n'.join(lines)
+
+def main():
+    t_ref, Y_ref = mio.read_csv(sys.argv[1])
+    P = dm.MotorParams.from_pset(2)
+    X0 = [0, mu.rad_of_deg(0.1), 0, 0, 0]
+    W = [0, 1]
+    dt = mean_step(t_ref)
+    t_sim, X, Y_sim, U, Xdebug = es.simulate(X0, t_ref[-1] + dt, W, dt, P)
+    print report(compare(t_sim, Y_sim, t_ref, Y_ref))
+
+if __name__ == "__main__":
+    main()